@@ -1,8 +1,16 @@
 # _cert.py
 
+""" Signing certificates. CERTS is a registry of the certificates configured in [CERT] CERTIFICATES:
+reload() reads the valid rows of dbo.Certificates with one query, parses the new and renewed ones in
+parallel and swaps the complete mapping in at once, so lookups never see a half-updated registry and
+signatures already running keep the certificate they started with. Certificates that cannot be loaded
+or have expired are retired one by one instead of stopping the service.
+"""
+
 import os
-import sys
 from datetime import datetime, timezone
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.serialization import pkcs12
 from cryptography.fernet import Fernet
@@ -12,13 +20,21 @@ from _logger import logger
 
 
 cipher_suite = Fernet(ENCRYPTION_KEY)
-CERTS: dict = {}
+DEFAULT_PASSWORD = '123456'
+
+
+class CertificateError(Exception):
+    pass
 
 
 class Certificate:
     directory = DIR_CERTIFICATE
 
-    def __init__(self, name, password='123456'):
+    def __init__(self, name, password=DEFAULT_PASSWORD, pfx_encrypted: bytes = None, use_database: bool = True):
+        """pfx_encrypted is the CertificateData of the valid dbo.Certificates row, if it was already read.
+        Without it the row is fetched, or the certificate is loaded from disk and stored in the database.
+        With use_database=False the certificate is only loaded from disk.
+        Raises CertificateError if no valid certificate can be loaded."""
         logger.info(f"Processing certificate {name}")
         self.name = name
         self.password = password
@@ -26,15 +42,21 @@ class Certificate:
         self.pfx_decrypted = None
         self.private_key = None
         self.certificate = None
+        self.chain = []
         self.issuer = None
         self.expiration = None
         self.subject = None
         self.file_path = os.path.join(self.directory, f"{self.name}.pfx")
 
-        if not self.fetch_valid_certificate():
+        self.pfx_encrypted = pfx_encrypted
+        if not use_database:
             if not self.load_from_disk():
-                logger.critical("Unable to load a valid certificate. Terminating program.")
-                sys.exit(1)
+                raise CertificateError(f"Unable to load a valid certificate {self.name}.")
+            self._extract_certificate()
+            self._check_validity()
+        elif pfx_encrypted is None and not self.fetch_valid_certificate():
+            if not self.load_from_disk():
+                raise CertificateError(f"Unable to load a valid certificate {self.name}.")
             else:
                 self._extract_certificate()
                 self._check_validity()
@@ -78,6 +100,7 @@ class Certificate:
             self.private_key, self.certificate, additional_certificates = pkcs12.load_key_and_certificates(
                 self.pfx_decrypted, self.password.encode(), default_backend()
             )
+            self.chain = list(additional_certificates or [])
             self.expiration = self.certificate.not_valid_after.astimezone(timezone.utc)
             self.issuer = self.certificate.issuer.rfc4514_string(),
             self.issuer = self.issuer[0]
@@ -85,8 +108,7 @@ class Certificate:
 
             logger.info(f"Expiration: {self.expiration}. Issuer: {self.issuer}. Subject: {self.subject}")
         except Exception as e:
-            logger.critical(f"An error occurred while extracting certificate: {e}")
-            sys.exit(1)
+            raise CertificateError(f"An error occurred while extracting certificate {self.name}: {e}")
         else:
             logger.info(f"Certificated {self.name} successfully extracted.")
 
@@ -103,13 +125,15 @@ class Certificate:
         try:
             self.pfx_decrypted = cipher_suite.decrypt(self.pfx_encrypted)
         except Exception as e:
-            logger.critical(f"Decryption error: {e}")
-            sys.exit(1)
+            raise CertificateError(f"Decryption error of certificate {self.name}: {str(e) or type(e).__name__}")
+
+    @property
+    def expired(self) -> bool:
+        return self.expiration < datetime.now(timezone.utc)
 
     def _check_validity(self) -> None:
-        if self.expiration < datetime.now(timezone.utc):
-            logger.critical("Certificate has expired.")
-            sys.exit(1)
+        if self.expired:
+            raise CertificateError(f"Certificate {self.name} has expired on {self.expiration}.")
         logger.warning(f'Certificate {self.name} will expire on: {self.expiration}')
 
     def _insert_cert_to_db(self):
@@ -132,3 +156,118 @@ class Certificate:
             logger.error(f"Problem with deleting file {e}.")
         else:
             logger.info(f"The file {os.path.basename(self.file_path)} was removed from the disk.")
+
+
+def parse_certificates(value: str) -> dict:
+    """Parses the [CERT] CERTIFICATES setting, 'name password' or 'name' separated by commas, to {name: password}."""
+    configured = {}
+    for cert in value.strip(',').split(','):
+        if cert.strip():
+            cert = cert.strip().split(' ')
+            if len(cert) == 2:
+                name, pwd = cert
+                configured[name] = pwd
+            elif len(cert) == 1:
+                configured[cert[0]] = DEFAULT_PASSWORD
+            else:
+                logger.error(f"Error parsing certificate data: '{cert}'")
+    return configured
+
+
+class CertificateRegistry(Mapping):
+    """Read-only mapping of certificate name to Certificate, replaced as a whole by reload()."""
+
+    select_valid = """
+    SELECT c.CertName, c.CertificateData FROM dbo.Certificates c
+    WHERE c.Valid = 1
+    AND c.ID = (SELECT MAX(m.ID) FROM dbo.Certificates m WHERE m.Valid = 1 AND m.CertName = c.CertName)
+    """
+
+    def __init__(self, max_workers: int = 8):
+        self.max_workers = max_workers
+        self._certs = {}
+        # name -> reason of the certificates that are configured but not in use.
+        self.retired = {}
+        self.generation = 0
+        self.loaded = None
+
+    def __getitem__(self, name) -> Certificate:
+        return self._certs[name]
+
+    def __iter__(self):
+        return iter(self._certs)
+
+    def __len__(self) -> int:
+        return len(self._certs)
+
+    def snapshot(self) -> dict:
+        """The current certificates; the dict is never changed afterwards."""
+        return self._certs
+
+    def reload(self, configured: dict) -> bool:
+        """Loads the configured certificates, reusing those whose database row did not change.
+        Returns True if the registry changed. When dbo.Certificates cannot be read, the registry is kept."""
+        try:
+            rows = {name: data for name, data in fetch_sql_sync(self.select_valid) or []}
+        except Exception as e:
+            logger.error(f"Unable to read certificates from the database, keeping the current ones: {e}")
+            return False
+        current = self._certs
+        certs, retired, pending = {}, {}, []
+        for name, password in configured.items():
+            cert = current.get(name)
+            if cert is not None and cert.password == password and rows.get(name) == cert.pfx_encrypted:
+                certs[name] = cert
+            else:
+                pending.append((name, password))
+
+        if pending:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(pending))) as executor:
+                loaded = list(executor.map(lambda item: self._load(item[0], item[1], rows.get(item[0])), pending))
+            for (name, _), (cert, error) in zip(pending, loaded):
+                if cert is not None:
+                    certs[name] = cert
+                elif name in current and rows.get(name) is not None and not current[name].expired:
+                    # A broken renewal does not take the certificate that works out of service.
+                    logger.error(f"{error} Keeping the certificate loaded before.")
+                    certs[name] = current[name]
+                else:
+                    retired[name] = error
+
+        for name, cert in list(certs.items()):
+            if cert.expired:
+                retired[name] = f"Certificate {name} has expired on {cert.expiration}."
+                del certs[name]
+        for name, reason in retired.items():
+            if self.retired.get(name) != reason:
+                logger.error(f"Certificate {name} retired: {reason}")
+
+        self.retired = retired
+        self.loaded = datetime.now(timezone.utc)
+        if certs.keys() == current.keys() and all(certs[name] is current[name] for name in certs):
+            return False
+        self._certs = certs
+        self.generation += 1
+        logger.info(f"Certificate registry generation {self.generation}: {', '.join(certs) or 'no certificates'}.")
+        return True
+
+    @staticmethod
+    def _load(name: str, password: str, pfx_encrypted):
+        try:
+            return Certificate(name, password, pfx_encrypted), None
+        except CertificateError as e:
+            return None, str(e)
+        except Exception as e:
+            return None, f"Loading certificate {name} failed: {e}"
+
+    def stats(self) -> dict:
+        return {
+            "generation": self.generation,
+            "loaded": self.loaded.isoformat(timespec='seconds') if self.loaded else None,
+            "certificates": {name: {"subject": cert.subject, "expiration": cert.expiration.isoformat()}
+                             for name, cert in self._certs.items()},
+            "retired": dict(self.retired),
+        }
+
+
+CERTS = CertificateRegistry()
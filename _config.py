@@ -2,6 +2,7 @@
 
 import os
 import sys
+import socket
 import configparser
 from _logger import logger
 
@@ -27,12 +28,90 @@ try:
     DB_NAME = config['DATABASE']['DB_NAME']
     DB_USER = config['DATABASE']['DB_USER']
     DB_PASSWORD = config['DATABASE']['DB_PASSWORD']
+    DB_POOL_SIZE = config.getint('DATABASE', 'POOL_SIZE', fallback=10)
+    DB_POOL_MAX_IDLE = config.getfloat('DATABASE', 'POOL_MAX_IDLE', fallback=300)
+    DB_POOL_TIMEOUT = config.getfloat('DATABASE', 'POOL_TIMEOUT', fallback=30)
     ENCRYPTION_KEY = config['CERT']['ENCRYPTION_KEY']
     CERTIFICATES = config['CERT']['CERTIFICATES']
+    CERT_RELOAD_INTERVAL = config.getfloat('CERT', 'RELOAD_INTERVAL', fallback=300)
+    # Token of the /admin endpoints; they are disabled while it is empty.
+    ADMIN_TOKEN = config.get('ADMIN', 'TOKEN', fallback='').strip()
     KTA_API_URL = config['KTA']['URL']
+    KTA_PUSH = config.getboolean('KTA', 'PUSH', fallback=False)
+    KTA_SENDERS = config.get('KTA', 'SENDERS', fallback='')
+    KTA_CONCURRENCY = config.getint('KTA', 'CONCURRENCY', fallback=4)
+    KTA_RETRIES = config.getint('KTA', 'RETRIES', fallback=5)
+    KTA_BACKOFF = config.getfloat('KTA', 'BACKOFF', fallback=1)
+    KTA_BACKOFF_MAX = config.getfloat('KTA', 'BACKOFF_MAX', fallback=60)
+    KTA_TIMEOUT = config.getfloat('KTA', 'TIMEOUT', fallback=30)
+    UPLOAD_MAX_SIZE = config.getint('UPLOAD', 'MAX_SIZE', fallback=20_971_520)
+    UPLOAD_MEMORY_THRESHOLD = config.getint('UPLOAD', 'MEMORY_THRESHOLD', fallback=1_048_576)
+    VALIDATION_MODE = config.get('VALIDATION', 'MODE', fallback='fast').strip().lower()
+    SIGNING_WORKERS = config.getint('SIGNING', 'WORKERS', fallback=os.cpu_count() or 1)
+    VERIFY_WORKERS = config.getint('VERIFY', 'WORKERS', fallback=SIGNING_WORKERS)
+    VERIFY_TRUST_DIR = config.get('VERIFY', 'TRUST_DIR', fallback='')
+    VERIFY_SYSTEM_TRUST = config.getboolean('VERIFY', 'SYSTEM_TRUST', fallback=True)
+    VERIFY_CACHE_SIZE = config.getint('VERIFY', 'CACHE_SIZE', fallback=10_000)
+    VERIFY_CACHE_TTL = config.getfloat('VERIFY', 'CACHE_TTL', fallback=3600)
+    OUTPUT_FSYNC = config.getboolean('OUTPUT', 'FSYNC', fallback=True)
+    BATCH_MAX_FILES = config.getint('BATCH', 'MAX_FILES', fallback=100)
+    BATCH_MAX_SIZE = config.getint('BATCH', 'MAX_SIZE', fallback=209_715_200)
+    QUEUE_WORKERS = config.getint('QUEUE', 'WORKERS', fallback=SIGNING_WORKERS)
+    QUEUE_MAX_DEPTH = config.getint('QUEUE', 'MAX_DEPTH', fallback=1000)
+    STATUS_CACHE_SIZE = config.getint('STATUS_CACHE', 'MAX_ENTRIES', fallback=100_000)
+    STATUS_CACHE_TTL = config.getfloat('STATUS_CACHE', 'TTL', fallback=300)
+    STATUS_CACHE_TERMINAL_TTL = config.getfloat('STATUS_CACHE', 'TERMINAL_TTL', fallback=3600)
+    STATUS_MAX_UUIDS = config.getint('STATUS', 'MAX_UUIDS', fallback=1000)
+    NOTIFY_MAX_WAIT = config.getfloat('NOTIFY', 'MAX_WAIT', fallback=60)
+    NOTIFY_HEARTBEAT = config.getfloat('NOTIFY', 'HEARTBEAT', fallback=15)
+    STATUS_WRITER_BATCH_SIZE = config.getint('STATUS_WRITER', 'BATCH_SIZE', fallback=500)
+    STATUS_WRITER_INTERVAL = config.getfloat('STATUS_WRITER', 'INTERVAL', fallback=0.05)
+    STATUS_WRITER_RETRY_MAX = config.getfloat('STATUS_WRITER', 'RETRY_MAX', fallback=30)
+    STATUS_WRITER_FSYNC = config.getboolean('STATUS_WRITER', 'FSYNC', fallback=True)
+    JANITOR_RETENTION = config.getfloat('JANITOR', 'RETENTION', fallback=300)
+    JANITOR_DISK_BUDGET = config.getint('JANITOR', 'DISK_BUDGET', fallback=0)
+    JANITOR_SWEEP_INTERVAL = config.getfloat('JANITOR', 'SWEEP_INTERVAL', fallback=0)
+    DOWNLOAD_GRACE = config.getfloat('DOWNLOAD', 'GRACE', fallback=30)
+    DOWNLOAD_CHUNK_SIZE = config.getint('DOWNLOAD', 'CHUNK_SIZE', fallback=262_144)
+    DOWNLOAD_BATCH_MAX_FILES = config.getint('DOWNLOAD', 'BATCH_MAX_FILES', fallback=500)
+    IDEMPOTENCY_TTL = config.getfloat('IDEMPOTENCY', 'TTL', fallback=3600)
+    IDEMPOTENCY_MAX_ENTRIES = config.getint('IDEMPOTENCY', 'MAX_ENTRIES', fallback=100_000)
+    IDEMPOTENCY_AUTO = config.getboolean('IDEMPOTENCY', 'AUTO', fallback=False)
+    SCHEDULER_RATE = config.getfloat('SCHEDULER', 'RATE', fallback=0.0)
+    SCHEDULER_BURST = config.getfloat('SCHEDULER', 'BURST', fallback=20.0)
+    SCHEDULER_WEIGHT = config.getfloat('SCHEDULER', 'WEIGHT', fallback=1.0)
+    SCHEDULER_SENDER_MAX_DEPTH = config.getint('SCHEDULER', 'SENDER_MAX_DEPTH', fallback=0)
+    # Per-sender overrides of the [SCHEDULER] limits, in sections named [SENDER:<sender>].
+    SENDER_LIMITS = {
+        section[len('SENDER:'):].strip(): (
+            config.getfloat(section, 'RATE', fallback=SCHEDULER_RATE),
+            config.getfloat(section, 'BURST', fallback=SCHEDULER_BURST),
+            config.getfloat(section, 'WEIGHT', fallback=SCHEDULER_WEIGHT),
+            config.getint(section, 'MAX_DEPTH', fallback=SCHEDULER_SENDER_MAX_DEPTH),
+        )
+        for section in config.sections() if section.upper().startswith('SENDER:')
+    }
+    STORAGE_BACKEND = config.get('STORAGE', 'BACKEND', fallback='local').strip().lower()
+    STORAGE_PATH = config.get('STORAGE', 'PATH', fallback='')
+    STORAGE_SHARD_DEPTH = config.getint('STORAGE', 'SHARD_DEPTH', fallback=2)
+    # Identifies this node in Documents.Node, so that with shared storage every node only recovers its own jobs.
+    NODE_ID = config.get('NODE', 'ID', fallback=socket.gethostname()).strip()[:255]
+    if STORAGE_BACKEND not in ('local', 'shared'):
+        raise ValueError(f"Unknown storage backend '{STORAGE_BACKEND}', expected 'local' or 'shared'.")
 except (KeyError, ValueError) as e:
     logger.critical(f"Error setting configuration variables: {e}")
     sys.exit(1)
 
 
 logger.info('Settings have been loaded.')
+
+
+def read_certificates() -> str:
+    """Reads [CERT] CERTIFICATES from the configuration file again, so certificates can be added without a restart."""
+    current = configparser.ConfigParser()
+    try:
+        current.read(CONFIG_FILE)
+        return current.get('CERT', 'CERTIFICATES', fallback=CERTIFICATES)
+    except configparser.Error as e:
+        logger.error(f"Error reading configuration file: {e}")
+        return CERTIFICATES
@@ -1,10 +1,21 @@
 # _database.py - database module for IM Sign (FastAPI) application.
 
+import os
+import json
+import time
 import pyodbc
 import asyncio
+import threading
+from collections import deque
+from contextlib import contextmanager, suppress
+from dataclasses import dataclass, asdict
+from typing import Optional
 from _logger import logger
+from _metrics import DB_QUERY_SECONDS
 from functools import partial
-from _config import DB_SERVER_URL, DB_NAME, DB_USER, DB_PASSWORD
+from _config import DB_SERVER_URL, DB_NAME, DB_USER, DB_PASSWORD, DB_POOL_SIZE, DB_POOL_MAX_IDLE, DB_POOL_TIMEOUT
+from _config import (DIR_TEMP, STATUS_WRITER_BATCH_SIZE, STATUS_WRITER_INTERVAL, STATUS_WRITER_RETRY_MAX,
+                     STATUS_WRITER_FSYNC)
 
 
 CONNECTION_STRING = 'DRIVER={ODBC Driver 17 for SQL Server};' \
@@ -13,20 +24,171 @@ CONNECTION_STRING = 'DRIVER={ODBC Driver 17 for SQL Server};' \
                     f'UID={DB_USER};' \
                     f'PWD={DB_PASSWORD}'
 
+# Connections are pooled by ConnectionPool below, the ODBC driver manager pool would only duplicate it.
+pyodbc.pooling = False
+
+
+# -------------- Connection pool --------------
+class ConnectionPool:
+    """Bounded, thread-safe pool of autocommit connections.
+
+    Connections idle for longer than max_idle seconds are evicted, connections idle for longer
+    than ping_after seconds are health-checked with a trivial query before they are handed out.
+    Checkout blocks, so it must be called from a worker thread, never from the event loop.
+    """
+
+    def __init__(self, connect, size: int, max_idle: float, timeout: float, ping_after: float = 30):
+        self._connect = connect
+        self.size = max(1, size)
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self._idle = deque()
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._created = 0
+        self._evicted = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def acquire(self):
+        started = time.monotonic()
+        deadline = started + self.timeout
+        stale = []
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError("Connection pool is closed.")
+                stale.extend(self._evict_idle())
+                if self._idle:
+                    connection, last_used = self._idle.pop()
+                    create = False
+                    break
+                if self._in_use < self.size:
+                    connection, last_used = None, None
+                    create = True
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"No database connection available within {self.timeout} s.")
+                self._cond.wait(remaining)
+            self._in_use += 1
+            self._checkouts += 1
+            waited = time.monotonic() - started
+            if waited > 0.001:
+                self._waits += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+
+        for stale_connection in stale:
+            self._discard(stale_connection)
+
+        try:
+            if not create and time.monotonic() - last_used > self.ping_after and not self._is_alive(connection):
+                self._discard(connection)
+                create = True
+            if create:
+                connection = self._connect()
+                with self._cond:
+                    self._created += 1
+        except BaseException:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return connection
+
+    def release(self, connection, discard: bool = False) -> None:
+        with self._cond:
+            self._in_use -= 1
+            if not discard and not self._closed:
+                self._idle.append((connection, time.monotonic()))
+                connection = None
+            self._cond.notify()
+        if connection is not None:
+            self._discard(connection)
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+        try:
+            yield connection
+        except pyodbc.IntegrityError:
+            # A rejected statement leaves the connection usable.
+            self.release(connection)
+            raise
+        except pyodbc.Error:
+            # The connection may be broken, do not hand it out again.
+            self.release(connection, discard=True)
+            raise
+        except BaseException:
+            self.release(connection)
+            raise
+        else:
+            self.release(connection)
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            idle = [connection for connection, _ in self._idle]
+            self._idle.clear()
+            self._cond.notify_all()
+        for connection in idle:
+            self._discard(connection)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "size": self.size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "created": self._created,
+                "evicted": self._evicted,
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "wait_avg_ms": round(self._wait_total / self._checkouts * 1000, 3) if self._checkouts else 0.0,
+                "wait_max_ms": round(self._wait_max * 1000, 3),
+            }
+
+    def _evict_idle(self) -> list:
+        # Called with the lock held. The oldest connections sit at the left end of the deque,
+        # the caller closes the returned ones after releasing the lock.
+        now = time.monotonic()
+        stale = []
+        while self._idle and now - self._idle[0][1] > self.max_idle:
+            stale.append(self._idle.popleft()[0])
+            self._evicted += 1
+        return stale
+
+    @staticmethod
+    def _is_alive(connection) -> bool:
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                cursor.fetchall()
+            return True
+        except pyodbc.Error as e:
+            logger.warning(f"Dropping dead database connection: {e}")
+            return False
+
+    @staticmethod
+    def _discard(connection) -> None:
+        try:
+            connection.close()
+        except pyodbc.Error:
+            pass
+
+
+pool = ConnectionPool(partial(pyodbc.connect, CONNECTION_STRING, autocommit=True),
+                      DB_POOL_SIZE, DB_POOL_MAX_IDLE, DB_POOL_TIMEOUT)
+
 
 # -------------- Async query mechanism --------------
 async def fetch_sql(sql, params=None):
-    connection = pyodbc.connect(CONNECTION_STRING, autocommit=True)
-    results = []
-    try:
-        with connection.cursor() as cursor:
-            if params:
-                await run_in_executor(cursor.execute, sql, params)
-            else:
-                await run_in_executor(cursor.execute, sql)
-            results = await run_in_executor(cursor.fetchall)
-    finally:
-        connection.close()
+    results = await run_in_executor(_fetch_all, sql, params)
 
     if not results:
         return None
@@ -34,32 +196,345 @@ async def fetch_sql(sql, params=None):
     return results[0]
 
 
+async def fetch_all_sql(sql, params=None):
+    return await run_in_executor(_fetch_all, sql, params) or []
+
+
 async def run_in_executor(func, *args):
     loop = asyncio.get_running_loop()
     return await loop.run_in_executor(None, partial(func, *args))
 
 
 async def execute_query(sql, params=None):
-    connection = pyodbc.connect(CONNECTION_STRING, autocommit=True)
-    try:
+    await run_in_executor(_execute, sql, params)
+
+
+async def execute_transaction(statements):
+    await run_in_executor(_execute_transaction, statements)
+
+
+def _execute_transaction(statements):
+    """Executes (sql, params) pairs on one connection and commits them together."""
+    with DB_QUERY_SECONDS.time(operation='transaction'), pool.connection() as connection:
+        connection.autocommit = False
+        try:
+            with connection.cursor() as cursor:
+                for sql, params in statements:
+                    cursor.execute(sql, params) if params else cursor.execute(sql)
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+        finally:
+            connection.autocommit = True
+
+
+def multi_row(sql, rows, suffix: str = ''):
+    """Expands a 'VALUES ' template into multi-row statements, suffix is appended after the VALUES list.
+
+    Yields (sql, params) pairs that respect SQL Server limits of 1000 rows per VALUES list
+    and 2100 parameters per statement.
+    """
+    if not rows:
+        return
+    width = len(rows[0])
+    chunk = max(1, min(1000, 2000 // width))
+    placeholder = '(' + ', '.join('?' * width) + ')'
+    for start in range(0, len(rows), chunk):
+        part = rows[start:start + chunk]
+        yield sql + ', '.join([placeholder] * len(part)) + suffix, [value for row in part for value in row]
+
+
+def _fetch_all(sql, params=None):
+    with DB_QUERY_SECONDS.time(operation='fetch'), pool.connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params) if params else cursor.execute(sql)
+            return cursor.fetchall() if cursor.description else None
+
+
+def _execute(sql, params=None):
+    with DB_QUERY_SECONDS.time(operation='execute'), pool.connection() as connection:
         with connection.cursor() as cursor:
-            if params:
-                await run_in_executor(cursor.execute, sql, params)
+            cursor.execute(sql, params) if params else cursor.execute(sql)
+
+
+# -------------- Write-behind status writer --------------
+@dataclass
+class StatusEvent:
+    """One document status transition. An event with created set also registers the document itself."""
+    file_uuid: str
+    status: str
+    message: str
+    recorded: str
+    created: bool = False
+    file_size: Optional[int] = None
+    sender: Optional[str] = None
+    sign_timestamp: Optional[str] = None
+    node: Optional[str] = None
+
+
+def status_statements(events: list) -> list:
+    """Builds the (sql, params) pairs that store events: new Documents rows, the DocumentsHistory rows
+    in recording order and one CurrentStatus update per document.
+    """
+    documents = [(e.file_uuid, e.file_size, e.sender, e.recorded, e.node) for e in events if e.created]
+    history = [(number, e.file_uuid, e.status, e.message, e.recorded) for number, e in enumerate(events)]
+    current = {}
+    for e in events:
+        previous = current.get(e.file_uuid)
+        current[e.file_uuid] = (e.file_uuid, e.status, e.message, e.sign_timestamp or (previous and previous[3]))
+
+    statements = list(multi_row(insert_Documents_events, documents, insert_Documents_events_end))
+    statements += multi_row(insert_DocumentsHistory_events, history, insert_DocumentsHistory_events_end)
+    statements += multi_row(update_Documents_events, list(current.values()), update_Documents_events_end)
+    return statements
+
+
+class StatusWriter:
+    """Write-behind writer of document status events.
+
+    record() appends the event to a journal segment in the temporary directory and returns; sync() waits until
+    the journal is on disk, with one fsync in a worker thread for all the events recorded meanwhile. A background
+    task stores all pending events in one transaction once batch_size events are waiting or interval seconds
+    after the first one, so a transition and the document row it depends on always commit together.
+    Journal segments are removed after the commit. While SQL Server is unavailable the flush is retried with
+    backoff, and segments left over by a crash are replayed on the next start; replaying is idempotent.
+    With fsync disabled, sync() returns at once and only a process crash, not an OS crash, keeps the events.
+    When a batch fails while the database is reachable, it is stored per document and the events of documents
+    that still fail are set aside in a dead-letter file.
+    """
+
+    dead_letter_file = 'status-dead-letter.jsonl'
+
+    def __init__(self, directory: str, batch_size: int, interval: float, retry_max: float, fsync: bool = True):
+        self.directory = directory
+        self.batch_size = batch_size
+        self.interval = interval
+        self.retry_max = retry_max
+        self.fsync = fsync
+        self._pending = []
+        self._latest = {}
+        self._segments = []
+        self._journal = None
+        # Journal files written since the last fsync, and the number of events recorded and synced.
+        self._unsynced = set()
+        self._written = 0
+        self._synced = 0
+        self._syncing = None
+        self._lock = None
+        self._wakeup = None
+        self._closing = None
+        self._task = None
+        self.flushes = 0
+        self.flushed_events = 0
+        self.failures = 0
+        self.dead_lettered = 0
+
+    def record(self, event: StatusEvent) -> None:
+        if self._journal is None:
+            path = os.path.join(self.directory, f"status-{time.time_ns():020d}.journal")
+            self._journal = open(path, 'a', encoding='utf-8')
+        self._journal.write(json.dumps(asdict(event)) + '\n')
+        self._journal.flush()
+        self._unsynced.add(self._journal.name)
+        self._written += 1
+        self._pending.append(event)
+        self._latest[event.file_uuid.lower()] = (event.status, event.message)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def sync(self) -> None:
+        """Waits until the events recorded so far are on disk. Raises OSError when the journal cannot be synced."""
+        target = self._written
+        while self.fsync and self._synced < target:
+            if self._syncing is None:
+                self._syncing = asyncio.ensure_future(self._sync())
+            await asyncio.shield(self._syncing)
+
+    async def _sync(self) -> None:
+        written, paths, self._unsynced = self._written, self._unsynced, set()
+        try:
+            await asyncio.to_thread(_sync_journal, paths)
+        except BaseException:
+            self._unsynced |= paths
+            raise
+        finally:
+            self._syncing = None
+        self._synced = written
+
+    def latest(self, file_uuid):
+        """Returns (status, message) of the last event of the document that is not stored yet, or None."""
+        return self._latest.get(str(file_uuid).lower())
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def start(self) -> None:
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._closing = asyncio.Event()
+        self._replay()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stops the background task and makes a last flush. Events that cannot be stored stay in the journal."""
+        if self._task is not None:
+            self._closing.set()
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        if not await self.flush():
+            logger.warning(f"{len(self._pending)} status event(s) remain in the journal until the next start.")
+        self._seal()
+
+    async def flush(self) -> bool:
+        async with self._lock:
+            if not self._pending:
+                return True
+            events, self._pending = self._pending, []
+            self._seal()
+            segments = list(self._segments)
+            try:
+                await run_in_executor(_execute_transaction, status_statements(events))
+            except Exception as e:
+                logger.warning(f"Storing {len(events)} status event(s) in one transaction failed, "
+                               f"storing them per document: {e}")
+                failed = await run_in_executor(self._store_per_document, events)
+                if failed:
+                    self._pending = [event for group, _ in failed for event in group] + self._pending
+                    self.failures += 1
+                    await run_in_executor(_sync_files, segments)
+                    logger.error(f"Unable to store the status events of {len(failed)} document(s), "
+                                 f"they are kept in the journal: {failed[0][1]}")
+                    return False
+
+            self._segments = self._segments[len(segments):]
+            for path in segments:
+                with suppress(OSError):
+                    os.remove(path)
+            waiting = {event.file_uuid.lower() for event in self._pending}
+            for event in events:
+                key = event.file_uuid.lower()
+                if key not in waiting:
+                    self._latest.pop(key, None)
+            self.flushes += 1
+            self.flushed_events += len(events)
+            return True
+
+    def _store_per_document(self, events: list) -> list:
+        """Stores the events of every document in its own transaction after a batch failed.
+
+        Events that still fail while the database is reachable can never be stored (e.g. a value longer
+        than its column); they are moved to the dead-letter file so they do not block the other documents.
+        Returns the (events, error) pairs of the documents left for a retry because the database is down.
+        """
+        try:
+            _fetch_all("SELECT 1")
+        except Exception as e:
+            return [(events, e)]
+        documents = {}
+        for event in events:
+            documents.setdefault(event.file_uuid.lower(), []).append(event)
+        failed = []
+        for group in documents.values():
+            try:
+                _execute_transaction(status_statements(group))
+            except Exception as e:
+                failed.append((group, e))
+        if not failed:
+            return []
+
+        with open(os.path.join(self.directory, self.dead_letter_file), 'a', encoding='utf-8') as file:
+            for group, error in failed:
+                for event in group:
+                    file.write(json.dumps(dict(asdict(event), error=str(error))) + '\n')
+                logger.error(f"Status events of document {group[0].file_uuid} cannot be stored and were moved "
+                             f"to {self.dead_letter_file}: {error}")
+            file.flush()
+            os.fsync(file.fileno())
+        self.dead_lettered += sum(len(group) for group, _ in failed)
+        return []
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "journal_segments": len(self._segments) + (self._journal is not None),
+            "flushes": self.flushes,
+            "flushed_events": self.flushed_events,
+            "events_per_flush": round(self.flushed_events / self.flushes, 2) if self.flushes else 0.0,
+            "failures": self.failures,
+            "dead_lettered": self.dead_lettered,
+        }
+
+    async def _run(self) -> None:
+        backoff = 0
+        while not self._closing.is_set():
+            await self._wakeup.wait()
+            delay = backoff or (self.interval if len(self._pending) < self.batch_size else 0)
+            if delay:
+                # Gathers more events, or waits out the backoff, unless the application is shutting down.
+                with suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._closing.wait(), delay)
+            if self._closing.is_set():
+                break
+            self._wakeup.clear()
+            if await self.flush():
+                backoff = 0
             else:
-                await run_in_executor(cursor.execute, sql)
-    finally:
-        connection.close()
+                backoff = min(self.retry_max, max(backoff * 2, self.interval, 0.5))
+                self._wakeup.set()
+
+    def _seal(self) -> None:
+        if self._journal is not None:
+            self._segments.append(self._journal.name)
+            self._journal.close()
+            self._journal = None
+
+    def _replay(self) -> None:
+        names = sorted(name for name in os.listdir(self.directory)
+                       if name.startswith('status-') and name.endswith('.journal'))
+        for name in names:
+            path = os.path.join(self.directory, name)
+            with open(path, encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        event = StatusEvent(**json.loads(line))
+                    except (ValueError, TypeError):
+                        # A line cut short by a crash while it was being written.
+                        logger.warning(f"Skipping a damaged line in status journal {name}.")
+                        continue
+                    self._pending.append(event)
+                    self._latest[event.file_uuid.lower()] = (event.status, event.message)
+            self._segments.append(path)
+        if names:
+            logger.info(f"Replaying {len(self._pending)} status event(s) from {len(names)} journal segment(s).")
+
+
+def _sync_files(paths: list) -> None:
+    for path in paths:
+        with suppress(OSError), open(path, 'rb') as file:
+            os.fsync(file.fileno())
+
+
+def _sync_journal(paths: set) -> None:
+    for path in paths:
+        try:
+            with open(path, 'rb') as file:
+                os.fsync(file.fileno())
+        except FileNotFoundError:
+            # Stored and removed in the meantime.
+            pass
+
+
+status_writer = StatusWriter(DIR_TEMP, STATUS_WRITER_BATCH_SIZE, STATUS_WRITER_INTERVAL, STATUS_WRITER_RETRY_MAX,
+                             STATUS_WRITER_FSYNC)
 
 
 # -------------- Sync queries --------------
 def execute_sql_sync(sql, params=None):
     try:
-        with pyodbc.connect(CONNECTION_STRING, autocommit=True) as connection:
-            with connection.cursor() as cursor:
-                if params:
-                    cursor.execute(sql, params)
-                else:
-                    cursor.execute(sql)
+        _execute(sql, params)
     except pyodbc.Error as e:
         logger.error(f"Error executing SQL command: {e}")
         raise
@@ -67,10 +542,7 @@ def execute_sql_sync(sql, params=None):
 
 def fetch_sql_sync(sql, params=None):
     try:
-        with pyodbc.connect(CONNECTION_STRING, autocommit=True) as connection:
-            with connection.cursor() as cursor:
-                cursor.execute(sql, params) if params else cursor.execute(sql)
-                return cursor.fetchall() if cursor.description else None
+        return _fetch_all(sql, params)
     except pyodbc.Error as e:
         logger.error(f"Error executing SQL command: {e}")
         raise
@@ -91,8 +563,75 @@ INSERT INTO DocumentsHistory (UUID, Status, Message)
 VALUES (?, ?, ?)
 """
 
+
+# Templates of the status writer, expanded by multi_row. Rows that are already stored are skipped,
+# so replaying a journal segment whose transaction did commit changes nothing.
+insert_Documents_events = """
+INSERT INTO Documents (UUID, FileSize, Sender, RecordTime, Node)
+SELECT v.UUID, CAST(v.FileSize AS INT), v.Sender, CAST(v.RecordTime AS DATETIME), v.Node
+FROM (VALUES """
+insert_Documents_events_end = """) AS v (UUID, FileSize, Sender, RecordTime, Node)
+WHERE NOT EXISTS (SELECT 1 FROM Documents d WHERE d.UUID = v.UUID)
+"""
+
+insert_DocumentsHistory_events = """
+INSERT INTO DocumentsHistory (UUID, Status, Message, RecordTime)
+SELECT v.UUID, v.Status, v.Message, CAST(v.RecordTime AS DATETIME) FROM (VALUES """
+insert_DocumentsHistory_events_end = """) AS v (Seq, UUID, Status, Message, RecordTime)
+WHERE NOT EXISTS (SELECT 1 FROM DocumentsHistory h WHERE h.UUID = v.UUID AND h.Status = v.Status
+                  AND h.RecordTime = CAST(v.RecordTime AS DATETIME))
+ORDER BY v.Seq
+"""
+
+update_Documents_events = """
+UPDATE Documents SET CurrentStatus = v.Status, CurrentMessage = v.Message,
+    SignTimestamp = COALESCE(CAST(v.SignTimestamp AS DATETIME2), Documents.SignTimestamp)
+FROM (VALUES """
+update_Documents_events_end = """) AS v (UUID, Status, Message, SignTimestamp)
+WHERE Documents.UUID = v.UUID
+"""
+
 check_file_status = """
-SELECT TOP 1 Status, Message FROM DocumentsHistory WHERE UUID = ? ORDER BY ID DESC
+SELECT CurrentStatus, CurrentMessage FROM Documents WHERE UUID = ?
+"""
+
+# Template of status_cache.current_statuses, expanded by multi_row into lists of at most 1000 UUIDs.
+select_Documents_status = """
+SELECT d.UUID, d.CurrentStatus, d.CurrentMessage FROM Documents d JOIN (VALUES """
+select_Documents_status_end = """) AS v (UUID) ON d.UUID = v.UUID
+"""
+
+# Claims of idempotency.claim: the primary key of IdempotencyKeys rejects a second claim of a key.
+insert_IdempotencyKey = """
+INSERT INTO IdempotencyKeys (IdempotencyKey, UUID, RecordTime) VALUES (?, ?, CAST(? AS DATETIME))
+"""
+
+select_IdempotencyKey = """
+SELECT UUID, CASE WHEN RecordTime >= CAST(? AS DATETIME) THEN 1 ELSE 0 END,
+    CASE WHEN RecordTime >= CAST(? AS DATETIME) THEN 1 ELSE 0 END
+FROM IdempotencyKeys WHERE IdempotencyKey = ?
+"""
+
+# Takes a key over from the given holder; a no-op when another request took it over first.
+update_IdempotencyKey = """
+UPDATE IdempotencyKeys SET UUID = ?, RecordTime = CAST(? AS DATETIME) WHERE IdempotencyKey = ? AND UUID = ?
+"""
+
+delete_IdempotencyKey = """
+DELETE FROM IdempotencyKeys WHERE IdempotencyKey = ? AND UUID = ?
+"""
+
+delete_expired_IdempotencyKeys = """
+DELETE FROM IdempotencyKeys WHERE RecordTime < CAST(? AS DATETIME)
+"""
+
+# Documents of the given node; rows registered before Documents.Node existed belong to every node.
+select_undelivered_Documents = """
+SELECT UUID, Sender FROM Documents WHERE CurrentStatus = 'Saved' AND (Node = ? OR Node IS NULL)
+"""
+
+select_unfinished_Documents = """
+SELECT UUID, CurrentStatus FROM Documents WHERE CurrentStatus IN ('Received', 'Signed') AND (Node = ? OR Node IS NULL)
 """
 
 create_Documents = """
@@ -104,11 +643,52 @@ BEGIN
         SignTimestamp DATETIME2 NULL,
         FileSize INT NULL,
         RecordTime DATETIME NOT NULL DEFAULT GETDATE(),
-        Sender NVARCHAR(255) NULL
+        Sender NVARCHAR(255) NULL,
+        CurrentStatus NVARCHAR(50) NULL,
+        CurrentMessage NVARCHAR(MAX) NULL,
+        Node NVARCHAR(255) NULL
     );
 END 
 """
 
+# Deployments created before CurrentStatus existed: add the columns and backfill them from the
+# latest history row in one transaction. Skipped once the columns are there.
+migrate_Documents_CurrentStatus = """
+IF COL_LENGTH('Documents', 'CurrentStatus') IS NULL
+AND EXISTS (SELECT * FROM sys.tables WHERE name = 'DocumentsHistory' AND type = 'U')
+BEGIN
+    SET XACT_ABORT ON;
+    BEGIN TRANSACTION;
+    ALTER TABLE Documents ADD CurrentStatus NVARCHAR(50) NULL, CurrentMessage NVARCHAR(MAX) NULL;
+    EXEC('
+        UPDATE d SET CurrentStatus = h.Status, CurrentMessage = h.Message
+        FROM Documents d
+        CROSS APPLY (
+            SELECT TOP 1 Status, Message FROM DocumentsHistory WHERE UUID = d.UUID ORDER BY ID DESC
+        ) h
+    ');
+    COMMIT TRANSACTION;
+END
+"""
+
+migrate_Documents_Node = """
+IF COL_LENGTH('Documents', 'Node') IS NULL
+BEGIN
+    ALTER TABLE Documents ADD Node NVARCHAR(255) NULL;
+END
+"""
+
+create_IdempotencyKeys = """
+IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = 'IdempotencyKeys' AND type = 'U')
+BEGIN
+    CREATE TABLE IdempotencyKeys (
+        IdempotencyKey CHAR(64) NOT NULL PRIMARY KEY,
+        UUID uniqueidentifier NOT NULL,
+        RecordTime DATETIME NOT NULL
+    );
+END
+"""
+
 create_DocumentsHistory = """
 IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = 'DocumentsHistory' AND type = 'U')
 AND EXISTS (SELECT * FROM sys.tables WHERE name = 'Documents' AND type = 'U')
@@ -124,6 +704,16 @@ BEGIN
 END
 """
 
+create_DocumentsHistory_index = """
+IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = 'IX_DocumentsHistory_UUID_ID'
+               AND object_id = OBJECT_ID('DocumentsHistory'))
+AND EXISTS (SELECT * FROM sys.tables WHERE name = 'DocumentsHistory' AND type = 'U')
+BEGIN
+    CREATE NONCLUSTERED INDEX IX_DocumentsHistory_UUID_ID ON DocumentsHistory (UUID, ID DESC)
+    INCLUDE (Status, Message);
+END
+"""
+
 create_Certificates = """
 IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = 'Certificates' AND type = 'U')
 BEGIN
@@ -0,0 +1,268 @@
+# _engine.py - process pool signing engine for IM Sign (FastAPI) application.
+
+import io
+import time
+import warnings
+import asyncio
+from datetime import datetime, timezone
+from collections import OrderedDict
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor
+import certifi
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.serialization import pkcs12
+from cryptography.x509.verification import ExtensionPolicy, PolicyBuilder, Store
+from endesive import pdf, verifier
+from _logger import logger
+from _payload import Payload
+
+
+# Key material loaded once per worker process by _init_worker.
+_WORKER_KEYS: dict = {}
+# Trust store and chain results of a verification worker, set up by _init_verifier.
+_TRUST: dict = {}
+
+
+# -------------- Worker process side --------------
+def _init_worker(key_material: dict) -> None:
+    for name, (pfx_decrypted, password) in key_material.items():
+        private_key, certificate, _ = pkcs12.load_key_and_certificates(
+            pfx_decrypted, password.encode(), default_backend()
+        )
+        _WORKER_KEYS[name] = (private_key, certificate)
+
+
+def _sign(source, dct: dict, cert_name: str) -> bytes:
+    # Spilled uploads are passed by path, so large documents are never pickled to the worker.
+    if isinstance(source, str):
+        with open(source, 'rb') as file:
+            source = file.read()
+    private_key, certificate = _WORKER_KEYS[cert_name]
+    return pdf.cms.sign(source, dct, private_key, certificate, [], "sha256")
+
+
+class _ChainCache:
+    """LRU of chain verification results keyed by the fingerprints of the signer and its intermediates."""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def get(self, key: tuple):
+        """Returns (found, error); error is None for a trusted chain."""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return False, None
+        self._entries.move_to_end(key)
+        return True, entry[1]
+
+    def put(self, key: tuple, error) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl, error)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+def _load_certificate(data: bytes) -> x509.Certificate:
+    if data.lstrip().startswith(b'-----BEGIN'):
+        return x509.load_pem_x509_certificate(data)
+    return x509.load_der_x509_certificate(data)
+
+
+def _init_verifier(anchors: list, intermediates: list, system_trust: bool, cache_size: int, cache_ttl: float) -> None:
+    certificates = [_load_certificate(data) for data in anchors]
+    if system_trust:
+        # A few roots of the bundle have non-positive serial numbers, which cryptography warns about.
+        with open(certifi.where(), 'rb') as bundle, warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            certificates += x509.load_pem_x509_certificates(bundle.read())
+    _TRUST["store"] = Store(certificates)
+    _TRUST["intermediates"] = [_load_certificate(data) for data in intermediates]
+    _TRUST["chains"] = _ChainCache(cache_size, cache_ttl)
+
+
+class _ChainVerifier:
+    """Takes the place of the policy verifier of endesive's VerifyData.
+
+    The trust store is parsed once per worker instead of once per signature, and the result of a chain
+    is cached, so documents signed with the same certificates are not verified against the store again.
+    Issuers are checked with the WebPKI CA rules, the signer only for validity: the TLS client rules of
+    build_client_verifier (subjectAltName, clientAuth EKU, authority key identifier) do not apply to
+    document signing certificates.
+    """
+
+    def __init__(self):
+        self.signer = None
+        self.error = None
+
+    def verify(self, leaf: x509.Certificate, intermediates: list) -> None:
+        self.signer = leaf
+        key = tuple(certificate.fingerprint(hashes.SHA256()) for certificate in [leaf, *intermediates])
+        found, self.error = _TRUST["chains"].get(key)
+        if not found:
+            try:
+                PolicyBuilder().store(_TRUST["store"]).time(datetime.now(timezone.utc).replace(tzinfo=None)) \
+                    .max_chain_depth(4) \
+                    .extension_policies(ca_policy=ExtensionPolicy.webpki_defaults_ca(),
+                                        ee_policy=ExtensionPolicy.permit_all()) \
+                    .build_client_verifier().verify(leaf, [*intermediates, *_TRUST["intermediates"]])
+            except Exception as e:
+                self.error = str(e) or type(e).__name__
+            _TRUST["chains"].put(key, self.error)
+        if self.error:
+            raise ValueError(self.error)
+
+
+class _VerifyData(verifier.VerifyData):
+    def __init__(self):
+        # The base class would parse the whole trust store for every signature.
+        self.verifier = _ChainVerifier()
+
+
+def _verify_signature(data: bytes, byte_range: list) -> dict:
+    start, length, offset, rest = byte_range
+    contents = bytes.fromhex(data[start + length + 1:offset - 1].decode('ascii'))
+    signed = data[start:start + length] + data[offset:offset + rest]
+    verification = _VerifyData()
+    # endesive prints failed chain verifications; the reason is returned as chain_error instead.
+    with redirect_stdout(io.StringIO()):
+        digest_valid, signature_valid, chain_valid = verification.verify(contents, signed)
+    signer = verification.verifier.signer
+    return {
+        "signer": signer.subject.rfc4514_string(),
+        "issuer": signer.issuer.rfc4514_string(),
+        "serial_number": format(signer.serial_number, 'x'),
+        "digest_valid": digest_valid,
+        "signature_valid": signature_valid,
+        "chain_valid": chain_valid,
+        "chain_error": verification.verifier.error,
+        "covers_document": offset + rest >= len(data.rstrip()),
+    }
+
+
+def _verify(source) -> list:
+    """Returns a result per signature of the document, in the order they appear in the file."""
+    if isinstance(source, str):
+        with open(source, 'rb') as file:
+            source = file.read()
+    results = []
+    position = source.find(b'/ByteRange')
+    while position != -1:
+        start = source.find(b'[', position)
+        stop = source.find(b']', start)
+        try:
+            byte_range = [int(value) for value in source[start + 1:stop].split()]
+            if len(byte_range) != 4:
+                raise ValueError(f"Malformed /ByteRange: {source[start + 1:stop][:50]!r}")
+            results.append(_verify_signature(source, byte_range))
+            position = source.find(b'/ByteRange', byte_range[2] + byte_range[3])
+        except Exception as e:
+            results.append({"error": f"{type(e).__name__}: {e}"})
+            position = source.find(b'/ByteRange', stop)
+    return results
+
+
+# -------------- Event loop side --------------
+class SigningEngine:
+    """Runs CPU-bound CMS signing in a pool of worker processes.
+
+    Every worker parses the PKCS#12 material of all known certificates once in its
+    initializer, so jobs only carry the document and the signature dictionary.
+    When the certificates change, reload() starts a new pool and the old one finishes its signatures.
+    """
+
+    def __init__(self):
+        self._executor = None
+        self.workers = 0
+        self.cert_names = frozenset()
+
+    @property
+    def running(self) -> bool:
+        return self._executor is not None
+
+    def _pool(self, certs: dict) -> ProcessPoolExecutor:
+        key_material = {name: (cert.pfx_decrypted, cert.password) for name, cert in certs.items()}
+        self.cert_names = frozenset(key_material)
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker, initargs=(key_material,))
+
+    def start(self, certs: dict, workers: int) -> None:
+        self.workers = max(1, workers)
+        self._executor = self._pool(certs)
+        logger.info(f"Signing engine started with {self.workers} worker(s) for {len(certs)} certificate(s).")
+
+    def reload(self, certs: dict) -> None:
+        if self._executor is None:
+            return
+        previous, self._executor = self._executor, self._pool(certs)
+        # Jobs already submitted to the old workers still complete.
+        previous.shutdown(wait=False)
+        logger.info(f"Signing engine reloaded with {len(certs)} certificate(s).")
+
+    async def sign(self, payload: Payload, dct: dict, cert_name: str) -> bytes:
+        if self._executor is None:
+            raise RuntimeError("Signing engine is not running.")
+        if cert_name not in self.cert_names:
+            raise RuntimeError(f"Certificate {cert_name} is no longer available.")
+        source = payload.data if payload.in_memory else payload.path
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, _sign, source, dct, cert_name)
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+            logger.info("Signing engine stopped.")
+
+
+class VerificationEngine:
+    """Runs PDF signature verification in its own pool of worker processes, so heavy verification traffic
+    neither blocks the event loop nor competes with signing for the signing workers."""
+
+    def __init__(self):
+        self._executor = None
+        self.workers = 0
+        self._settings = ()
+
+    @property
+    def running(self) -> bool:
+        return self._executor is not None
+
+    def _pool(self, anchors: list, intermediates: list) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=_init_verifier,
+                                   initargs=(anchors, intermediates, *self._settings))
+
+    def start(self, anchors: list, intermediates: list, workers: int, system_trust: bool, cache_size: int,
+              cache_ttl: float) -> None:
+        self.workers = max(1, workers)
+        self._settings = (system_trust, cache_size, cache_ttl)
+        self._executor = self._pool(anchors, intermediates)
+        logger.info(f"Verification engine started with {self.workers} worker(s), {len(anchors)} trust anchor(s) "
+                    f"and {len(intermediates)} intermediate(s).")
+
+    def reload(self, anchors: list, intermediates: list) -> None:
+        if self._executor is None:
+            return
+        previous, self._executor = self._executor, self._pool(anchors, intermediates)
+        previous.shutdown(wait=False)
+        logger.info(f"Verification engine reloaded with {len(anchors)} trust anchor(s) "
+                    f"and {len(intermediates)} intermediate(s).")
+
+    async def verify(self, payload: Payload) -> list:
+        if self._executor is None:
+            raise RuntimeError("Verification engine is not running.")
+        source = payload.data if payload.in_memory else payload.path
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, _verify, source)
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+            logger.info("Verification engine stopped.")
+
+
+engine = SigningEngine()
+verification_engine = VerificationEngine()
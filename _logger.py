@@ -1,7 +1,68 @@
 # _logger.py
 
+""" Logging for the application. The handlers configured in logging_config.json run on a background
+thread: the root logger only puts records on a queue, so formatting and console and file I/O never block
+the event loop. Messages use lazy %-style arguments; per-document fields (uuid, sender, cert_name, stage,
+duration_ms) are passed with extra= and written as fields by JsonFormatter.
+"""
+
+import os
 import json
+import atexit
 import logging.config
+from queue import SimpleQueue
+from itertools import count
+from logging.handlers import QueueHandler, QueueListener, BaseRotatingHandler, WatchedFileHandler
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object per line, including the per-document fields given with extra=."""
+
+    FIELDS = ('uuid', 'sender', 'cert_name', 'status', 'stage', 'duration_ms')
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "location": f"{record.filename}:{record.lineno}",
+            "message": record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SampleFilter(logging.Filter):
+    """Passes only one in every records logged with extra={'sample': True}, e.g. status polls.
+
+    The decision is stored on the record, so a filter shared by several handlers keeps or drops a record
+    for all of them.
+    """
+
+    def __init__(self, every: int = 1):
+        super().__init__()
+        self.every = max(1, int(every))
+        self._counter = count()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, 'sample', False):
+            return True
+        keep = getattr(record, 'sampled', None)
+        if keep is None:
+            keep = record.sampled = next(self._counter) % self.every == 0
+        return keep
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The queue stays in this process, so the record is passed as it is and its message
+        # is formatted on the listener thread instead of the caller's.
+        return record
 
 
 def get_logging_config():
@@ -9,8 +70,51 @@ def get_logging_config():
         return json.load(config_file)
 
 
+def start_listener() -> QueueListener:
+    """Moves the handlers of the root logger behind a queue served by a background thread."""
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    queue = SimpleQueue()
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(_QueueHandler(queue))
+    queue_listener = QueueListener(queue, *handlers, respect_handler_level=True)
+    queue_listener.start()
+    return queue_listener
+
+
+def _child_handler(handler: logging.Handler) -> logging.Handler:
+    """Returns a handler that a forked child can use next to the parent's copy of handler.
+
+    Only the parent may rotate a log file: a child appends through a WatchedFileHandler, which reopens the
+    file once the parent has rotated it away.
+    """
+    if not isinstance(handler, BaseRotatingHandler):
+        return handler
+    child = WatchedFileHandler(handler.baseFilename, encoding=handler.encoding, delay=True)
+    child.setLevel(handler.level)
+    child.setFormatter(handler.formatter)
+    for log_filter in handler.filters:
+        child.addFilter(log_filter)
+    return child
+
+
+def _log_directly() -> None:
+    # A forked child (e.g. a signing worker) has no listener thread, so it writes to the handlers itself.
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, _QueueHandler):
+            root.removeHandler(handler)
+    for handler in listener.handlers:
+        root.addHandler(_child_handler(handler))
+
+
 logging_config = get_logging_config()
 logging.config.dictConfig(logging_config)
+listener = start_listener()
+atexit.register(listener.stop)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_log_directly)
 
 
 def setup_logger():
@@ -0,0 +1,135 @@
+# _payload.py - incremental reception of uploaded documents for IM Sign (FastAPI) application.
+
+import os
+import asyncio
+from io import BytesIO
+from _logger import logger
+from _config import DIR_TEMP, UPLOAD_MAX_SIZE, UPLOAD_MEMORY_THRESHOLD
+
+
+class PayloadTooLarge(Exception):
+    pass
+
+
+class Payload:
+    """An uploaded document. Small documents stay in memory, larger ones are spilled to a file in DIR_TEMP."""
+
+    def __init__(self, data: bytes = None, path: str = None, size: int = 0):
+        self.data = data
+        self.path = path
+        self.size = size
+
+    @property
+    def in_memory(self) -> bool:
+        return self.path is None
+
+    def open(self):
+        return BytesIO(self.data) if self.in_memory else open(self.path, 'rb')
+
+    def read(self) -> bytes:
+        if self.in_memory:
+            return self.data
+        with open(self.path, 'rb') as file:
+            return file.read()
+
+    def persist(self, path: str) -> None:
+        """Moves the payload to path so that it survives a restart. In-memory data is released."""
+        if self.in_memory:
+            with open(path, 'wb') as file:
+                file.write(self.data)
+            self.data = None
+        elif self.path != path:
+            os.replace(self.path, path)
+        self.path = path
+
+    def discard(self) -> None:
+        self.data = None
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            except PermissionError as e:
+                logger.error(f"Problem with deleting upload {self.path}: {e}")
+            self.path = None
+
+
+def upload_path(file_uuid) -> str:
+    return f"{DIR_TEMP}/{file_uuid}.upload"
+
+
+class _Spooler:
+    """Collects chunks in memory and moves them to {DIR_TEMP}/{uuid}.upload once memory_threshold is reached."""
+
+    def __init__(self, file_uuid, max_size: int, memory_threshold: int):
+        self.path = upload_path(file_uuid)
+        self.max_size = max_size
+        self.memory_threshold = memory_threshold
+        self.buffer = bytearray()
+        self.file = None
+        self.size = 0
+
+    def add(self, chunk: bytes) -> bool:
+        """Buffers chunk, returns True when the buffer should be flushed."""
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            raise PayloadTooLarge(f"Upload exceeds the limit of {self.max_size} B.")
+        self.buffer += chunk
+        return len(self.buffer) >= self.memory_threshold
+
+    def flush(self) -> None:
+        if self.file is None:
+            self.file = open(self.path, 'wb')
+        self.file.write(self.buffer)
+        self.buffer = bytearray()
+
+    def finish(self) -> Payload:
+        if self.file is None:
+            return Payload(data=bytes(self.buffer), size=self.size)
+        self.flush()
+        self.file.close()
+        return Payload(path=self.path, size=self.size)
+
+    def abort(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            Payload(path=self.path).discard()
+
+
+async def receive(request, file_uuid, max_size: int = UPLOAD_MAX_SIZE,
+                  memory_threshold: int = UPLOAD_MEMORY_THRESHOLD, digest=None) -> Payload:
+    """Consumes the request body chunk by chunk.
+
+    Raises PayloadTooLarge as soon as the declared or received size exceeds max_size. Once more than
+    memory_threshold bytes are buffered, the buffer is flushed to {DIR_TEMP}/{uuid}.upload.
+    A hashlib object passed as digest is updated with every chunk.
+    """
+    content_length = request.headers.get('content-length')
+    if content_length and content_length.isdigit() and int(content_length) > max_size:
+        raise PayloadTooLarge(f"Declared size {content_length} B exceeds the limit of {max_size} B.")
+
+    spooler = _Spooler(file_uuid, max_size, memory_threshold)
+    try:
+        async for chunk in request.stream():
+            if spooler.add(chunk):
+                await asyncio.to_thread(spooler.flush)
+            if digest is not None:
+                digest.update(chunk)
+        return await asyncio.to_thread(spooler.finish)
+    except BaseException:
+        spooler.abort()
+        raise
+
+
+def spool(stream, file_uuid, max_size: int = UPLOAD_MAX_SIZE,
+          memory_threshold: int = UPLOAD_MEMORY_THRESHOLD, chunk_size: int = 65536) -> Payload:
+    """Blocking counterpart of receive for binary file objects, e.g. multipart parts or ZIP members."""
+    spooler = _Spooler(file_uuid, max_size, memory_threshold)
+    try:
+        while chunk := stream.read(chunk_size):
+            if spooler.add(chunk):
+                spooler.flush()
+        return spooler.finish()
+    except BaseException:
+        spooler.abort()
+        raise
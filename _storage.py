@@ -0,0 +1,227 @@
+# _storage.py - storage of signed documents for IM Sign (FastAPI) application.
+
+""" Signed files are stored under {root}/{uuid[0:2]}/{uuid[2:4]}/{uuid}.pdf, so no directory grows beyond
+a few hundred entries. An optional entity tag is kept next to the file in {uuid}.etag. Files appear atomically: they are written to a temporary name in the target directory
+and renamed. LocalStorage keeps them on the local disk of the node; SharedStorage puts them on a filesystem
+mounted by every node (NFS, SMB), so any node can serve /get_signed for a document signed by another one.
+"""
+
+import os
+import errno
+import socket
+import shutil
+from contextlib import suppress
+from _logger import logger
+from _config import DIR_TEMP, STORAGE_BACKEND, STORAGE_PATH, STORAGE_SHARD_DEPTH, OUTPUT_FSYNC
+
+
+class LocalStorage:
+    suffix = '.pdf'
+
+    def __init__(self, root: str, shard_depth: int = 2, fsync: bool = True):
+        self.root = root
+        self.shard_depth = shard_depth
+        self.fsync = fsync
+
+    def path(self, file_uuid) -> str:
+        key = str(file_uuid).lower()
+        shards = [key[2 * level:2 * level + 2] for level in range(self.shard_depth)]
+        return os.path.join(self.root, *shards, key + self.suffix)
+
+    def exists(self, file_uuid) -> bool:
+        return os.path.exists(self.path(file_uuid))
+
+    def size(self, file_uuid):
+        """Returns the size of the stored file, or None if there is none."""
+        try:
+            return os.stat(self.path(file_uuid)).st_size
+        except FileNotFoundError:
+            return None
+
+    def open(self, file_uuid):
+        return open(self.path(file_uuid), 'rb')
+
+    def etag(self, file_uuid):
+        """Returns the entity tag stored with the file, or None for files stored without one."""
+        try:
+            with open(self._etag_path(self.path(file_uuid)), 'r') as file:
+                return file.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def put(self, file_uuid, buffers: list, etag: str = None) -> int:
+        """Atomically stores the concatenation of buffers. Returns the stored size."""
+        path = self.path(file_uuid)
+        if etag:
+            self._put_etag(path, etag)
+        part_path = self._part_path(path)
+        fd = self._create(part_path)
+        try:
+            size = _write_all(fd, [memoryview(buffer) for buffer in buffers])
+            if self.fsync:
+                os.fsync(fd)
+        except BaseException:
+            os.close(fd)
+            with suppress(OSError):
+                os.remove(part_path)
+            raise
+        os.close(fd)
+        self._commit(part_path, path)
+        return size
+
+    def put_file(self, file_uuid, source: str, size: int, tail: bytes, etag: str = None) -> int:
+        """Atomically stores the first size bytes of the file at source followed by tail. The source file is consumed.
+
+        The file is turned into the stored file in place: it is truncated to size (so a retried job does not
+        append twice), tail is appended and it is renamed. Returns the stored size.
+        """
+        if etag:
+            self._put_etag(self.path(file_uuid), etag)
+        with open(source, 'r+b') as file:
+            file.truncate(size)
+            file.seek(size)
+            file.write(tail)
+            file.flush()
+            if self.fsync:
+                os.fsync(file.fileno())
+        self._commit(source, self.path(file_uuid))
+        return size + len(tail)
+
+    def delete(self, file_uuid) -> bool:
+        """Removes the stored file. Returns False if there was none."""
+        path = self.path(file_uuid)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        with suppress(FileNotFoundError):
+            os.remove(self._etag_path(path))
+        return True
+
+    def scan(self):
+        """Yields (uuid, size, mtime) of every stored file."""
+        yield from self._scan(self.root, self.shard_depth)
+
+    def list_expired(self, before: float):
+        """Yields (uuid, size, mtime) of the stored files last modified before the given time."""
+        for item in self.scan():
+            if item[2] < before:
+                yield item
+
+    def adopt_flat(self, directory: str) -> int:
+        """Moves signed files left in directory by the flat layout into their shards. Returns their number."""
+        moved = 0
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.endswith(self.suffix) and not entry.name.startswith('.') and entry.is_file():
+                    with suppress(FileNotFoundError):
+                        self._commit(entry.path, self.path(entry.name[:-len(self.suffix)]))
+                        moved += 1
+        return moved
+
+    def _scan(self, directory: str, depth: int):
+        try:
+            entries = list(os.scandir(directory))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if depth:
+                if len(entry.name) == 2 and entry.is_dir(follow_symlinks=False):
+                    yield from self._scan(entry.path, depth - 1)
+            elif entry.name.endswith(self.suffix) and not entry.name.startswith('.') and entry.is_file():
+                with suppress(FileNotFoundError):
+                    info = entry.stat()
+                    yield entry.name[:-len(self.suffix)], info.st_size, info.st_mtime
+
+    def _part_path(self, path: str) -> str:
+        return f"{path}.part"
+
+    def _etag_path(self, path: str) -> str:
+        return path[:-len(self.suffix)] + '.etag'
+
+    def _put_etag(self, path: str, etag: str) -> None:
+        # Written before the file itself, so a stored file always has its tag.
+        etag_path = self._etag_path(path)
+        part_path = self._part_path(etag_path)
+        fd = self._create(part_path)
+        try:
+            _write_all(fd, [memoryview(etag.encode())])
+        finally:
+            os.close(fd)
+        os.replace(part_path, etag_path)
+
+    @staticmethod
+    def _create(path: str) -> int:
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+        try:
+            return os.open(path, flags, 0o644)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            return os.open(path, flags, 0o644)
+
+    def _commit(self, source: str, path: str) -> None:
+        """Renames source to path. A source on another filesystem (e.g. an upload in DIR_TEMP) is copied."""
+        try:
+            os.replace(source, path)
+        except FileNotFoundError:
+            if not os.path.exists(source):
+                raise
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._commit(source, path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            part_path = self._part_path(path)
+            with open(source, 'rb') as src, open(part_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+                dst.flush()
+                if self.fsync:
+                    os.fsync(dst.fileno())
+            os.replace(part_path, path)
+            os.remove(source)
+
+
+class SharedStorage(LocalStorage):
+    """Storage on a filesystem shared by several nodes.
+
+    Temporary names carry the host name and process id, so concurrent writers never collide, and the directory
+    is synced after a rename, so the new name is visible to other nodes once put returns.
+    """
+
+    def _part_path(self, path: str) -> str:
+        directory, name = os.path.split(path)
+        return os.path.join(directory, f".{name}.{socket.gethostname()}.{os.getpid()}.part")
+
+    def _commit(self, source: str, path: str) -> None:
+        super()._commit(source, path)
+        if self.fsync and hasattr(os, 'O_DIRECTORY'):
+            fd = os.open(os.path.dirname(path), os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            except OSError as e:
+                logger.debug(f"Directory sync is not supported for {path}: {e}")
+            finally:
+                os.close(fd)
+
+
+def _write_all(fd: int, buffers: list) -> int:
+    size = sum(len(buffer) for buffer in buffers)
+    if hasattr(os, 'writev'):
+        while buffers:
+            written = os.writev(fd, buffers)
+            while buffers and written >= len(buffers[0]):
+                written -= len(buffers[0])
+                buffers.pop(0)
+            if buffers:
+                buffers[0] = buffers[0][written:]
+    else:
+        for buffer in buffers:
+            while buffer:
+                buffer = buffer[os.write(fd, buffer):]
+    return size
+
+
+BACKENDS = {'local': LocalStorage, 'shared': SharedStorage}
+
+storage = BACKENDS[STORAGE_BACKEND](STORAGE_PATH or os.path.join(DIR_TEMP, 'signed'), STORAGE_SHARD_DEPTH, OUTPUT_FSYNC)
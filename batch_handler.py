@@ -0,0 +1,134 @@
+# batch_handler.py
+
+""" Helpers for /sign_batch: unpacking multipart or ZIP uploads into payloads and registering
+all documents of a batch together.
+"""
+
+import uuid
+import asyncio
+import zipfile
+from dataclasses import dataclass
+from typing import Optional
+from starlette.requests import Request
+from _logger import logger
+from _config import BATCH_MAX_FILES, BATCH_MAX_SIZE
+from _payload import Payload, PayloadTooLarge, receive, spool
+from validators import valid_file
+from status_cache import record_status
+
+
+class BatchError(Exception):
+    pass
+
+
+@dataclass
+class BatchItem:
+    name: str
+    file_uuid: str
+    payload: Optional[Payload] = None
+    error: Optional[str] = None
+
+    def reject(self, error: str) -> None:
+        if self.payload is not None:
+            self.payload.discard()
+            self.payload = None
+        self.error = error
+
+    def result(self) -> dict:
+        if self.error:
+            return {"file": self.name, "error": self.error}
+        return {"file": self.name, "uuid": self.file_uuid}
+
+
+def _spool_item(stream, name: str) -> BatchItem:
+    item = BatchItem(name, str(uuid.uuid4()))
+    try:
+        item.payload = spool(stream, item.file_uuid)
+    except PayloadTooLarge as e:
+        item.error = str(e)
+    return item
+
+
+def _limited(request, max_size: int) -> Request:
+    """Returns a view of the request whose body raises PayloadTooLarge once more than max_size
+    bytes have been received, whatever Content-Length says."""
+    received = 0
+
+    async def receive():
+        nonlocal received
+        message = await request.receive()
+        received += len(message.get('body', b''))
+        if received > max_size:
+            raise PayloadTooLarge(f"Upload exceeds the batch limit of {max_size} B.")
+        return message
+
+    return Request(request.scope, receive)
+
+
+async def collect_batch(request) -> list:
+    """Reads the documents of a batch from a multipart/form-data body or from a ZIP archive."""
+    content_type = request.headers.get('content-type', '')
+    content_length = request.headers.get('content-length')
+    if content_length and content_length.isdigit() and int(content_length) > BATCH_MAX_SIZE:
+        raise PayloadTooLarge(f"Declared size {content_length} B exceeds the batch limit of {BATCH_MAX_SIZE} B.")
+
+    if content_type.startswith('multipart/form-data'):
+        form = await _limited(request, BATCH_MAX_SIZE).form(max_files=BATCH_MAX_FILES, max_fields=BATCH_MAX_FILES)
+        uploads = [value for _, value in form.multi_items() if not isinstance(value, str)]
+        try:
+            return [await asyncio.to_thread(_spool_item, upload.file, upload.filename or f"file{index}")
+                    for index, upload in enumerate(uploads)]
+        finally:
+            await form.close()
+
+    if content_type in ('application/zip', 'application/x-zip-compressed', 'application/octet-stream'):
+        archive = await receive(request, f"batch-{uuid.uuid4()}", max_size=BATCH_MAX_SIZE)
+        try:
+            return await asyncio.to_thread(_unzip, archive)
+        finally:
+            archive.discard()
+
+    raise BatchError(f"Unsupported content type: {content_type or 'none'}.")
+
+
+def _unzip(archive: Payload) -> list:
+    items = []
+    try:
+        with archive.open() as stream, zipfile.ZipFile(stream) as zf:
+            members = [info for info in zf.infolist() if not info.is_dir() and not info.filename.startswith('__MACOSX/')]
+            if len(members) > BATCH_MAX_FILES:
+                raise BatchError(f"Archive holds {len(members)} files, the limit is {BATCH_MAX_FILES}.")
+            for info in members:
+                if not info.filename.lower().endswith('.pdf'):
+                    items.append(BatchItem(info.filename, '', error="Not a PDF file."))
+                    continue
+                with zf.open(info) as member:
+                    items.append(_spool_item(member, info.filename))
+    except zipfile.BadZipFile as e:
+        for item in items:
+            item.reject(str(e))
+        raise BatchError(f"Invalid ZIP archive: {e}")
+    except BaseException:
+        for item in items:
+            item.reject("Batch aborted.")
+        raise
+    return items
+
+
+async def validate_batch(items: list) -> None:
+    pending = [item for item in items if item.payload is not None]
+    results = await asyncio.gather(*(valid_file(item.payload) for item in pending))
+    for item, validation in zip(pending, results):
+        if not validation:
+            item.reject(f"Invalid file, failed check: {validation.failed_check}.")
+
+
+async def register_batch(items: list, sender: str) -> None:
+    """Registers all accepted items with a 'Received' status, the status writer stores them in one transaction."""
+    accepted = [item for item in items if item.payload is not None]
+    if not accepted:
+        return
+    for item in accepted:
+        await record_status(item.file_uuid, 'Received', 'Received file from the client in a batch',
+                            created=True, file_size=item.payload.size, sender=sender)
+    logger.info(f"Registered {len(accepted)} batch document(s) from {sender}.")
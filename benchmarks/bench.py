@@ -0,0 +1,316 @@
+# bench.py - end-to-end benchmark of the /sign -> /wait -> /get_signed cycle.
+
+""" Runs the FastAPI app in-process against a throwaway working directory: a generated config.ini,
+a self-signed PFX registered through the normal certificate loading path and a SQLite database
+in place of SQL Server (see sqlite_backend; schema creation and migrations are not run). Synthetic PDFs
+are sent at the requested concurrency for every combination of size and page count.
+
+Example:
+    python benchmarks/bench.py --sizes 100k,1m,10m --pages 1,50 --concurrency 8 --requests 40 \\
+        --output bench.json --baseline previous.json --max-regression 0.15
+
+The JSON report holds requests/sec, client latencies and server stage latencies (p50/p95/p99, ms)
+per matrix cell and the peak RSS of the API process and of the signing workers. With --baseline the
+run exits with status 1 if throughput drops or p95 latency grows by more than --max-regression.
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime, timezone
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import httpx  # noqa: E402
+from cryptography.fernet import Fernet  # noqa: E402
+import sqlite_backend  # noqa: E402
+from synthetic import make_pdf, make_pfx  # noqa: E402
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+CERT_NAME = 'bench'
+CERT_PASSWORD = 'bench-password'
+
+QUIET_LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {"standard": {"format": "%(asctime)s | %(levelname)s | %(filename)s:%(lineno)s | %(message)s"}},
+    "handlers": {"console": {"class": "logging.StreamHandler", "level": "WARNING", "formatter": "standard",
+                             "stream": "ext://sys.stderr"}},
+    "root": {"level": "WARNING", "handlers": ["console"]},
+}
+
+
+def parse_size(value: str) -> int:
+    value = value.strip().lower()
+    for suffix, factor in (('k', 1024), ('m', 1024 ** 2), ('g', 1024 ** 3)):
+        if value.endswith(suffix):
+            return int(float(value[:-1]) * factor)
+    return int(value)
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "count": 0}
+    ordered = sorted(values)
+
+    def rank(q):
+        return round(ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))] * 1000, 3)
+
+    return {"p50": rank(0.50), "p95": rank(0.95), "p99": rank(0.99), "count": len(ordered)}
+
+
+def prepare_workdir(args) -> str:
+    workdir = tempfile.mkdtemp(prefix='imsign-bench-')
+    temp_dir = os.path.join(workdir, 'data')
+    cert_dir = os.path.join(workdir, 'load_certificate')
+    os.makedirs(temp_dir)
+    os.makedirs(cert_dir)
+    make_pfx(os.path.join(cert_dir, f'{CERT_NAME}.pfx'), CERT_NAME, CERT_PASSWORD)
+
+    with open(os.path.join(workdir, 'logging_config.json'), 'w') as file:
+        json.dump(QUIET_LOGGING, file)
+    with open(os.path.join(workdir, 'config.ini'), 'w') as file:
+        file.write(f"""[DIRECTORIES]
+CERTIFICATE = {cert_dir}
+temp_folder = {temp_dir}
+
+[DATABASE]
+DB_SERVER = sqlite
+DB_NAME = bench
+DB_USER = bench
+DB_PASSWORD = bench
+POOL_SIZE = {args.db_pool_size}
+
+[CERT]
+ENCRYPTION_KEY = {Fernet.generate_key().decode()}
+CERTIFICATES = {CERT_NAME} {CERT_PASSWORD}
+
+[KTA]
+URL = http://127.0.0.1:9/
+
+[SIGNING]
+WORKERS = {args.signing_workers}
+
+[QUEUE]
+WORKERS = {args.queue_workers}
+MAX_DEPTH = {max(1000, args.requests * 2)}
+
+[VALIDATION]
+MODE = {args.validation_mode}
+""")
+    return workdir
+
+
+class StageRecorder:
+    """Keeps the raw samples of _metrics.STAGE_SECONDS, so exact percentiles can be reported."""
+
+    def __init__(self, histogram):
+        self.samples = {}
+        self._observe = histogram.observe
+        histogram.observe = self.observe
+
+    def observe(self, value: float, **labels) -> None:
+        self.samples.setdefault(labels.get('stage', ''), []).append(value)
+        self._observe(value, **labels)
+
+    def reset(self) -> dict:
+        samples, self.samples = self.samples, {}
+        return samples
+
+
+async def run_cell(client: httpx.AsyncClient, document: bytes, requests: int, concurrency: int) -> dict:
+    latencies = {"sign": [], "wait": [], "download": [], "total": []}
+    errors = {}
+    semaphore = asyncio.Semaphore(concurrency)
+    headers = {"sender": "bench", "cert-name": CERT_NAME, "content-type": "application/pdf"}
+
+    def failed(step: str, response: httpx.Response) -> None:
+        key = f"{step}:{response.status_code}"
+        errors[key] = errors.get(key, 0) + 1
+
+    async def cycle():
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.post('/sign', content=document, headers=headers)
+            if response.status_code != 200:
+                return failed('sign', response)
+            signed = time.perf_counter()
+            file_uuid = response.json()['uuid']
+
+            response = await client.get(f'/wait/{file_uuid}', params={'timeout': 60})
+            if response.status_code != 200:
+                return failed('wait', response)
+            ready = time.perf_counter()
+
+            response = await client.get(f'/get_signed/{file_uuid}')
+            if response.status_code != 200:
+                return failed('get_signed', response)
+            done = time.perf_counter()
+
+            latencies["sign"].append(signed - started)
+            latencies["wait"].append(ready - signed)
+            latencies["download"].append(done - ready)
+            latencies["total"].append(done - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(cycle() for _ in range(requests)))
+    elapsed = time.perf_counter() - started
+
+    completed = len(latencies["total"])
+    return {
+        "completed": completed,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "rps": round(completed / elapsed, 3) if elapsed else 0.0,
+        "latency_ms": {name: percentiles(values) for name, values in latencies.items()},
+    }
+
+
+def peak_rss_kb() -> dict:
+    if resource is None:
+        return {}
+    factor = 1 if sys.platform.startswith('linux') else 1 / 1024
+    return {
+        "api": int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * factor),
+        "workers": int(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * factor),
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO, capture_output=True, text=True,
+                              timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ''
+
+
+async def benchmark(args) -> dict:
+    # The application reads config.ini and logging_config.json from the working directory when _config and
+    # _logger are first imported, so none of it may be loaded before the chdir into the generated workdir.
+    if '_config' in sys.modules:
+        raise RuntimeError("The application was imported before the benchmark set up its working directory.")
+    workdir = prepare_workdir(args)
+    os.chdir(workdir)
+    sys.path.insert(0, REPO)
+
+    # First import of the application: install() loads _database, and with it _config, from the workdir.
+    sqlite_backend.install(os.path.join(workdir, 'bench.sqlite'))
+    import _metrics
+    import main
+
+    recorder = StageRecorder(_metrics.STAGE_SECONDS)
+    runs = []
+    await main.app.router.startup()
+    try:
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=300) as client:
+            for size in args.sizes:
+                for pages in args.pages:
+                    document = make_pdf(pages, size)
+                    if args.warmup:
+                        await run_cell(client, document, args.warmup, args.concurrency)
+                    recorder.reset()
+                    result = await run_cell(client, document, args.requests, args.concurrency)
+                    result["stages_ms"] = {name: percentiles(values) for name, values in recorder.reset().items()}
+                    result.update({"size": size, "document_bytes": len(document), "pages": pages,
+                                   "concurrency": args.concurrency, "requests": args.requests})
+                    runs.append(result)
+                    print(f"size={size} pages={pages} c={args.concurrency}: {result['rps']} req/s, "
+                          f"p95 total {result['latency_ms']['total']['p95']} ms, errors {result['errors'] or 0}",
+                          file=sys.stderr)
+    finally:
+        await main.app.router.shutdown()
+
+    return {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "signing_workers": args.signing_workers,
+            "queue_workers": args.queue_workers,
+            "validation_mode": args.validation_mode,
+            "workdir": workdir,
+        },
+        "runs": runs,
+        "peak_rss_kb": peak_rss_kb(),
+    }
+
+
+def compare(report: dict, baseline: dict, max_regression: float) -> list:
+    """Returns the regressions of report against baseline, matched by size, pages and concurrency."""
+    def key(run):
+        return run["size"], run["pages"], run["concurrency"]
+
+    previous = {key(run): run for run in baseline.get("runs", [])}
+    regressions = []
+    for run in report["runs"]:
+        old = previous.get(key(run))
+        if not old:
+            continue
+        if old["rps"] and run["rps"] < old["rps"] * (1 - max_regression):
+            regressions.append(f"{key(run)}: throughput {old['rps']} -> {run['rps']} req/s")
+        old_p95, new_p95 = old["latency_ms"]["total"]["p95"], run["latency_ms"]["total"]["p95"]
+        if old_p95 and new_p95 and new_p95 > old_p95 * (1 + max_regression):
+            regressions.append(f"{key(run)}: p95 latency {old_p95} -> {new_p95} ms")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='100k,1m,5m', help='Comma separated document sizes (k/m suffixes)')
+    parser.add_argument('--pages', default='1,50', help='Comma separated page counts')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=40, help='Sign cycles per matrix cell')
+    parser.add_argument('--warmup', type=int, default=2, help='Unmeasured cycles before every cell')
+    parser.add_argument('--signing-workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--queue-workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--db-pool-size', type=int, default=10)
+    parser.add_argument('--validation-mode', choices=('fast', 'strict'), default='fast')
+    parser.add_argument('--output', help='Write the JSON report to this file (default: stdout)')
+    parser.add_argument('--baseline', help='JSON report of a previous run to compare against')
+    parser.add_argument('--max-regression', type=float, default=0.15)
+    args = parser.parse_args(argv)
+    args.sizes = [parse_size(value) for value in args.sizes.split(',') if value.strip()]
+    args.pages = [int(value) for value in args.pages.split(',') if value.strip()]
+    return args
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+    report = asyncio.run(benchmark(args))
+
+    if output:
+        with open(output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if baseline is not None:
+        regressions = compare(report, baseline, args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
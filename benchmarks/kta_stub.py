@@ -0,0 +1,85 @@
+# kta_stub.py - local stand-in for the KTA endpoint that receives pushed documents.
+
+""" Accepts the POSTs of delivery.py and stores every received PDF as {uuid}.pdf in --output.
+A share of the requests can be failed (--fail-rate, --fail-status) or slowed down (--delay) to exercise
+retries and dead-lettering.
+
+Example, with [KTA] URL = http://127.0.0.1:8081/documents and PUSH = true in config.ini:
+    python benchmarks/kta_stub.py --port 8081 --output /tmp/kta --fail-rate 0.2
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    options = None
+    received = 0
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        if self.options.delay:
+            time.sleep(self.options.delay)
+        if random.random() < self.options.fail_rate:
+            return self._answer(self.options.fail_status, b'failed on purpose')
+        file_uuid = self.headers.get('uuid') or f'unnamed-{time.time_ns()}'
+        if self.options.output:
+            with open(os.path.join(self.options.output, f'{os.path.basename(file_uuid)}.pdf'), 'wb') as file:
+                file.write(body)
+        Handler.received += 1
+        self._answer(200, b'ok')
+
+    def _answer(self, status: int, body: bytes) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if not self.options.quiet:
+            super().log_message(format, *args)
+
+
+def serve(host: str, port: int, options) -> ThreadingHTTPServer:
+    """Returns the server bound to host:port; call serve_forever() to handle requests."""
+    Handler.options = options
+    if options.output:
+        os.makedirs(options.output, exist_ok=True)
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--output', help='Directory for the received documents (default: discard them)')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='Share of requests answered with --fail-status')
+    parser.add_argument('--fail-status', type=int, default=503)
+    parser.add_argument('--delay', type=float, default=0.0, help='Seconds to wait before answering')
+    parser.add_argument('--quiet', action='store_true')
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    options = parse_args(argv)
+    server = serve(options.host, options.port, options)
+    print(f"KTA stub listening on http://{options.host}:{options.port}/", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Received {Handler.received} document(s).", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,184 @@
+# sqlite_backend.py - local SQLite stand-in for SQL Server used by the benchmark harness.
+
+""" Provides pyodbc-like connections backed by one SQLite file, so that the _database connection pool,
+the query templates and the transactions run unchanged without a SQL Server.
+Only the T-SQL constructs used by the queries of _database are translated.
+
+The guarded DDL of _database (the create_* and migrate_* blocks run by maintenance.create_tables) is not:
+SCHEMA mirrors the tables, keys and indexes they create, and the IF blocks are skipped. The benchmark
+therefore measures queries and transactions, not table creation, migrations or SQL Server index behaviour;
+tests/test_sqlite_backend.py checks that SCHEMA keeps the columns and keys of the T-SQL tables.
+"""
+
+import re
+import uuid
+import sqlite3
+from datetime import datetime
+import pyodbc
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS Documents (
+    ID INTEGER PRIMARY KEY AUTOINCREMENT,
+    UUID TEXT NOT NULL UNIQUE,
+    SignTimestamp TEXT NULL,
+    FileSize INTEGER NULL,
+    RecordTime TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    Sender TEXT NULL,
+    CurrentStatus TEXT NULL,
+    CurrentMessage TEXT NULL,
+    Node TEXT NULL
+);
+CREATE TABLE IF NOT EXISTS IdempotencyKeys (
+    IdempotencyKey TEXT NOT NULL PRIMARY KEY,
+    UUID TEXT NOT NULL,
+    RecordTime TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS DocumentsHistory (
+    ID INTEGER PRIMARY KEY AUTOINCREMENT,
+    UUID TEXT NOT NULL REFERENCES Documents(UUID),
+    Status TEXT NOT NULL,
+    Message TEXT NULL,
+    RecordTime TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS IX_DocumentsHistory_UUID_ID ON DocumentsHistory (UUID, ID DESC, Status, Message);
+CREATE TABLE IF NOT EXISTS Certificates (
+    ID INTEGER PRIMARY KEY AUTOINCREMENT,
+    Valid INTEGER NOT NULL,
+    CertName TEXT NOT NULL,
+    Expiration TEXT NOT NULL,
+    Issuer TEXT NULL,
+    Subject TEXT NULL,
+    RecordTime TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    CertificateData BLOB
+);
+"""
+
+_TOP = re.compile(r'\bSELECT\s+TOP\s+(\d+)\s', re.IGNORECASE)
+_SCHEMA_PREFIX = re.compile(r'\bdbo\.', re.IGNORECASE)
+_DATETIME_CAST = re.compile(r'CAST\(([\w.?]+) AS DATETIME2?\)', re.IGNORECASE)
+_VALUES_ALIAS = re.compile(r'\(VALUES\s(.*?)\)\s+AS\s+(\w+)\s*\(([^)]*)\)', re.IGNORECASE | re.DOTALL)
+_UUID = re.compile(r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$')
+
+
+def translate(sql: str):
+    """Rewrites a T-SQL statement for SQLite. Returns None for the guarded DDL of _database, which is not
+    translated; the schema is created by create_schema instead."""
+    stripped = sql.strip()
+    if stripped.upper().startswith('IF '):
+        return None
+    top = _TOP.search(stripped)
+    if top:
+        stripped = _TOP.sub('SELECT ', stripped, count=1) + f' LIMIT {top.group(1)}'
+    stripped = _SCHEMA_PREFIX.sub('', stripped)
+    # Dates are stored as text, so casting to a date is a no-op.
+    stripped = _DATETIME_CAST.sub(r'\1', stripped)
+    # SQLite has no column list on a derived table alias: (VALUES ...) AS v (a, b) -> (SELECT column1 AS a, ...) AS v
+    stripped = _VALUES_ALIAS.sub(_alias_values, stripped)
+    return stripped.replace('GETDATE()', 'CURRENT_TIMESTAMP')
+
+
+def _alias_values(match) -> str:
+    columns = [name.strip() for name in match.group(3).split(',')]
+    aliases = ', '.join(f'column{number} AS {name}' for number, name in enumerate(columns, start=1))
+    return f'(SELECT {aliases} FROM (VALUES {match.group(1)})) AS {match.group(2)}'
+
+
+def _adapt(value):
+    # uniqueidentifier comparisons are case-insensitive in SQL Server, UUIDs are stored lower-case here.
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, str) and _UUID.match(value):
+        return value.lower()
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ')
+    return value
+
+
+class Cursor:
+    def __init__(self, connection):
+        self._cursor = connection.cursor()
+        self.description = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def execute(self, sql, params=None):
+        statement = translate(sql)
+        if statement is None:
+            self.description = None
+            return self
+        if params is None:
+            params = ()
+        elif not isinstance(params, (list, tuple)):
+            params = (params,)
+        try:
+            self._cursor.execute(statement, [_adapt(value) for value in params])
+        except sqlite3.IntegrityError as e:
+            # Raised as pyodbc raises a constraint violation of SQL Server.
+            raise pyodbc.IntegrityError(str(e)) from e
+        self.description = self._cursor.description
+        return self
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def close(self):
+        self._cursor.close()
+
+
+class Connection:
+    def __init__(self, path: str):
+        self._connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._autocommit = True
+
+    @property
+    def autocommit(self) -> bool:
+        return self._autocommit
+
+    @autocommit.setter
+    def autocommit(self, value: bool) -> None:
+        if not value and self._autocommit:
+            self._connection.execute('BEGIN')
+        elif value and not self._autocommit and self._connection.in_transaction:
+            self._connection.execute('COMMIT')
+        self._autocommit = value
+
+    def cursor(self) -> Cursor:
+        return Cursor(self._connection)
+
+    def commit(self) -> None:
+        if self._connection.in_transaction:
+            self._connection.execute('COMMIT')
+        if not self._autocommit:
+            self._connection.execute('BEGIN')
+
+    def rollback(self) -> None:
+        if self._connection.in_transaction:
+            self._connection.execute('ROLLBACK')
+        if not self._autocommit:
+            self._connection.execute('BEGIN')
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+def create_schema(path: str) -> None:
+    connection = sqlite3.connect(path)
+    try:
+        connection.executescript(SCHEMA)
+    finally:
+        connection.close()
+
+
+def install(path: str) -> None:
+    """Points the _database connection pool at the SQLite file."""
+    import _database
+
+    create_schema(path)
+    _database.pool._connect = lambda: Connection(path)
@@ -0,0 +1,88 @@
+# synthetic.py - synthetic PDFs and a throwaway signing certificate for the benchmark harness.
+
+import zlib
+import random
+from datetime import datetime, timedelta, timezone
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.serialization import pkcs12
+
+
+def make_pdf(pages: int, size: int, seed: int = 0) -> bytes:
+    """Builds a valid PDF with the given number of pages, padded to roughly size bytes.
+
+    Padding is an incompressible embedded stream referenced from the first page, so the document
+    stays realistic for hashing and for the structural checks.
+    """
+    objects = []
+
+    def add(body: bytes) -> int:
+        objects.append(body)
+        return len(objects)
+
+    catalog = add(b'')
+    page_tree = add(b'')
+    font = add(b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>')
+
+    kids = []
+    for number in range(pages):
+        text = f"BT /F1 24 Tf 72 720 Td (Benchmark page {number + 1}) Tj ET".encode()
+        content = add(b'<< /Length %d >>\nstream\n' % len(text) + text + b'\nendstream')
+        kids.append(add(
+            b'<< /Type /Page /Parent %d 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 %d 0 R >> >> '
+            b'/Contents %d 0 R >>' % (page_tree, font, content)
+        ))
+
+    skeleton = 1024 + 220 * pages
+    if size > skeleton:
+        padding = _noise(size - skeleton, seed)
+        compressed = zlib.compress(padding, 1)
+        filler = add(b'<< /Length %d /Filter /FlateDecode >>\nstream\n' % len(compressed) + compressed + b'\nendstream')
+        objects[catalog - 1] = b'<< /Type /Catalog /Pages %d 0 R /PieceInfo << /Bench << /Data %d 0 R >> >> >>' % (
+            page_tree, filler)
+    else:
+        objects[catalog - 1] = b'<< /Type /Catalog /Pages %d 0 R >>' % page_tree
+    objects[page_tree - 1] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (
+        b' '.join(b'%d 0 R' % kid for kid in kids), len(kids))
+
+    output = bytearray(b'%PDF-1.7\n%\xe2\xe3\xcf\xd3\n')
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += b'%d 0 obj\n' % number + body + b'\nendobj\n'
+    xref = len(output)
+    output += b'xref\n0 %d\n0000000000 65535 f\r\n' % (len(objects) + 1)
+    for offset in offsets:
+        output += b'%010d 00000 n\r\n' % offset
+    output += b'trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, catalog, xref)
+    return bytes(output)
+
+
+def _noise(size: int, seed: int) -> bytes:
+    # A random block repeated at a distance larger than the deflate window stays incompressible.
+    block = random.Random(seed).randbytes(65536)
+    return (block * (size // len(block) + 1))[:size]
+
+
+def make_pfx(path: str, common_name: str, password: str, days: int = 30) -> None:
+    """Writes a self-signed RSA-2048 certificate with its private key as a PKCS#12 file."""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    now = datetime.now(timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(minutes=5))
+        .not_valid_after(now + timedelta(days=days))
+        .sign(key, hashes.SHA256())
+    )
+    with open(path, 'wb') as file:
+        file.write(pkcs12.serialize_key_and_certificates(
+            common_name.encode(), key, certificate, None,
+            serialization.BestAvailableEncryption(password.encode())
+        ))
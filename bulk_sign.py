@@ -0,0 +1,396 @@
+# bulk_sign.py - offline bulk signing of archived PDFs for IM Sign.
+
+""" Signs every PDF of a directory tree or of a manifest (a text file listing one path per line) without
+going through the HTTP API. Documents are validated with validators.valid_file and signed on the signing
+engine's process pool exactly like /sign does; workers read the files themselves, so documents are never
+loaded into or pickled from this process. Signed files are written to the output directory under the same
+relative path.
+
+Results are stored in Documents/DocumentsHistory in batches (Received, Signed and Transmitted, or Failed),
+and/or appended to a CSV or JSON lines ledger (--ledger, by extension). Sources are added to a checkpoint
+file once their results were stored, so an interrupted run continues where it stopped with --resume;
+failed documents are tried again.
+
+Run from the application directory, it uses config.ini and the certificates of the API:
+    python bulk_sign.py /archive/2023 --output /signed/2023 --cert CSAT --ledger /signed/2023.csv --resume
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import uuid
+import asyncio
+import argparse
+from datetime import datetime
+from dataclasses import dataclass, asdict
+from typing import Optional
+from _logger import logger
+from _config import SIGNING_WORKERS, OUTPUT_FSYNC, CERTIFICATES
+import _database
+import maintenance
+from _cert import CERTS, Certificate, CertificateError, parse_certificates
+from _engine import engine
+from _payload import Payload
+from validators import valid_file
+from sign_handler import SignTime, signature_fields
+
+CHECKPOINT_NAME = '.bulk_sign.checkpoint'
+
+
+@dataclass
+class Result:
+    source: str
+    output: str
+    uuid: str
+    received: str
+    status: str = 'Transmitted'
+    message: str = ''
+    file_size: int = 0
+    size: int = 0
+    signed: Optional[str] = None
+    finished: Optional[str] = None
+    sign_timestamp: Optional[str] = None
+    duration_ms: float = 0.0
+
+    def fail(self, message: str) -> None:
+        self.status = 'Failed'
+        self.message = message
+
+    def events(self, sender: str) -> list:
+        events = [_database.StatusEvent(self.uuid, 'Received', 'Received file from bulk signing', self.received,
+                                        created=True, file_size=self.file_size, sender=sender)]
+        if self.signed:
+            events.append(_database.StatusEvent(self.uuid, 'Signed', 'File was signed', self.signed,
+                                                sign_timestamp=self.sign_timestamp))
+        events.append(_database.StatusEvent(self.uuid, self.status, self.message, self.finished))
+        return events
+
+
+def now() -> str:
+    return datetime.now().isoformat(timespec='milliseconds')
+
+
+def iter_sources(path: str):
+    """Yields (source path, relative output path) of every document of a directory tree or a manifest."""
+    if os.path.isdir(path):
+        for directory, subdirectories, names in os.walk(path):
+            subdirectories.sort()
+            for name in sorted(names):
+                if name.lower().endswith('.pdf'):
+                    source = os.path.join(directory, name)
+                    yield source, os.path.relpath(source, path)
+        return
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, encoding='utf-8') as manifest:
+        for line in manifest:
+            entry = line.strip()
+            if not entry or entry.startswith('#'):
+                continue
+            if os.path.isabs(entry):
+                yield entry, os.path.splitdrive(entry)[1].lstrip('/\\')
+            else:
+                yield os.path.join(base, entry), os.path.normpath(entry)
+
+
+def output_target(output: str, relative: str) -> Optional[str]:
+    """Returns the output path of a document, None if relative (e.g. a manifest entry with '..') escapes output."""
+    root = os.path.realpath(output)
+    target = os.path.realpath(os.path.join(root, relative))
+    if target == root or os.path.commonpath([root, target]) != root:
+        return None
+    return os.path.join(output, relative)
+
+
+def write_output(source: str, signature: bytes, target: str, fsync: bool) -> int:
+    """Writes the document followed by its signature to target atomically. Returns the size written."""
+    os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+    part_path = f"{target}.part"
+    with open(source, 'rb') as src, open(part_path, 'wb') as dst:
+        while chunk := src.read(1024 * 1024):
+            dst.write(chunk)
+        dst.write(signature)
+        dst.flush()
+        if fsync:
+            os.fsync(dst.fileno())
+        size = dst.tell()
+    os.replace(part_path, target)
+    return size
+
+
+async def sign_document(source: str, target: str, cert_name: str) -> Result:
+    started = time.perf_counter()
+    result = Result(source, target, str(uuid.uuid4()), now(), message=f'Signed file written to {target}')
+    try:
+        result.file_size = os.path.getsize(source)
+        # The payload points at the archived file itself and is never discarded.
+        payload = Payload(path=source, size=result.file_size)
+        validation = await valid_file(payload)
+        if not validation:
+            result.fail(f"Invalid file, failed check: {validation.failed_check}.")
+        else:
+            timestamp = SignTime()
+            signature = await engine.sign(payload, signature_fields(timestamp), cert_name)
+            result.signed = now()
+            result.sign_timestamp = timestamp.db()
+            result.size = await asyncio.to_thread(write_output, source, signature, target, OUTPUT_FSYNC)
+    except Exception as e:
+        result.fail(f"Failed to sign the file: {e}")
+    result.finished = now()
+    result.duration_ms = round((time.perf_counter() - started) * 1000, 3)
+    return result
+
+
+class Ledger:
+    """Appends results to a CSV file or, for any other extension, to a JSON lines file."""
+
+    FIELDS = ('source', 'output', 'uuid', 'status', 'message', 'file_size', 'size', 'sign_timestamp', 'duration_ms')
+
+    def __init__(self, path: str):
+        self.csv = path.lower().endswith('.csv')
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, 'a', encoding='utf-8', newline='')
+        self._writer = csv.DictWriter(self._file, self.FIELDS, extrasaction='ignore') if self.csv else None
+        if self.csv and new:
+            self._writer.writeheader()
+
+    def write(self, results: list) -> None:
+        for result in results:
+            row = {name: value for name, value in asdict(result).items() if name in self.FIELDS}
+            if self.csv:
+                self._writer.writerow(row)
+            else:
+                self._file.write(json.dumps(row, ensure_ascii=False) + '\n')
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class Checkpoint:
+    """Relative paths of the documents that were signed and recorded, one per line."""
+
+    def __init__(self, path: str, resume: bool):
+        self.path = path
+        self.done = set()
+        if resume and os.path.exists(path):
+            with open(path, encoding='utf-8') as file:
+                self.done = {line.rstrip('\n') for line in file if line.strip()}
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, 'a' if resume else 'w', encoding='utf-8')
+
+    def __contains__(self, relative: str) -> bool:
+        return relative in self.done
+
+    def add(self, relatives: list) -> None:
+        if not relatives:
+            return
+        self._file.write(''.join(f"{relative}\n" for relative in relatives))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.done.update(relatives)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class Recorder:
+    """Collects results and stores them together: the ledger, one database transaction, then the checkpoint.
+
+    Results whose transaction failed are kept and stored with the next batch; they are only checkpointed once
+    they are in the database.
+    """
+
+    def __init__(self, sender: str, use_database: bool, ledger: Optional[Ledger], checkpoint: Checkpoint,
+                 batch_size: int, interval: float):
+        self.sender = sender
+        self.use_database = use_database
+        self.ledger = ledger
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self.interval = interval
+        self._pending = []
+        self._unstored = []
+        self._flushed = time.monotonic()
+
+    @property
+    def unstored(self) -> int:
+        return len(self._unstored)
+
+    def add(self, relative: str, result: Result) -> None:
+        self._pending.append((relative, result))
+
+    def due(self) -> bool:
+        return len(self._pending) >= self.batch_size or (
+            bool(self._pending) and time.monotonic() - self._flushed >= self.interval)
+
+    async def flush(self) -> None:
+        pending, self._pending = self._pending, []
+        self._flushed = time.monotonic()
+        if self.ledger is not None and pending:
+            self.ledger.write([result for _, result in pending])
+        pending, self._unstored = self._unstored + pending, []
+        if not pending:
+            return
+        if self.use_database:
+            events = [event for _, result in pending for event in result.events(self.sender)]
+            try:
+                await _database.execute_transaction(_database.status_statements(events))
+            except Exception as e:
+                self._unstored = pending
+                logger.error("Storing %d result(s) in the database failed, they are kept for the next batch: %s",
+                             len(pending), e)
+                return
+        self.checkpoint.add([relative for relative, result in pending if result.status != 'Failed'])
+
+
+class Progress:
+    def __init__(self, total: int, interval: float):
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.failed = 0
+        self.bytes = 0
+        self.started = time.monotonic()
+        self._reported = self.started
+
+    def update(self, result: Result) -> None:
+        self.done += 1
+        self.bytes += result.file_size
+        if result.status == 'Failed':
+            self.failed += 1
+
+    def report(self, force: bool = False) -> None:
+        current = time.monotonic()
+        if not force and current - self._reported < self.interval:
+            return
+        self._reported = current
+        elapsed = max(current - self.started, 1e-9)
+        rate = self.done / elapsed
+        eta = f"{(self.total - self.done) / rate:.0f} s" if rate else '-'
+        print(f"{self.done}/{self.total} document(s), {self.failed} failed, {rate:.1f} doc/s, "
+              f"{self.bytes / elapsed / 1048576:.1f} MB/s, ETA {eta}", file=sys.stderr, flush=True)
+
+
+async def run(args) -> int:
+    checkpoint = Checkpoint(args.checkpoint or os.path.join(args.output, CHECKPOINT_NAME), args.resume)
+    sources = [(source, relative) for source, relative in iter_sources(args.input) if relative not in checkpoint]
+    if checkpoint.done:
+        logger.info("Resuming, %d document(s) were signed before.", len(checkpoint.done))
+
+    ledger = Ledger(args.ledger) if args.ledger else None
+    recorder = Recorder(args.sender, not args.no_db, ledger, checkpoint, args.batch_size, args.flush_interval)
+    progress = Progress(len(sources), args.progress_interval)
+    semaphore = asyncio.Semaphore(args.in_flight)
+    tasks = set()
+
+    async def process(source: str, relative: str) -> None:
+        try:
+            target = output_target(args.output, relative)
+            if target is None:
+                result = Result(source, relative, str(uuid.uuid4()), now())
+                result.fail(f"Output path {relative} is outside of {args.output}")
+                result.finished = result.received
+            else:
+                result = await sign_document(source, target, args.cert)
+        finally:
+            semaphore.release()
+        if result.status == 'Failed':
+            logger.warning("%s - %s", source, result.message, extra={"uuid": result.uuid})
+        recorder.add(relative, result)
+        progress.update(result)
+
+    try:
+        for source, relative in sources:
+            await semaphore.acquire()
+            task = asyncio.create_task(process(source, relative))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            if recorder.due():
+                await recorder.flush()
+            progress.report()
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        try:
+            await recorder.flush()
+        finally:
+            checkpoint.close()
+            if ledger is not None:
+                ledger.close()
+            progress.report(force=True)
+
+    if recorder.unstored:
+        logger.error("%d result(s) could not be stored in the database and are not checkpointed; they are in the "
+                     "ledger and will be signed again with --resume.", recorder.unstored)
+        return 1
+    return 1 if progress.failed else 0
+
+
+def load_certificate(name: str) -> Optional[Certificate]:
+    """Loads a configured certificate from its PFX file in DIR_CERTIFICATE, for --no-db."""
+    configured = parse_certificates(CERTIFICATES)
+    if name not in configured:
+        print(f"Unknown certificate: {name}. Configured: {', '.join(configured) or 'none'}", file=sys.stderr)
+        return None
+    try:
+        return Certificate(name, configured[name], use_database=False)
+    except CertificateError as e:
+        print(e, file=sys.stderr)
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', help='Directory of PDFs (searched recursively) or a manifest with one path per line')
+    parser.add_argument('--output', required=True, help='Directory for the signed files')
+    parser.add_argument('--cert', required=True, help='Name of the certificate to sign with')
+    parser.add_argument('--sender', default='bulk_sign', help='Sender recorded in Documents')
+    parser.add_argument('--workers', type=int, default=SIGNING_WORKERS, help='Signing processes')
+    parser.add_argument('--in-flight', type=int, default=0, help='Documents processed at once (default 2 x workers)')
+    parser.add_argument('--ledger', help='Append the results to this CSV (.csv) or JSON lines file')
+    parser.add_argument('--no-db', action='store_true', help='Do not record the results in the database')
+    parser.add_argument('--checkpoint', help=f'Checkpoint file (default OUTPUT/{CHECKPOINT_NAME})')
+    parser.add_argument('--resume', action='store_true', help='Skip the documents listed in the checkpoint')
+    parser.add_argument('--batch-size', type=int, default=200, help='Results stored per database transaction')
+    parser.add_argument('--flush-interval', type=float, default=5, help='Store results at least this often (s)')
+    parser.add_argument('--progress-interval', type=float, default=5, help='Seconds between progress lines')
+    args = parser.parse_args(argv)
+    args.workers = max(1, args.workers)
+    args.in_flight = args.in_flight or 2 * args.workers
+    return args
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    if not os.path.exists(args.input):
+        print(f"Input not found: {args.input}", file=sys.stderr)
+        return 2
+
+    if args.no_db:
+        cert = load_certificate(args.cert)
+    else:
+        maintenance.create_tables()
+        maintenance.check_certificates()
+        cert = CERTS.get(args.cert)
+        if cert is None:
+            print(f"Unknown certificate: {args.cert}. Configured: {', '.join(CERTS) or 'none'}", file=sys.stderr)
+    if cert is None:
+        return 2
+
+    engine.start({args.cert: cert}, args.workers)
+    try:
+        return asyncio.run(run(args))
+    except KeyboardInterrupt:
+        print("Interrupted, continue with --resume.", file=sys.stderr)
+        return 130
+    finally:
+        engine.shutdown()
+        _database.pool.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,185 @@
+# delivery.py
+
+""" Push delivery of signed documents to TotalAgility (KTA).
+With [KTA] PUSH enabled, every saved document is POSTed to the KTA endpoint of its sender ([KTA] SENDERS,
+"name url" pairs separated by commas) or to [KTA] URL, so integrated senders do not need to poll /get_signed.
+Requests share one keep-alive connection pool and at most CONCURRENCY run at once. Network errors, 408, 429
+and 5xx answers are retried with exponential backoff; a document that cannot be delivered gets the
+'DeadLetter' status and stays available on /get_signed until the janitor expires it.
+
+The request body is the signed PDF, the headers carry uuid and sender. A delivered file is removed and the
+document becomes 'Transmitted'. Documents still 'Saved' at startup are delivered again.
+"""
+
+import os
+import time
+import random
+import asyncio
+from contextlib import suppress
+from typing import Optional
+import httpx
+from _logger import logger
+from _config import (KTA_API_URL, KTA_PUSH, KTA_SENDERS, KTA_CONCURRENCY, KTA_RETRIES, KTA_BACKOFF,
+                     KTA_BACKOFF_MAX, KTA_TIMEOUT, DOWNLOAD_CHUNK_SIZE)
+from _metrics import observe_stage
+from _storage import storage
+from janitor import janitor
+from status_cache import record_status
+
+RETRY_STATUS_CODES = (408, 429)
+
+
+def parse_sender_urls(value: str) -> dict:
+    """Parses 'sender url, sender url'. Sender names may contain spaces, the URL is the last word."""
+    urls = {}
+    for entry in value.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        name, separator, url = entry.rpartition(' ')
+        if not separator or not name.strip():
+            logger.error(f"Error parsing KTA sender URL: '{entry}'")
+            continue
+        urls[name.strip()] = url
+    return urls
+
+
+class DeliveryFailed(Exception):
+    def __init__(self, message: str, retry: bool):
+        super().__init__(message)
+        self.retry = retry
+
+
+class Delivery:
+    def __init__(self, enabled: bool, default_url: str, sender_urls: dict, concurrency: int, retries: int,
+                 backoff: float, backoff_max: float, timeout: float):
+        self.enabled = enabled
+        self.default_url = default_url.strip()
+        self.sender_urls = sender_urls
+        self.concurrency = max(1, concurrency)
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self._client = None
+        self._semaphore = None
+        self._tasks = set()
+        self.delivered = 0
+        self.retried = 0
+        self.dead_lettered = 0
+
+    @property
+    def running(self) -> bool:
+        return self._client is not None
+
+    def url(self, sender: Optional[str]) -> Optional[str]:
+        """Returns the endpoint the documents of sender are pushed to, or None if they are collected by polling."""
+        if not self.enabled:
+            return None
+        return self.sender_urls.get(sender) or self.default_url or None
+
+    def submit(self, file_uuid, sender: Optional[str], size: int) -> bool:
+        """Starts the delivery of a saved document. Returns False if its sender is not pushed to."""
+        url = self.url(sender)
+        if url is None or not self.running:
+            return False
+        # Until it is delivered or dead-lettered, the file must not expire.
+        janitor.forget(file_uuid)
+        task = asyncio.create_task(self._deliver(str(file_uuid).lower(), sender, size, url))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def start(self) -> None:
+        if not self.enabled:
+            return
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        self._client = httpx.AsyncClient(limits=limits, timeout=self.timeout)
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        logger.info(f"KTA delivery started, {len(self.sender_urls)} sender URL(s), concurrency {self.concurrency}.")
+
+    async def stop(self) -> None:
+        """Cancels pending deliveries; their documents stay 'Saved' and are delivered after the next start."""
+        for task in list(self._tasks):
+            task.cancel()
+        for task in list(self._tasks):
+            with suppress(asyncio.CancelledError):
+                await task
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "pending": len(self._tasks),
+            "delivered": self.delivered,
+            "retried": self.retried,
+            "dead_lettered": self.dead_lettered,
+        }
+
+    async def _deliver(self, file_uuid: str, sender: Optional[str], size: int, url: str) -> None:
+        started = time.perf_counter()
+        attempt = 0
+        while True:
+            try:
+                async with self._semaphore:
+                    await self._post(file_uuid, sender, url)
+                break
+            except DeliveryFailed as e:
+                error, retry = str(e), e.retry
+            except FileNotFoundError:
+                logger.warning(f"UUID: {file_uuid} - signed file disappeared before it was delivered to KTA.")
+                return
+            except httpx.HTTPError as e:
+                error, retry = f"{type(e).__name__}: {e}", True
+            except Exception as e:
+                error, retry = f"{type(e).__name__}: {e}", False
+
+            attempt += 1
+            if not retry or attempt > self.retries:
+                await self._dead_letter(file_uuid, sender, size, error, attempt)
+                return
+            self.retried += 1
+            delay = min(self.backoff_max, self.backoff * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+            logger.warning(f"UUID: {file_uuid} - KTA delivery attempt {attempt} failed ({error}), "
+                           f"retrying in {delay:.1f} s.")
+            await asyncio.sleep(delay)
+
+        observe_stage('push', time.perf_counter() - started)
+        self.delivered += 1
+        await asyncio.to_thread(storage.delete, file_uuid)
+        message = 'Signed file was delivered to KTA.'
+        await record_status(file_uuid, 'Transmitted', message, sender=sender)
+        logger.info("UUID: %s - Delivered to KTA.", file_uuid, extra={"uuid": file_uuid, "sender": sender})
+
+    async def _post(self, file_uuid: str, sender: Optional[str], url: str) -> None:
+        file = await asyncio.to_thread(storage.open, file_uuid)
+        try:
+            size = os.fstat(file.fileno()).st_size
+
+            async def body():
+                while chunk := await asyncio.to_thread(file.read, DOWNLOAD_CHUNK_SIZE):
+                    yield chunk
+
+            headers = {"Content-Type": "application/pdf", "Content-Length": str(size),
+                       "uuid": file_uuid, "sender": sender or ''}
+            response = await self._client.post(url, content=body(), headers=headers)
+        finally:
+            file.close()
+        if response.is_success:
+            return
+        retry = response.status_code in RETRY_STATUS_CODES or response.status_code >= 500
+        raise DeliveryFailed(f"KTA answered {response.status_code}", retry)
+
+    async def _dead_letter(self, file_uuid: str, sender: Optional[str], size: int, error: str, attempts: int) -> None:
+        self.dead_lettered += 1
+        # Left for the client to collect, the janitor removes it after the usual retention.
+        janitor.register(file_uuid, size, sender=sender)
+        message = f'Delivery to KTA failed after {attempts} attempt(s): {error}'
+        await record_status(file_uuid, 'DeadLetter', message, sender=sender)
+        logger.error("UUID: %s - %s", file_uuid, message, extra={"uuid": file_uuid, "sender": sender})
+
+
+delivery = Delivery(KTA_PUSH, KTA_API_URL, parse_sender_urls(KTA_SENDERS), KTA_CONCURRENCY, KTA_RETRIES,
+                    KTA_BACKOFF, KTA_BACKOFF_MAX, KTA_TIMEOUT)
@@ -0,0 +1,256 @@
+# download_handler.py
+
+""" Helpers for /get_signed downloads: HEAD, byte ranges and conditional requests.
+A signed file is no longer removed as soon as a response was started. The byte ranges sent to the client
+are collected per document and only once the whole file was sent it is handed to the janitor, which removes
+it after a grace window and records 'Transmitted'. An interrupted download can be resumed with a Range request.
+
+/get_signed_batch streams several files as one ZIP archive, built while it is sent: entries are stored
+uncompressed (PDFs are compressed already) and every file is read in chunks, so neither the archive nor a
+whole file is held in memory. The files are handed to the janitor together once the archive was sent.
+"""
+
+import os
+import re
+import json
+import time
+import asyncio
+import zipfile
+from typing import Optional
+from collections import OrderedDict
+from fastapi.responses import Response, StreamingResponse
+from _logger import logger
+from _config import DOWNLOAD_GRACE, DOWNLOAD_CHUNK_SIZE
+from _storage import storage
+from _metrics import observe_stage
+from janitor import janitor
+from status_cache import record_status
+
+
+_BYTE_RANGE = re.compile(r'([0-9]*)-([0-9]*)')
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header: Optional[str], size: int):
+    """Returns the (start, end) byte positions, end inclusive, requested by a Range header.
+
+    Returns None when the whole file should be sent: no header, a unit other than bytes, a malformed value
+    or several ranges (answered with the complete file, which RFC 9110 allows). Raises RangeNotSatisfiable
+    when the range lies outside the file.
+    """
+    if not header or not header.strip().lower().startswith('bytes='):
+        return None
+    spec = header.strip()[6:].strip()
+    if ',' in spec:
+        return None
+    match = _BYTE_RANGE.fullmatch(spec)
+    if match is None or match.group() == '-':
+        return None
+    first, last = match.groups()
+    if not first:
+        length = int(last)
+        if length == 0 or size == 0:
+            raise RangeNotSatisfiable()
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if start >= size:
+        raise RangeNotSatisfiable()
+    if end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    """Weak comparison of an If-None-Match or If-Range header with the entity tag of the file."""
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    bare = etag[2:] if etag.startswith('W/') else etag
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if (candidate[2:] if candidate.startswith('W/') else candidate) == bare:
+            return True
+    return False
+
+
+def file_etag(file_uuid, stat: os.stat_result) -> str:
+    # Files stored before entity tags were written get a weak tag from their size and modification time.
+    return storage.etag(file_uuid) or f'W/"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+class DeliveryTracker:
+    """Byte ranges of every file that were sent to the client, merged per document."""
+
+    def __init__(self, max_entries: int = 10_000):
+        self.max_entries = max_entries
+        self._sent = OrderedDict()
+
+    def add(self, file_uuid, start: int, end: int, size: int) -> bool:
+        """Records that bytes start..end (inclusive) were sent. Returns True once the whole file was sent."""
+        key = str(file_uuid).lower()
+        ranges = sorted(self._sent.get(key, []) + [(start, end + 1)])
+        merged = [ranges[0]]
+        for low, high in ranges[1:]:
+            if low <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], high))
+            else:
+                merged.append((low, high))
+        if merged[0][0] == 0 and merged[0][1] >= size:
+            self._sent.pop(key, None)
+            return True
+        self._sent[key] = merged
+        self._sent.move_to_end(key)
+        while len(self._sent) > self.max_entries:
+            # Downloads abandoned half-way; their files expire through the janitor.
+            self._sent.popitem(last=False)
+        return False
+
+    def forget(self, file_uuid) -> None:
+        self._sent.pop(str(file_uuid).lower(), None)
+
+    def __len__(self) -> int:
+        return len(self._sent)
+
+
+deliveries = DeliveryTracker()
+
+
+def head_response(file_uuid, path: str, headers: dict) -> Response:
+    stat = os.stat(path)
+    headers = dict(headers, **{"ETag": file_etag(file_uuid, stat), "Accept-Ranges": "bytes",
+                               "Content-Length": str(stat.st_size)})
+    return Response(status_code=200, headers=headers, media_type='application/pdf')
+
+
+async def file_response(file_uuid, path: str, range_header: Optional[str], if_range: Optional[str],
+                        if_none_match: Optional[str], headers: dict) -> Response:
+    """Builds the response for a GET of a stored signed file. Raises FileNotFoundError if the file is gone."""
+    file = await asyncio.to_thread(open, path, 'rb')
+    try:
+        stat = os.fstat(file.fileno())
+        size = stat.st_size
+        etag = file_etag(file_uuid, stat)
+        headers = dict(headers, **{"ETag": etag, "Accept-Ranges": "bytes"})
+
+        if etag_matches(if_none_match, etag):
+            file.close()
+            return Response(status_code=304, headers=headers)
+
+        byte_range = None
+        if range_header and (not if_range or etag_matches(if_range, etag)):
+            try:
+                byte_range = parse_range(range_header, size)
+            except RangeNotSatisfiable:
+                file.close()
+                headers["Content-Range"] = f"bytes */{size}"
+                return Response(status_code=416, headers=headers)
+    except BaseException:
+        file.close()
+        raise
+
+    start, end = byte_range if byte_range else (0, size - 1)
+    headers["Content-Length"] = str(end - start + 1)
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    body = _send(file, file_uuid, start, end, size)
+    return StreamingResponse(body, status_code=206 if byte_range else 200, headers=headers,
+                             media_type='application/pdf')
+
+
+async def _send(file, file_uuid, start: int, end: int, size: int):
+    started = time.perf_counter()
+    try:
+        file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await asyncio.to_thread(file.read, min(DOWNLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                return
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+    # Reached only after the server asked for more data following the last chunk, i.e. it was sent.
+    if deliveries.add(file_uuid, start, end, size):
+        seconds = time.perf_counter() - started
+        observe_stage('deliver', seconds)
+        janitor.delivered(file_uuid, size, DOWNLOAD_GRACE)
+        logger.info("UUID: %s - Transmitted to the client, removal in %s s.", file_uuid, DOWNLOAD_GRACE,
+                    extra={"uuid": str(file_uuid), "stage": 'deliver', "duration_ms": round(seconds * 1000, 3)})
+
+
+class _ZipSink:
+    """Write-only, unseekable target of the ZIP writer; the bytes written so far are taken out as chunks."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def take(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def zip_response(file_uuids: list, manifest: list, headers: dict) -> StreamingResponse:
+    """Streams the stored files of file_uuids as {uuid}.pdf entries of a ZIP archive.
+
+    manifest lists the documents that are not included, with their status or an error; files that disappear
+    before they are read are added to it. It is written as the last entry, manifest.json.
+    """
+    return StreamingResponse(_send_zip(file_uuids, manifest), headers=headers, media_type='application/zip')
+
+
+async def _send_zip(file_uuids: list, manifest: list):
+    started = time.perf_counter()
+    sink = _ZipSink()
+    archive = zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED)
+    sent = []
+    try:
+        for file_uuid in file_uuids:
+            try:
+                file = await asyncio.to_thread(storage.open, file_uuid)
+            except FileNotFoundError:
+                message = 'Signed file is no longer on disk.'
+                janitor.forget(file_uuid)
+                await record_status(file_uuid, 'Expired', message)
+                manifest.append({"uuid": file_uuid, "status": 'Expired', "message": message})
+                continue
+            try:
+                stat = os.fstat(file.fileno())
+                info = zipfile.ZipInfo(f'{file_uuid}.pdf', time.localtime(stat.st_mtime)[:6])
+                # The size known in advance lets the writer switch to ZIP64 for files above 4 GB.
+                info.file_size = stat.st_size
+                with archive.open(info, 'w') as entry:
+                    while chunk := await asyncio.to_thread(file.read, DOWNLOAD_CHUNK_SIZE):
+                        entry.write(chunk)
+                        yield sink.take()
+            finally:
+                file.close()
+            sent.append((file_uuid, stat.st_size))
+            yield sink.take()
+        archive.writestr('manifest.json', json.dumps({"included": [file_uuid for file_uuid, _ in sent],
+                                                      "missing": manifest}, indent=2))
+        archive.close()
+        yield sink.take()
+    finally:
+        archive.close()
+
+    # As with single downloads, reached only once the whole archive was sent.
+    for file_uuid, size in sent:
+        deliveries.forget(file_uuid)
+        janitor.delivered(file_uuid, size, DOWNLOAD_GRACE)
+    seconds = time.perf_counter() - started
+    logger.info("Transmitted %d file(s) in one archive, removal in %s s.", len(sent), DOWNLOAD_GRACE,
+                extra={"stage": 'deliver', "duration_ms": round(seconds * 1000, 3)})
@@ -0,0 +1,182 @@
+# idempotency.py
+
+""" Idempotency keys for /sign.
+A client that retries /sign after a timeout gets the UUID of the document it already sent instead of
+having it received, validated and signed again. The key is the Idempotency-Key header of the request or,
+with [IDEMPOTENCY] AUTO, the SHA-256 of the certificate name, the sender and the body. Both are scoped by
+the sender and the certificate, so a key reused with another certificate is a new document.
+
+A request claims its key by inserting it into IdempotencyKeys before it registers its document; the primary
+key makes the claim atomic across workers and nodes. A retry gets the UUID of the holder only once that
+document is registered; while the first request is still running it gets InProgress (409). A claim is
+released when its request fails, and taken over when its document failed, when it is older than
+[IDEMPOTENCY] TTL, or when its document was never registered within PENDING_TIMEOUT seconds (a crashed
+request). Registered documents are kept in a bounded in-memory cache, so a retry to the same process
+costs no claim query.
+"""
+
+import time
+import asyncio
+import hashlib
+from datetime import datetime, timedelta
+from collections import OrderedDict
+import pyodbc
+import _database
+from _logger import logger
+from _config import IDEMPOTENCY_TTL, IDEMPOTENCY_MAX_ENTRIES, IDEMPOTENCY_AUTO
+from status_cache import current_status
+
+
+MAX_KEY_LENGTH = 255
+# Seconds after which a claim without a registered document is considered abandoned.
+PENDING_TIMEOUT = 600
+# Seconds between purges of expired claims.
+PURGE_INTERVAL = 600
+
+
+class InProgress(Exception):
+    """Another request holding the same key has not registered its document yet."""
+
+
+class IdempotencyCache:
+    """Bounded LRU of idempotency key -> document UUID with per-entry expiry."""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.replays = 0
+        self.conflicts = 0
+
+    def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            return None
+        return entry[1]
+
+    def put(self, key: str, file_uuid: str) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl, str(file_uuid).lower())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def drop(self, key: str) -> None:
+        self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "replays": self.replays,
+            "conflicts": self.conflicts,
+        }
+
+
+cache = IdempotencyCache(IDEMPOTENCY_MAX_ENTRIES, IDEMPOTENCY_TTL)
+_background = set()
+_purged = time.monotonic()
+
+
+def request_key(sender: str, cert_name: str, idempotency_key: str):
+    """Returns the stored form of an Idempotency-Key header, or None when the header is absent."""
+    if not idempotency_key:
+        return None
+    return hashlib.sha256(b'key\0' + sender.encode() + b'\0' + cert_name.encode() + b'\0'
+                          + idempotency_key.encode()).hexdigest()
+
+
+def content_digest(cert_name: str, sender: str):
+    """Returns a hashlib object to be fed with the body when automatic keys are enabled, else None."""
+    if not IDEMPOTENCY_AUTO:
+        return None
+    return hashlib.sha256(b'body\0' + cert_name.encode() + b'\0' + sender.encode() + b'\0')
+
+
+def _timestamp(seconds_ago: float = 0) -> str:
+    return (datetime.now() - timedelta(seconds=seconds_ago)).isoformat(timespec='milliseconds')
+
+
+async def _insert(key: str, file_uuid: str) -> bool:
+    try:
+        await _database.execute_query(_database.insert_IdempotencyKey, (key, file_uuid, _timestamp()))
+    except pyodbc.IntegrityError:
+        return False
+    return True
+
+
+async def claim(key: str, file_uuid: str):
+    """Claims key for file_uuid. Returns the UUID of the registered document that holds the key, or None
+    when file_uuid now holds it. Raises InProgress while the holder has not registered its document."""
+    _purge_expired()
+    original = cache.get(key)
+    if original is not None:
+        status = await current_status(original)
+        if status is not None and status[0] != 'Failed':
+            cache.replays += 1
+            return original
+        cache.drop(key)
+
+    for _ in range(3):
+        if await _insert(key, file_uuid):
+            return None
+        row = await _database.fetch_sql(_database.select_IdempotencyKey, (_timestamp(cache.ttl),
+                                                                          _timestamp(PENDING_TIMEOUT), key))
+        if row is None:
+            # Released in the meantime.
+            continue
+        holder, live, recent = str(row[0]).lower(), row[1], row[2]
+        status = await current_status(holder) if live else None
+        if status is not None and status[0] != 'Failed':
+            cache.put(key, holder)
+            cache.replays += 1
+            return holder
+        if live and status is None and recent:
+            cache.conflicts += 1
+            raise InProgress("A request with the same idempotency key is still in progress.")
+        # Expired, failed or abandoned: take the key over unless another request does so first.
+        await _database.execute_query(_database.update_IdempotencyKey, (file_uuid, _timestamp(), key, row[0]))
+        row = await _database.fetch_sql(_database.select_IdempotencyKey, (_timestamp(cache.ttl),
+                                                                          _timestamp(PENDING_TIMEOUT), key))
+        if row is not None and str(row[0]).lower() == file_uuid.lower():
+            return None
+    cache.conflicts += 1
+    raise InProgress("A request with the same idempotency key is still in progress.")
+
+
+def registered(key: str, file_uuid: str) -> None:
+    """Remembers that the document holding key is registered, so retries are answered from memory."""
+    if key:
+        cache.put(key, file_uuid)
+
+
+def release(key: str, file_uuid: str) -> None:
+    """Gives up the claim of a request that did not register its document.
+
+    The claim is deleted in the background, so a cancelled request can release it as well; if that fails,
+    the claim is taken over after PENDING_TIMEOUT.
+    """
+    if key:
+        _spawn(_database.execute_query(_database.delete_IdempotencyKey, (key, file_uuid)), 'release')
+
+
+def _purge_expired() -> None:
+    global _purged
+    if time.monotonic() - _purged < PURGE_INTERVAL:
+        return
+    _purged = time.monotonic()
+    _spawn(_database.execute_query(_database.delete_expired_IdempotencyKeys, (_timestamp(cache.ttl),)), 'purge')
+
+
+def _spawn(coroutine, action: str) -> None:
+    async def run():
+        try:
+            await coroutine
+        except Exception as e:
+            logger.warning(f"Failed to {action} idempotency keys: {e}")
+
+    task = asyncio.get_running_loop().create_task(run())
+    _background.add(task)
+    task.add_done_callback(_background.discard)
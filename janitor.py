@@ -0,0 +1,184 @@
+# janitor.py
+
+""" Expiry of signed files waiting for collection in the signed-file storage.
+Every saved file is registered with its expiry time in a heap, so the janitor sleeps until the next file
+expires and only ever touches the files that do. The heap is rebuilt from the storage at startup.
+With a disk budget the oldest files are evicted early once signed files take more space than allowed.
+Removed files get the 'Expired' status, so /get_signed can tell the client what happened.
+
+On shared storage the files saved by other nodes are unknown to the heap; a periodic sweep over
+storage.list_expired (SWEEP_INTERVAL) covers them when a node goes away.
+"""
+
+import time
+import heapq
+import asyncio
+from contextlib import suppress
+from _logger import logger
+from _config import JANITOR_RETENTION, JANITOR_DISK_BUDGET, JANITOR_SWEEP_INTERVAL
+from _storage import storage
+from status_cache import record_status
+
+
+# Status recorded when a file is removed: (status, message).
+EXPIRED = ('Expired', 'Signed file was not collected in time and was removed.')
+EVICTED = ('Expired', 'Signed file was removed to keep within the disk budget.')
+TRANSMITTED = ('Transmitted', 'File was sent back to the client.')
+
+
+class Janitor:
+    def __init__(self, storage, retention: float, disk_budget: int, sweep_interval: float = 0):
+        self.storage = storage
+        self.retention = retention
+        self.disk_budget = disk_budget
+        self.sweep_interval = sweep_interval
+        # (expires, uuid) entries; entries of forgotten or re-registered files are skipped when they surface.
+        self._heap = []
+        self._files = {}
+        self.bytes = 0
+        self.expired = 0
+        self.evicted = 0
+        self._wakeup = None
+        self._tasks = []
+
+    @staticmethod
+    def key(file_uuid) -> str:
+        return str(file_uuid).lower()
+
+    def register(self, file_uuid, size: int, saved: float = None, sender: str = None) -> None:
+        """Starts tracking a signed file, saved is its modification time (default now). The sender, when known,
+        is passed on with the status recorded at its removal."""
+        self._track(file_uuid, size, (time.time() if saved is None else saved) + self.retention, None, sender)
+
+    def delivered(self, file_uuid, size: int, grace: float) -> None:
+        """Schedules the removal of a file that was sent completely to the client. It stays available
+        for grace seconds for a repeated download, its removal records the 'Transmitted' status."""
+        entry = self._files.get(self.key(file_uuid))
+        self._track(file_uuid, size, time.time() + grace, TRANSMITTED, entry[3] if entry else None)
+
+    def _track(self, file_uuid, size: int, expires: float, outcome: tuple, sender: str) -> None:
+        key = self.key(file_uuid)
+        self.forget(key)
+        self._files[key] = (expires, size, outcome, sender)
+        heapq.heappush(self._heap, (expires, key))
+        self.bytes += size
+        if self._wakeup is not None and (self._heap[0][1] == key or self.over_budget()):
+            self._wakeup.set()
+
+    def forget(self, file_uuid) -> None:
+        """Stops tracking a file that was removed by somebody else, e.g. after transmission."""
+        entry = self._files.pop(self.key(file_uuid), None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def over_budget(self) -> bool:
+        return bool(self.disk_budget) and self.bytes > self.disk_budget
+
+    async def start(self) -> None:
+        self._wakeup = asyncio.Event()
+        found = await asyncio.to_thread(lambda: list(self.storage.scan()))
+        for key, size, saved in found:
+            self.register(key, size, saved)
+        logger.info(f"Janitor is tracking {len(found)} signed file(s), {self.bytes} B.")
+        self._tasks = [asyncio.create_task(self._run())]
+        if self.sweep_interval > 0:
+            self._tasks.append(asyncio.create_task(self._sweep()))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+        self._tasks = []
+
+    def stats(self) -> dict:
+        next_expiry = self._next_delay()
+        return {
+            "files": len(self._files),
+            "bytes": self.bytes,
+            "disk_budget": self.disk_budget,
+            "retention": self.retention,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "next_expiry_in": round(next_expiry, 3) if next_expiry is not None else None,
+        }
+
+    async def _run(self) -> None:
+        while True:
+            due = self._take_due(time.time())
+            if due:
+                try:
+                    await self._remove(due)
+                except Exception as e:
+                    logger.error(f"Janitor failed to remove {len(due)} file(s): {e}")
+            delay = self._next_delay()
+            self._wakeup.clear()
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+
+    async def _sweep(self) -> None:
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                found = await asyncio.to_thread(
+                    lambda: [item[0] for item in self.storage.list_expired(time.time() - self.retention)]
+                )
+                for key in found:
+                    self.forget(key)
+                if found:
+                    await self._remove([(key, EXPIRED, None) for key in found])
+            except Exception as e:
+                logger.error(f"Janitor sweep failed: {e}")
+
+    def _next_delay(self):
+        while self._heap:
+            expires, key = self._heap[0]
+            entry = self._files.get(key)
+            if entry is not None and entry[0] == expires:
+                return 0 if self.over_budget() else max(0.0, expires - time.time())
+            heapq.heappop(self._heap)
+        return None
+
+    def _take_due(self, now: float) -> list:
+        """Pops the files that expired or, while over budget, the oldest ones. Returns (uuid, outcome, sender)."""
+        due = []
+        while self._heap:
+            expires, key = self._heap[0]
+            entry = self._files.get(key)
+            if entry is None or entry[0] != expires:
+                heapq.heappop(self._heap)
+                continue
+            if expires > now and not self.over_budget():
+                break
+            heapq.heappop(self._heap)
+            del self._files[key]
+            self.bytes -= entry[1]
+            due.append((key, entry[2] or (EXPIRED if expires <= now else EVICTED), entry[3]))
+        return due
+
+    async def _remove(self, due: list) -> None:
+        removed = await asyncio.to_thread(self._unlink, [key for key, _, _ in due])
+        for key, outcome, sender in due:
+            if key not in removed:
+                continue
+            if outcome is EXPIRED:
+                self.expired += 1
+            elif outcome is EVICTED:
+                self.evicted += 1
+            await record_status(key, *outcome, sender=sender)
+        if removed:
+            logger.info(f"Janitor removed {len(removed)} signed file(s).")
+
+    def _unlink(self, keys: list) -> set:
+        removed = set()
+        for key in keys:
+            try:
+                # False when the file was transmitted or removed by another node in the meantime.
+                if self.storage.delete(key):
+                    removed.add(key)
+            except OSError as e:
+                logger.error(f"Problem with deleting signed file {key}: {e}")
+        return removed
+
+
+janitor = Janitor(storage, JANITOR_RETENTION, JANITOR_DISK_BUDGET, JANITOR_SWEEP_INTERVAL)
@@ -0,0 +1,340 @@
+# job_queue.py
+
+""" Bounded, durable queue of signing jobs.
+Payloads are persisted to DIR_TEMP together with a small job file, so that documents which were
+not finished before a restart can be re-enqueued on startup by maintenance.recover_jobs.
+
+Senders are scheduled fairly: every sender is admitted through a token bucket ([SCHEDULER] RATE and BURST)
+and an optional depth limit, and the signers take jobs by weighted fair queueing across senders, so a
+sender with thousands of queued documents cannot hold back the next document of another sender.
+Limits and weights can be overridden per sender in [SENDER:<sender>] sections. The state of other senders
+is dropped once they are idle, and their throttling is counted under the metric label 'other'.
+"""
+
+import os
+import json
+import math
+import time
+import heapq
+import asyncio
+from itertools import count
+from dataclasses import dataclass, field
+from _logger import logger
+from _config import (DIR_TEMP, QUEUE_WORKERS, QUEUE_MAX_DEPTH, SCHEDULER_RATE, SCHEDULER_BURST, SCHEDULER_WEIGHT,
+                     SCHEDULER_SENDER_MAX_DEPTH, SENDER_LIMITS)
+from _payload import Payload, upload_path
+from sign_handler import sign_flow
+from status_cache import record_status, current_status
+from _metrics import registry, Gauge, Counter, observe_stage
+
+
+# Jobs of a higher priority are always taken first, fair queueing applies within a priority.
+PRIORITIES = {'interactive': 0, 'normal': 1, 'bulk': 2}
+DEFAULT_PRIORITY = 'normal'
+
+# Seconds between sweeps for idle sender states.
+SENDER_SWEEP_INTERVAL = 60
+
+THROTTLED_TOTAL = registry.register(Counter(
+    'imsign_throttled_total', 'Documents refused by the per-sender admission control.', ('sender',)
+))
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Throttled(Exception):
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def job_path(file_uuid) -> str:
+    return f"{DIR_TEMP}/{file_uuid}.job"
+
+
+@dataclass
+class SigningJob:
+    file_uuid: str
+    cert_name: str
+    sender: str
+    payload: Payload
+    priority: str = DEFAULT_PRIORITY
+    enqueued: float = field(default_factory=time.monotonic)
+
+    def persist(self) -> None:
+        self.payload.persist(upload_path(self.file_uuid))
+        with open(job_path(self.file_uuid), 'w') as file:
+            json.dump({"cert_name": self.cert_name, "sender": self.sender, "size": self.payload.size,
+                       "priority": self.priority}, file)
+
+    def forget(self) -> None:
+        self.payload.discard()
+        try:
+            os.remove(job_path(self.file_uuid))
+        except FileNotFoundError:
+            pass
+
+    @classmethod
+    def load(cls, file_uuid: str):
+        """Rebuilds a persisted job, returns None if its files are gone."""
+        try:
+            with open(job_path(file_uuid), 'r') as file:
+                meta = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return None
+        if not os.path.exists(upload_path(file_uuid)):
+            return None
+        payload = Payload(path=upload_path(file_uuid), size=meta["size"])
+        return cls(file_uuid, meta["cert_name"], meta["sender"], payload, meta.get("priority", DEFAULT_PRIORITY))
+
+
+class TokenBucket:
+    """Allows rate documents per second on average and bursts of up to burst documents."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def take(self, amount: int = 1) -> float:
+        """Takes amount tokens. Returns 0 on success, otherwise the seconds until they are available.
+
+        A request larger than the burst (a batch) is let through once the bucket is full and leaves it in debt.
+        """
+        current = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (current - self.updated) * self.rate)
+        self.updated = current
+        needed = min(amount, self.burst)
+        if self.tokens >= needed:
+            self.tokens -= amount
+            return 0.0
+        return (needed - self.tokens) / self.rate
+
+    def full(self) -> bool:
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.burst
+
+
+class SenderState:
+    def __init__(self, rate: float, burst: float, weight: float, max_depth: int):
+        self.bucket = TokenBucket(rate, burst) if rate > 0 else None
+        self.weight = weight if weight > 0 else 1.0
+        self.max_depth = max_depth
+        self.depth = 0
+        self.finish = 0.0
+        self.admitted = 0
+        self.throttled = 0
+        self.processed = 0
+
+    def idle(self, virtual: float) -> bool:
+        """True if dropping this state and starting afresh would not change how the sender is treated."""
+        return self.depth == 0 and self.finish <= virtual and (self.bucket is None or self.bucket.full())
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth,
+            "weight": self.weight,
+            "admitted": self.admitted,
+            "throttled": self.throttled,
+            "processed": self.processed,
+            "tokens": round(self.bucket.tokens, 2) if self.bucket else None,
+        }
+
+
+class FairQueue:
+    """Jobs ordered by priority and, within a priority, by start-time fair queueing across senders.
+
+    A job is tagged with the virtual time at which its sender's previous job finishes (or the current virtual
+    time if the sender is idle) plus 1 / weight. Taking the job with the lowest tag serves backlogged senders
+    in proportion to their weights, and a newly arriving sender waits at most for the jobs already being signed.
+    """
+
+    def __init__(self, sender_state):
+        self._sender_state = sender_state
+        self._heap = []
+        self._sequence = count()
+        self._virtual = 0.0
+        self._available = asyncio.Semaphore(0)
+
+    def qsize(self) -> int:
+        return len(self._heap)
+
+    @property
+    def virtual(self) -> float:
+        return self._virtual
+
+    def put_nowait(self, job: SigningJob) -> None:
+        state = self._sender_state(job.sender)
+        tag = max(self._virtual, state.finish) + 1.0 / state.weight
+        state.finish = tag
+        state.depth += 1
+        heapq.heappush(self._heap, (PRIORITIES.get(job.priority, PRIORITIES[DEFAULT_PRIORITY]), tag,
+                                    next(self._sequence), job))
+        self._available.release()
+
+    async def get(self) -> SigningJob:
+        await self._available.acquire()
+        _, tag, _, job = heapq.heappop(self._heap)
+        self._virtual = max(self._virtual, tag - 1.0 / self._sender_state(job.sender).weight)
+        self._sender_state(job.sender).depth -= 1
+        return job
+
+
+class SigningQueue:
+    """Fair queue of signing jobs drained by a fixed number of concurrent signers."""
+
+    def __init__(self, workers: int, max_depth: int, limits: tuple, sender_limits: dict):
+        self.workers = max(1, workers)
+        self.max_depth = max_depth
+        self.limits = limits
+        self.sender_limits = sender_limits
+        self._senders = {}
+        self._swept = time.monotonic()
+        self._queue = None
+        self._tasks = []
+        self._active = 0
+        self._processed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._run_total = 0.0
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def has_capacity(self, count: int = 1) -> bool:
+        return self.depth + count <= self.max_depth
+
+    def retry_after(self) -> int:
+        """Seconds the signers need to work off a tenth of the backlog, estimated from the average job duration."""
+        if not self._processed:
+            return 1
+        average = self._run_total / self._processed
+        return min(60, max(1, round(average * self.depth / 10 / self.workers)))
+
+    def sender(self, sender: str) -> SenderState:
+        state = self._senders.get(sender)
+        if state is None:
+            state = self._senders[sender] = SenderState(*self.sender_limits.get(sender, self.limits))
+        return state
+
+    def _sweep(self) -> None:
+        """Drops idle states of senders without configured limits, so the table does not grow with every sender."""
+        current = time.monotonic()
+        if self._queue is None or current - self._swept < SENDER_SWEEP_INTERVAL:
+            return
+        self._swept = current
+        # With nothing queued no finish tag can matter any more.
+        virtual = self._queue.virtual if self._queue.qsize() else math.inf
+        idle = [sender for sender, state in self._senders.items()
+                if sender not in self.sender_limits and state.idle(virtual)]
+        for sender in idle:
+            del self._senders[sender]
+        if idle:
+            logger.debug(f"Dropped the scheduler state of {len(idle)} idle sender(s).")
+
+    def admit(self, sender: str, count: int = 1) -> None:
+        """Takes count documents of sender through its rate limit and depth limit. Raises Throttled if refused."""
+        self._sweep()
+        state = self.sender(sender)
+        if state.max_depth and state.depth + count > state.max_depth:
+            self._throttle(state, sender, count)
+            raise Throttled(f"Sender {sender} has {state.depth} document(s) queued, the limit is {state.max_depth}.",
+                            self.retry_after())
+        wait = state.bucket.take(count) if state.bucket else 0.0
+        if wait:
+            self._throttle(state, sender, count)
+            raise Throttled(f"Sender {sender} exceeds its rate of {state.bucket.rate:g} document(s) per second.",
+                            max(1, math.ceil(wait)))
+        state.admitted += count
+
+    def _throttle(self, state: SenderState, sender: str, count: int) -> None:
+        state.throttled += count
+        THROTTLED_TOTAL.inc(count, sender=sender if sender in self.sender_limits else 'other')
+
+    def start(self) -> None:
+        self._queue = FairQueue(self.sender)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"Signing queue started with {self.workers} signer(s), maximum depth {self.max_depth}.")
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Jobs left in the queue are persisted and will be recovered on the next startup.
+        logger.info(f"Signing queue stopped, {self.depth} job(s) left for recovery.")
+
+    async def submit(self, job: SigningJob) -> None:
+        if not self.has_capacity():
+            raise QueueFull(f"Signing queue is full ({self.max_depth} jobs).")
+        await asyncio.to_thread(job.persist)
+        self._queue.put_nowait(job)
+
+    def resume(self, job: SigningJob) -> None:
+        """Enqueues an already persisted job, ignoring the depth limit."""
+        self._queue.put_nowait(job)
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "workers": self.workers,
+            "active": self._active,
+            "processed": self._processed,
+            "wait_avg_ms": round(self._wait_total / self._processed * 1000, 3) if self._processed else 0.0,
+            "wait_max_ms": round(self._wait_max * 1000, 3),
+            "senders": {sender: state.stats() for sender, state in self._senders.items()},
+        }
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            state = self.sender(job.sender)
+            started = time.monotonic()
+            waited = started - job.enqueued
+            self._active += 1
+            try:
+                logger.debug("UUID: %s - waited %.3f s in the signing queue.", job.file_uuid, waited,
+                             extra={"uuid": job.file_uuid, "sender": job.sender, "cert_name": job.cert_name,
+                                    "stage": 'queue_wait', "duration_ms": round(waited * 1000, 3)})
+                observe_stage('queue_wait', waited, job.cert_name)
+                await sign_flow(job.payload, job.cert_name, job.file_uuid, job.sender)
+                await asyncio.to_thread(job.forget)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("UUID: %s - signing job failed: %s", job.file_uuid, e, extra={"uuid": job.file_uuid})
+                await self._abandon(job)
+            finally:
+                self._active -= 1
+                self._processed += 1
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+                self._run_total += time.monotonic() - started
+                state.processed += 1
+                self._sweep()
+
+    @staticmethod
+    async def _abandon(job: SigningJob) -> None:
+        """Marks a job whose signing flow raised as failed, unless it reached a final status, and drops its files,
+        so it is not signed again by every restart."""
+        try:
+            status = await current_status(job.file_uuid)
+            if status is None or status[0] in ('Received', 'Signed'):
+                message = 'Failed to sign the file'
+                await record_status(job.file_uuid, 'Failed', message, sender=job.sender)
+        except Exception as e:
+            logger.error("UUID: %s - unable to record the failure: %s", job.file_uuid, e,
+                         extra={"uuid": job.file_uuid})
+        await asyncio.to_thread(job.forget)
+
+
+signing_queue = SigningQueue(QUEUE_WORKERS, QUEUE_MAX_DEPTH,
+                             (SCHEDULER_RATE, SCHEDULER_BURST, SCHEDULER_WEIGHT, SCHEDULER_SENDER_MAX_DEPTH),
+                             SENDER_LIMITS)
+
+registry.register(Gauge('imsign_queue_depth', 'Signing jobs waiting in the queue.', lambda: signing_queue.depth))
+registry.register(Gauge('imsign_inflight_jobs', 'Signing jobs being processed.', lambda: signing_queue.stats()["active"]))
@@ -1,18 +1,31 @@
 # main.py
 
-from _logger import logger, logging_config
-import os
+from _logger import logger
+import hmac
+import json
 import uuid
+import asyncio
 from pydantic import BaseModel
 from _cert import CERTS
-from _config import DIR_TEMP
+from _config import ADMIN_TOKEN, NOTIFY_MAX_WAIT, NOTIFY_HEARTBEAT, STATUS_MAX_UUIDS, DOWNLOAD_BATCH_MAX_FILES
+from _payload import receive, PayloadTooLarge
 import _database
 import maintenance
-from sign_handler import sign_flow
-from validators import valid_file, sanitize_input
-from fastapi import FastAPI, BackgroundTasks, Header, Request, HTTPException
-from fastapi.responses import JSONResponse
-from starlette.responses import FileResponse
+from _engine import verification_engine
+import idempotency
+from job_queue import signing_queue, SigningJob, QueueFull, Throttled, PRIORITIES, DEFAULT_PRIORITY
+from status_cache import record_status, current_status, current_statuses, cache as status_cache
+from batch_handler import BatchError, collect_batch, validate_batch, register_batch
+from validators import valid_file, sanitize_input, MAX_SENDER_LENGTH
+from notifier import hub
+from janitor import janitor
+from delivery import delivery
+from _storage import storage
+from download_handler import head_response, file_response, zip_response, deliveries
+from _metrics import registry, stage
+from typing import Optional, List
+from fastapi import FastAPI, Header, Request, HTTPException, Query
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 
 app = FastAPI()
 
@@ -20,65 +33,344 @@ app = FastAPI()
 logger.info("Initializing maintenance.")
 app.add_event_handler("startup", maintenance.check_directories)
 app.add_event_handler("startup", maintenance.create_tables)
+app.add_event_handler("startup", maintenance.start_status_writer)
+app.add_event_handler("startup", maintenance.start_janitor)
 app.add_event_handler("startup", maintenance.check_certificates)
-app.add_event_handler("startup", maintenance.start_scheduler)
-app.add_event_handler("shutdown", maintenance.shutdown_scheduler)
+app.add_event_handler("startup", maintenance.start_signing_engine)
+app.add_event_handler("startup", maintenance.start_verification_engine)
+app.add_event_handler("startup", maintenance.start_certificate_reloader)
+app.add_event_handler("startup", maintenance.start_signing_queue)
+app.add_event_handler("startup", maintenance.recover_jobs)
+app.add_event_handler("startup", maintenance.start_delivery)
+app.add_event_handler("shutdown", maintenance.shutdown_certificate_reloader)
+app.add_event_handler("shutdown", maintenance.shutdown_delivery)
+app.add_event_handler("shutdown", maintenance.shutdown_janitor)
+app.add_event_handler("shutdown", maintenance.shutdown_signing_queue)
+app.add_event_handler("shutdown", maintenance.shutdown_signing_engine)
+app.add_event_handler("shutdown", maintenance.shutdown_verification_engine)
+app.add_event_handler("shutdown", maintenance.shutdown_status_writer)
+app.add_event_handler("shutdown", maintenance.close_database_pool)
 
 
 class SignResponse(BaseModel):
     uuid: str
 
 
+class UUIDList(BaseModel):
+    uuids: List[str]
+
+
 @app.post("/sign", response_model=SignResponse, summary="Sign a file")
 async def sign(
         request: Request,
-        background_tasks: BackgroundTasks,
         sender: str = Header(..., description="The identifier of the file sender", alias='sender'),
         cert_name: str = Header(..., description="The name of the certificate to use for signing the file",
-                                alias='cert-name')
+                                alias='cert-name'),
+        idempotency_key: Optional[str] = Header(None, description="Client chosen key that identifies the document "
+                                                "across retries of this request", alias='Idempotency-Key'),
+        priority: str = Header(DEFAULT_PRIORITY, description="Signing priority: interactive, normal or bulk",
+                               alias='priority')
 ) -> JSONResponse:
     """
     Sign a file using a specified certificate and return the file UUID along with HTTP headers indicating the task status.
+    The file is handed to the signing queue. When the queue is full, 503 with a Retry-After header is returned,
+    when the sender exceeds its rate or queue share, 429 with a Retry-After header.
 
-    - **request**: FastAPI request object containing the file sent by the client.
-    - **background_tasks**: Background tasks for asynchronous operations.
+    - **request**: FastAPI request object containing the file sent by the client. The body is streamed and
+      rejected with 413 as soon as it exceeds the size limit.
     - **sender**: Sender identifier, provided through a request header.
     - **cert_name**: Certificate name for signing, provided through a request header.
+    - **idempotency_key**: Optional. A retry with the same key and certificate (or, with automatic keys enabled,
+      the same body, certificate and sender) within the idempotency window returns the UUID of the first request
+      with the header Idempotent-Replayed: true, and the file is not signed again. While the first request is
+      still being received, the retry gets 409 with a Retry-After header.
+    - **priority**: Optional. Interactive documents are signed before normal and bulk ones.
     """
-    sender = sanitize_input(sender)
+    sender = check_sender(sanitize_input(sender))
     cert_name = sanitize_input(cert_name)
+    priority = check_priority(priority)
     file_uuid = str(uuid.uuid4())
-    logger.info(f"Sender {sender} queued a new file with UUID: {file_uuid}. Required certificate: {cert_name}")
-
-    content = await request.body()
-    file_size = len(content)
+    document = {"uuid": file_uuid, "sender": sender, "cert_name": cert_name}
+    logger.info("Sender %s queued a new file with UUID: %s. Required certificate: %s", sender, file_uuid, cert_name,
+                extra=document)
 
     if cert_name not in CERTS:
         msg = f"Required certificate is unknown: {cert_name}."
         logger.warning(msg)
         raise HTTPException(status_code=400, detail=msg)
 
-    if not await valid_file(content):
-        msg = f"Invalid file. Check the file integrity or size limit 20 MB. UUID: {file_uuid}"
+    if idempotency_key is not None and len(idempotency_key) > idempotency.MAX_KEY_LENGTH:
+        msg = f"Idempotency-Key is longer than {idempotency.MAX_KEY_LENGTH} characters."
+        logger.warning(msg)
+        raise HTTPException(status_code=400, detail=msg)
+
+    key = idempotency.request_key(sender, cert_name, idempotency_key)
+    if key:
+        try:
+            original = await idempotency.claim(key, file_uuid)
+        except idempotency.InProgress as e:
+            raise in_progress(e, file_uuid)
+        if original:
+            return replayed(original, file_uuid)
+
+    if not signing_queue.has_capacity():
+        idempotency.release(key, file_uuid)
+        raise queue_full(file_uuid)
+    try:
+        signing_queue.admit(sender)
+    except Throttled as e:
+        idempotency.release(key, file_uuid)
+        raise throttled(e, file_uuid)
+
+    try:
+        digest = None if key else idempotency.content_digest(cert_name, sender)
+        try:
+            with stage('receive', cert_name) as timing:
+                payload = await receive(request, file_uuid, digest=digest)
+        except PayloadTooLarge as e:
+            msg = f"{e} UUID: {file_uuid}"
+            logger.warning(msg, extra=document)
+            raise HTTPException(status_code=413, detail=msg)
+        logger.debug("UUID: %s - received %d B.", file_uuid, payload.size,
+                     extra=dict(document, stage='receive', duration_ms=timing.ms))
+
+        if digest is not None:
+            key = digest.hexdigest()
+            try:
+                original = await idempotency.claim(key, file_uuid)
+            except idempotency.InProgress as e:
+                payload.discard()
+                raise in_progress(e, file_uuid)
+            if original:
+                payload.discard()
+                return replayed(original, file_uuid)
+
+        validation = await valid_file(payload)
+        if not validation:
+            payload.discard()
+            msg = f"Invalid file, failed check: {validation.failed_check}. " \
+                  f"Check the file integrity or size limit 20 MB. UUID: {file_uuid}"
+            logger.warning(msg, extra=document)
+            raise HTTPException(status_code=400, detail=msg)
+
+        try:
+            with stage('db_insert', cert_name):
+                await record_status(file_uuid, 'Received', 'Received file from the client',
+                                    created=True, file_size=payload.size, sender=sender)
+            idempotency.registered(key, file_uuid)
+            logger.info("Registered new document UUID: %s.", file_uuid, extra=document)
+        except OSError as e:
+            payload.discard()
+            msg = f"Unable to journal the document UUID: {file_uuid}. Error: {e}"
+            logger.error(msg, extra=document)
+            raise HTTPException(status_code=500, headers={"Task-Status": "Failed"}, detail=msg)
+    except BaseException:
+        idempotency.release(key, file_uuid)
+        raise
+
+    try:
+        await signing_queue.submit(SigningJob(file_uuid, cert_name, sender, payload, priority))
+    except QueueFull:
+        payload.discard()
+        await record_status(file_uuid, 'Failed', 'Signing queue is full')
+        raise queue_full(file_uuid)
+
+    return JSONResponse(content={"uuid": file_uuid}, headers={"Task-Status": "Completed"}, status_code=200)
+
+
+@app.post("/sign_batch", summary="Sign a batch of files")
+async def sign_batch(
+        request: Request,
+        sender: str = Header(..., description="The identifier of the file sender", alias='sender'),
+        cert_name: str = Header(..., description="The name of the certificate to use for signing the files",
+                                alias='cert-name'),
+        priority: str = Header(DEFAULT_PRIORITY, description="Signing priority: interactive, normal or bulk",
+                               alias='priority')
+) -> JSONResponse:
+    """
+    Sign several files with one certificate. The files are sent either as parts of a multipart/form-data body
+    or packed in a ZIP archive (Content-Type: application/zip). All valid files are registered in one
+    database transaction and queued together.
+
+    Returns a list with the UUID or the validation error of every file, in the order they were received.
+    The whole batch counts against the sender's rate limit; when it is exceeded, 429 is returned.
+    """
+    sender = check_sender(sanitize_input(sender))
+    cert_name = sanitize_input(cert_name)
+    priority = check_priority(priority)
+
+    if cert_name not in CERTS:
+        msg = f"Required certificate is unknown: {cert_name}."
         logger.warning(msg)
         raise HTTPException(status_code=400, detail=msg)
 
+    if not signing_queue.has_capacity():
+        raise queue_full("batch")
+
     try:
-        await _database.execute_query(_database.insert_Documents, (file_uuid, None, file_size, sender))
-        await _database.execute_query(_database.insert_DocumentsHistory,
-                                      (file_uuid, 'Received', 'Received file from the client'))
-        logger.info(f"Inserted new document UUID: {file_uuid} into database.")
+        items = await collect_batch(request)
+    except PayloadTooLarge as e:
+        logger.warning(f"Batch from {sender} rejected: {e}")
+        raise HTTPException(status_code=413, detail=str(e))
+    except BatchError as e:
+        logger.warning(f"Batch from {sender} rejected: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+
+    await validate_batch(items)
+    accepted = [item for item in items if item.payload is not None]
+
+    if not signing_queue.has_capacity(len(accepted)):
+        for item in accepted:
+            item.payload.discard()
+        raise queue_full("batch")
+    try:
+        signing_queue.admit(sender, len(accepted))
+    except Throttled as e:
+        for item in accepted:
+            item.payload.discard()
+        raise throttled(e, "batch")
+
+    try:
+        await register_batch(items, sender)
     except Exception as e:
-        msg = f"Database operation failed for UUID: {file_uuid}. Error: {e}"
+        for item in accepted:
+            item.payload.discard()
+        msg = f"Database operation failed for batch from {sender}. Error: {e}"
         logger.error(msg)
         raise HTTPException(status_code=500, headers={"Task-Status": "Failed"}, detail=msg)
 
-    background_tasks.add_task(sign_flow, content, cert_name, file_uuid)
+    for item in accepted:
+        try:
+            await signing_queue.submit(SigningJob(item.file_uuid, cert_name, sender, item.payload, priority))
+        except QueueFull:
+            item.reject("Signing queue is full.")
+            await record_status(item.file_uuid, 'Failed', 'Signing queue is full')
 
-    return JSONResponse(content={"uuid": file_uuid}, headers={"Task-Status": "Completed"}, status_code=200)
+    logger.info(f"Sender {sender} queued a batch of {len(accepted)} file(s) out of {len(items)}. "
+                f"Required certificate: {cert_name}")
+    return JSONResponse(content={"documents": [item.result() for item in items]},
+                        headers={"Task-Status": "Completed"}, status_code=200)
+
+
+def replayed(original: str, file_uuid: str) -> JSONResponse:
+    logger.info("Request %s repeats document UUID: %s, returning its UUID.", file_uuid, original,
+                extra={"uuid": original})
+    return JSONResponse(content={"uuid": original}, headers={"Task-Status": "Completed", "Idempotent-Replayed": "true"},
+                        status_code=200)
+
+
+def in_progress(e: idempotency.InProgress, file_uuid: str) -> HTTPException:
+    msg = f"{e} UUID: {file_uuid}"
+    logger.warning(msg)
+    return HTTPException(status_code=409, detail=msg, headers={"Retry-After": "1", "Task-Status": "Failed"})
+
+
+def queue_full(file_uuid: str) -> HTTPException:
+    msg = f"Signing queue is full, try again later. UUID: {file_uuid}"
+    logger.warning(msg)
+    return HTTPException(status_code=503, detail=msg,
+                         headers={"Retry-After": str(signing_queue.retry_after()), "Task-Status": "Failed"})
+
+
+def throttled(e: Throttled, file_uuid: str) -> HTTPException:
+    msg = f"{e} Try again later. UUID: {file_uuid}"
+    logger.warning(msg)
+    return HTTPException(status_code=429, detail=msg,
+                         headers={"Retry-After": str(e.retry_after), "Task-Status": "Failed"})
+
+
+def check_admin(admin_token: Optional[str]) -> None:
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if admin_token is None or not hmac.compare_digest(admin_token.encode(), ADMIN_TOKEN.encode()):
+        logger.warning("Rejected an admin request with a missing or wrong token.")
+        raise HTTPException(status_code=403, detail="Invalid admin token.")
+
+
+def check_sender(sender: str) -> str:
+    if len(sender) > MAX_SENDER_LENGTH:
+        msg = f"Sender is longer than {MAX_SENDER_LENGTH} characters."
+        logger.warning(msg)
+        raise HTTPException(status_code=400, detail=msg)
+    return sender
+
+
+def check_priority(priority: str) -> str:
+    priority = priority.strip().lower()
+    if priority not in PRIORITIES:
+        msg = f"Unknown priority: {priority}. Use one of: {', '.join(PRIORITIES)}."
+        logger.warning(msg)
+        raise HTTPException(status_code=400, detail=msg)
+    return priority
+
+
+@app.post("/verify", summary="Verify the signatures of a PDF file")
+async def verify(request: Request) -> JSONResponse:
+    """
+    Verify every signature of the PDF file sent as the request body. For each signature the signer, whether the
+    digest and the signature match the signed bytes, and whether the signer's chain leads to a trusted
+    certificate (the signing certificates of this service, [VERIFY] TRUST_DIR and, unless disabled,
+    the system bundle) are returned. The document is valid when it has signatures and all of them are.
+    """
+    label = f"verify-{uuid.uuid4()}"
+    try:
+        payload = await receive(request, label)
+    except PayloadTooLarge as e:
+        logger.warning(f"Verification rejected: {e}")
+        raise HTTPException(status_code=413, detail=str(e))
+    try:
+        result = await verify_payload(payload)
+    finally:
+        payload.discard()
+    if "error" in result:
+        raise HTTPException(status_code=400, detail=result["error"])
+    return JSONResponse(content=result, status_code=200)
 
 
-@app.get("/get_signed/{file_uuid}", responses={
+@app.post("/verify_batch", summary="Verify the signatures of several PDF files")
+async def verify_batch(request: Request) -> JSONResponse:
+    """
+    Verify several PDF files sent as parts of a multipart/form-data body or packed in a ZIP archive.
+    The files are verified in parallel by the verification workers. Returns the result of every file,
+    as /verify does, in the order they were received.
+    """
+    try:
+        items = await collect_batch(request)
+    except PayloadTooLarge as e:
+        logger.warning(f"Verification batch rejected: {e}")
+        raise HTTPException(status_code=413, detail=str(e))
+    except BatchError as e:
+        logger.warning(f"Verification batch rejected: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+
+    async def verify_item(item) -> dict:
+        if item.payload is None:
+            return {"file": item.name, "error": item.error}
+        try:
+            return dict({"file": item.name}, **await verify_payload(item.payload))
+        finally:
+            item.payload.discard()
+
+    results = await asyncio.gather(*[verify_item(item) for item in items])
+    logger.info(f"Verified a batch of {len(items)} file(s).")
+    return JSONResponse(content={"documents": results}, status_code=200)
+
+
+async def verify_payload(payload) -> dict:
+    try:
+        with stage('verify'):
+            signatures = await verification_engine.verify(payload)
+    except Exception as e:
+        logger.warning(f"Verification failed: {e}")
+        return {"error": f"Unable to verify the file: {e}"}
+    valid = bool(signatures) and all(
+        signature.get("digest_valid") and signature.get("signature_valid") and signature.get("chain_valid")
+        for signature in signatures
+    )
+    return {"valid": valid, "signatures": signatures}
+
+
+@app.api_route("/get_signed/{file_uuid}", methods=["GET", "HEAD"], responses={
     200: {
         "description": "Returns the signed PDF file to the client.",
         "content": {"application/pdf": {}}
@@ -86,6 +378,13 @@ async def sign(
     202: {
         "description": "File is still being processed. Try again later."
     },
+    206: {
+        "description": "Returns the requested byte range of the signed PDF file.",
+        "content": {"application/pdf": {}}
+    },
+    304: {
+        "description": "The client already has the file (If-None-Match)."
+    },
     400: {
         "description": "Invalid UUID format provided."
     },
@@ -93,75 +392,255 @@ async def sign(
         "description": "File not found or no such UUID in database."
     },
     410: {
-        "description": "File was processed and removed from the server."
+        "description": "File was transmitted, or expired before it was collected, and was removed from the server."
+    },
+    416: {
+        "description": "The requested byte range lies outside the file."
     },
     422: {
         "description": "Error processing the file due to internal state."
     }
 })
-async def get_signed(file_uuid: str, background_tasks: BackgroundTasks):
+async def get_signed(file_uuid: str, request: Request):
     """
-    Retrieve a signed PDF file by its UUID. This endpoint checks the file's status in the database,
+    Retrieve a signed PDF file by its UUID. This endpoint checks the file's status in the status cache or the database,
     ensures the file exists on disk, and sends it to the client. If the file is not ready or encounters
     issues, appropriate status messages and codes are returned.
+
+    HEAD returns the headers only. The ETag is the digest of the signature; Range (with If-Range) resumes an
+    interrupted download and If-None-Match answers 304. The file is removed a short grace window after all of
+    its bytes were sent, and the status becomes 'Transmitted'.
     """
     try:
         file_uuid = uuid.UUID(file_uuid)
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid UUID format.", headers={"Task-Status": "Failed"})
 
-    status = await _database.fetch_sql(_database.check_file_status, file_uuid)
+    status = await current_status(file_uuid)
 
     if not status:
-        logger.warning(f'UUID: {file_uuid} - No such UUID in database.')
+        logger.warning('UUID: %s - No such UUID in database.', file_uuid, extra={"uuid": file_uuid})
         raise HTTPException(status_code=404, detail="No such UUID in database.", headers={"Task-Status": "Failed"})
 
-    elif status[0] == 'Saved':
-        file_path = f"{DIR_TEMP}/{file_uuid}.pdf"
-
-        if not os.path.exists(file_path):
-            logger.warning(f'UUID: {file_uuid} - Can\'t locate file on disk.')
-            raise HTTPException(status_code=404, detail="Oooops! File was lost.", headers={"Task-Status": "Failed"})
-
-        response = FileResponse(path=file_path, headers={"Task-Status": "Completed"})
-        background_tasks.add_task(handle_file_post_send, file_uuid, file_path)
-
-        logger.info(f'UUID: {file_uuid} - Transmitted to the client.')
+    # With shared storage another node may have saved the file while this node still knows an earlier status.
+    # A 'DeadLetter' document could not be pushed to KTA and is left for the client to collect.
+    elif status[0] in ('Saved', 'DeadLetter') or (
+            status[0] in ('Received', 'Signed') and storage.exists(file_uuid)):
+        file_path = storage.path(file_uuid)
+        headers = {"Task-Status": "Completed"}
+
+        try:
+            if request.method == 'HEAD':
+                return await asyncio.to_thread(head_response, file_uuid, file_path, headers)
+            response = await file_response(file_uuid, file_path, request.headers.get('range'),
+                                           request.headers.get('if-range'), request.headers.get('if-none-match'),
+                                           headers)
+        except FileNotFoundError:
+            message = 'Signed file is no longer on disk.'
+            logger.warning('UUID: %s - %s', file_uuid, message, extra={"uuid": file_uuid, "status": 'Expired'})
+            janitor.forget(file_uuid)
+            await record_status(file_uuid, 'Expired', message)
+            return JSONResponse(content={"warning": message}, headers={"Task-Status": "Failed"}, status_code=410)
+
+        logger.info('UUID: %s - Sending to the client (%d).', file_uuid, response.status_code,
+                    extra={"uuid": file_uuid, "status": status[0]})
 
         return response
 
     elif status[0] == 'Failed':
         error_message = status[1] if len(status) > 1 else "File processing failed with an unknown error."
-        logger.warning(f'UUID: {file_uuid} - {error_message}')
+        logger.warning('UUID: %s - %s', file_uuid, error_message, extra={"uuid": file_uuid, "status": status[0]})
         return JSONResponse(content={"error": error_message}, headers={"Task-Status": "Failed"}, status_code=422)
 
     elif status[0] == 'Transmitted':
         warning = "File was processed, transmitted to the client and removed from the database."
-        logger.warning(f'UUID: {file_uuid} - {warning}')
+        logger.warning('UUID: %s - %s', file_uuid, warning, extra={"uuid": file_uuid, "status": status[0]})
         return JSONResponse(content={"warning": warning}, headers={"Task-Status": "Failed"}, status_code=410)
 
+    elif status[0] == 'Expired':
+        logger.warning('UUID: %s - %s', file_uuid, status[1], extra={"uuid": file_uuid, "status": status[0]})
+        return JSONResponse(content={"warning": status[1]}, headers={"Task-Status": "Failed"}, status_code=410)
+
     elif status[0] in ['Received', 'Signed']:
         message = f'The file is still being processed, please try again later. Current status: {status[0]}'
-        logger.info(f'UUID: {file_uuid} - {message}')
+        # Clients poll this, so only a sample of the polls is logged.
+        logger.info('UUID: %s - %s', file_uuid, message, extra={"uuid": file_uuid, "status": status[0], "sample": True})
         return JSONResponse(content={"status": message}, headers={"Task-Status": "In Progress"}, status_code=202)
 
     else:
-        logger.error(f'Status for {file_uuid} is {status}')
+        logger.error('Status for %s is %s', file_uuid, status, extra={"uuid": file_uuid})
         raise HTTPException(status_code=404, detail="Unexpected status", headers={"Task-Status": "Failed"})
 
 
-async def handle_file_post_send(file_uuid: uuid.UUID, file_path: str):
+@app.post("/get_signed_batch", summary="Download several signed files as one ZIP archive", responses={
+    200: {
+        "description": "ZIP archive with the signed files as {uuid}.pdf and manifest.json listing the documents "
+                       "that are not included.",
+        "content": {"application/zip": {}}
+    },
+    400: {
+        "description": "Too many UUIDs."
+    }
+})
+async def get_signed_batch(body: UUIDList):
+    """
+    Retrieve up to [DOWNLOAD] BATCH_MAX_FILES signed files in one response. The archive is built while it is
+    streamed, with uncompressed entries. Documents that are unknown, still being processed, failed or already
+    removed are listed in manifest.json with their status. Once the archive was sent completely, the included
+    files are removed after the usual grace window and become 'Transmitted', as with /get_signed.
+    """
+    if len(body.uuids) > DOWNLOAD_BATCH_MAX_FILES:
+        msg = f"Too many UUIDs: {len(body.uuids)}, the limit is {DOWNLOAD_BATCH_MAX_FILES}."
+        logger.warning(msg)
+        raise HTTPException(status_code=400, detail=msg)
+
+    file_uuids = []
+    manifest = []
+    for value in body.uuids:
+        try:
+            file_uuid = str(uuid.UUID(value))
+        except ValueError:
+            manifest.append({"uuid": value, "error": "Invalid UUID format."})
+            continue
+        if file_uuid not in file_uuids:
+            file_uuids.append(file_uuid)
+
+    statuses = await current_statuses(file_uuids)
+    included = []
+    for file_uuid in file_uuids:
+        status = statuses.get(file_uuid)
+        if status is None:
+            manifest.append({"uuid": file_uuid, "status": None, "message": "No such UUID in database."})
+        elif status[0] in ('Saved', 'DeadLetter') or (
+                status[0] in ('Received', 'Signed') and storage.exists(file_uuid)):
+            included.append(file_uuid)
+        else:
+            manifest.append({"uuid": file_uuid, "status": status[0], "message": status[1]})
+
+    logger.info("Sending %d of %d requested file(s) in one archive.", len(included), len(body.uuids))
+    return zip_response(included, manifest, {"Task-Status": "Completed",
+                                             "Content-Disposition": 'attachment; filename="signed.zip"'})
+
+
+# A 'DeadLetter' document is final and can be collected from /get_signed like a 'Saved' one.
+COMPLETED_STATUSES = ('Saved', 'DeadLetter')
+READY_STATUSES = COMPLETED_STATUSES + ('Failed', 'Transmitted', 'Expired')
+
+
+@app.get("/wait/{file_uuid}", responses={
+    200: {"description": "The document reached a final status."},
+    202: {"description": "The timeout expired while the document is still being processed."},
+    400: {"description": "Invalid UUID format provided."},
+    404: {"description": "No such UUID in database."}
+})
+async def wait_signed(file_uuid: str, timeout: float = Query(30, ge=0, description="Seconds to wait at most")):
+    """
+    Long-poll for the completion of a document. Returns as soon as the signed file is saved or processing fails,
+    or after the timeout with the current status. Fetch the file afterwards from /get_signed/{file_uuid}.
+    """
+    try:
+        file_uuid = str(uuid.UUID(file_uuid))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid UUID format.", headers={"Task-Status": "Failed"})
+
+    # Register before reading the status, so a completion in between is not missed.
+    waiter = hub.register(file_uuid)
     try:
-        os.remove(file_path)
-    except (PermissionError, FileNotFoundError) as e:
-        logger.error(f"Problem with deleting file {e}.")
-    else:
-        logger.info(f"File {file_path} has been removed from disk after transmission.")
+        status = await current_status(file_uuid)
+        if not status:
+            raise HTTPException(status_code=404, detail="No such UUID in database.", headers={"Task-Status": "Failed"})
+        if status[0] not in READY_STATUSES:
+            try:
+                status = await asyncio.wait_for(waiter, min(timeout, NOTIFY_MAX_WAIT))
+            except asyncio.TimeoutError:
+                return JSONResponse(content={"uuid": file_uuid, "status": status[0], "message": status[1]},
+                                    headers={"Task-Status": "In Progress"}, status_code=202)
+    finally:
+        hub.unregister(file_uuid, waiter)
+
+    task_status = "Completed" if status[0] in COMPLETED_STATUSES else "Failed"
+    return JSONResponse(content={"uuid": file_uuid, "status": status[0], "message": status[1]},
+                        headers={"Task-Status": task_status}, status_code=200)
+
+
+@app.post("/status", summary="Look up the status of several documents")
+async def status_batch(body: UUIDList):
+    """
+    Return the current status and message of up to [STATUS] MAX_UUIDS documents, in the order of the request.
+    Unknown UUIDs get the status null, malformed ones an error. Statuses this node has in memory are answered
+    directly, the others with one database query per 1000 UUIDs.
+    """
+    if len(body.uuids) > STATUS_MAX_UUIDS:
+        msg = f"Too many UUIDs: {len(body.uuids)}, the limit is {STATUS_MAX_UUIDS}."
+        logger.warning(msg)
+        raise HTTPException(status_code=400, detail=msg)
 
-        await _database.execute_query(
-            _database.insert_DocumentsHistory, (file_uuid, 'Transmitted', 'File was sent back to the client.')
-        )
-        logger.info(f"Recorded in the database that file {file_uuid} was transmitted.")
+    parsed = {}
+    for value in body.uuids:
+        try:
+            parsed[value] = str(uuid.UUID(value))
+        except ValueError:
+            parsed[value] = None
+
+    statuses = await current_statuses(list({file_uuid for file_uuid in parsed.values() if file_uuid}))
+    documents = []
+    for value in body.uuids:
+        file_uuid = parsed[value]
+        if file_uuid is None:
+            documents.append({"uuid": value, "error": "Invalid UUID format."})
+            continue
+        status, message = statuses.get(file_uuid, (None, "No such UUID in database."))
+        documents.append({"uuid": file_uuid, "status": status, "message": message})
+
+    logger.debug("Status lookup of %d UUID(s), %d known.", len(body.uuids), len(statuses))
+    return JSONResponse(content={"documents": documents}, headers={"Task-Status": "Completed"}, status_code=200)
+
+
+@app.get("/events")
+async def events(request: Request,
+                 sender: Optional[str] = Query(None, description="Only documents of this sender"),
+                 uuids: Optional[str] = Query(None, description="Comma separated list of UUIDs to follow")):
+    """
+    Server-Sent-Events stream of completion notifications. Every event carries the UUID, the final status
+    (Saved, Failed, Transmitted, DeadLetter or Expired) and its message. A comment line is sent every few seconds
+    to keep idle connections open. Files found in the storage at startup expire without a known sender,
+    so only streams without a sender filter get those events.
+    """
+    uuid_filter = None
+    if uuids:
+        try:
+            uuid_filter = {str(uuid.UUID(value.strip())) for value in uuids.split(',') if value.strip()}
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid UUID format.")
+    subscription = hub.subscribe(sanitize_input(sender) if sender else None, uuid_filter)
+
+    async def stream():
+        try:
+            yield ": connected\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscription.events.get(), NOTIFY_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event['status'].lower()}\ndata: {json.dumps(event)}\n\n"
+        finally:
+            hub.unsubscribe(subscription)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """
+    Metrics in the Prometheus text exposition format: per-stage latency histograms (by certificate),
+    database call latency, status transition counters, queue depth, in-flight jobs and temp directory size.
+    """
+    content = await asyncio.to_thread(registry.render)
+    return PlainTextResponse(content=content, media_type="text/plain; version=0.0.4; charset=utf-8")
 
 
 @app.get("/health")
@@ -178,8 +657,36 @@ async def health_check():
     return JSONResponse(content={"status": "Alive"}, status_code=200)
 
 
+@app.post("/admin/certificates/reload")
+async def reload_certificates(
+        admin_token: Optional[str] = Header(None, description="The token set in [ADMIN] TOKEN", alias='Admin-Token')
+):
+    """
+    Load new and renewed certificates from dbo.Certificates (and names added to [CERT] CERTIFICATES) now instead
+    of waiting for the next scheduled reload. Signatures in progress finish with the certificates they started with.
+    The endpoint is disabled (404) unless [ADMIN] TOKEN is set, and requires that token in the Admin-Token header.
+    """
+    check_admin(admin_token)
+    changed = await maintenance.reload_certificates()
+    return JSONResponse(content=dict(CERTS.stats(), changed=changed), status_code=200)
+
+
+@app.get("/stats")
+async def stats():
+    """
+    Runtime statistics of the signing queue, the status cache and the database connection pool.
+    """
+    return JSONResponse(content={"queue": signing_queue.stats(), "status_cache": status_cache.stats(),
+                                 "notifications": hub.stats(), "database": _database.pool.stats(),
+                                 "status_writer": _database.status_writer.stats(), "janitor": janitor.stats(),
+                                 "downloads_in_progress": len(deliveries), "idempotency": idempotency.cache.stats(),
+                                 "delivery": delivery.stats(), "certificates": CERTS.stats()},
+                        status_code=200)
+
+
 if __name__ == "__main__":
     logger.info("Starting FastAPI server")
     import uvicorn
 
-    uvicorn.run(app, host="127.0.0.1", port=8000, log_config=logging_config)
+    # The logging configured by _logger is kept, uvicorn's records go through the same queue and file.
+    uvicorn.run(app, host="127.0.0.1", port=8000, log_config=None)
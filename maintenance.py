@@ -7,71 +7,85 @@ and verify certificates based on configuration settings.
 
 import os
 import sys
+import asyncio
+from contextlib import suppress
 from _logger import logger
-from _config import DIR_TEMP
-from _database import execute_sql_sync, create_Documents, create_DocumentsHistory, create_Certificates
-from _cert import Certificate, CERTS
-from _config import CERTIFICATES
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from datetime import datetime, timedelta, timezone
+from _metrics import registry, Gauge
+from _config import DIR_TEMP, NODE_ID
+import _database
+from _database import (pool, execute_sql_sync, create_Documents, create_DocumentsHistory, create_Certificates,
+                       migrate_Documents_CurrentStatus, create_DocumentsHistory_index,
+                       create_IdempotencyKeys, migrate_Documents_Node)
+from _cert import CERTS, parse_certificates
+from _config import (CERTIFICATES, CERT_RELOAD_INTERVAL, read_certificates, SIGNING_WORKERS, VERIFY_WORKERS,
+                     VERIFY_TRUST_DIR, VERIFY_SYSTEM_TRUST, VERIFY_CACHE_SIZE, VERIFY_CACHE_TTL)
+from _engine import engine, verification_engine
+from cryptography.hazmat.primitives.serialization import Encoding
+from job_queue import signing_queue, SigningJob
+from _payload import Payload
+from status_cache import record_status
+from janitor import janitor
+from delivery import delivery
+from _storage import storage
 
 
-async def delete_old_files():
-    """
-    Asynchronously deletes files older than 5 days from a specified directory,
-    excluding files that start with a dot (hidden files).
-
-    This function scans through the directory specified by DIR_TEMP, checks each file to determine
-    if it is older than 5 days using the file creation timestamp. Files that start with a dot are
-    ignored to prevent deletion of system or hidden files. If a file meets the criteria, it is deleted.
+def temp_dir_bytes() -> int:
+    """Total size of the files in DIR_TEMP: pending uploads, persisted jobs and the status journal."""
+    total = 0
+    try:
+        with os.scandir(DIR_TEMP) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    try:
+                        total += entry.stat(follow_symlinks=False).st_size
+                    except FileNotFoundError:
+                        pass
+    except FileNotFoundError:
+        pass
+    return total
 
-    Exceptions for file deletion errors (e.g., PermissionError, FileNotFoundError) are caught and
-    logged as errors. Successful deletions are logged as informational messages.
 
-    Uses:
-        - `os`: To list files in the directory and to delete files.
-        - `datetime`: To calculate the age of files and to ensure all time calculations are in UTC.
-        - `logging`: To log information and errors related to file deletion.
+registry.register(Gauge('imsign_temp_dir_bytes', 'Bytes stored in the temporary directory.', temp_dir_bytes))
+registry.register(Gauge('imsign_signed_bytes', 'Bytes of signed files waiting for collection.', lambda: janitor.bytes))
 
-    Note:
-        - The function assumes that the file creation time can be retrieved accurately across
-          different operating systems.
-        - The function runs asynchronously and should be handled within an async event loop.
-    """
-    now = datetime.now(timezone.utc)
-    threshold = timedelta(minutes=5)
 
-    for filename in os.listdir(DIR_TEMP):
-        file_path = os.path.join(DIR_TEMP, filename)
-        if os.path.isfile(file_path) and not filename.startswith('.'):
-            file_creation_time = datetime.fromtimestamp(os.path.getctime(file_path), timezone.utc)
-            if now - file_creation_time > threshold:
-                try:
-                    os.remove(file_path)
-                except (PermissionError, FileNotFoundError) as e:
-                    logger.error(f"Problem with deleting file {file_path}: {e}")
-                else:
-                    logger.info(f"File {file_path} has been removed from disk after transmission.")
+async def start_janitor() -> None:
+    await janitor.start()
 
 
-scheduler = AsyncIOScheduler()
-scheduler.add_job(delete_old_files, 'interval', days=1)
-scheduler.start()
+async def shutdown_janitor() -> None:
+    await janitor.stop()
 
 
-def start_scheduler():
-    if not scheduler.running:
-        scheduler.start()
+async def start_delivery() -> None:
+    """Starts the push delivery to KTA and delivers again the documents this node saved but did not deliver
+    before the previous shutdown."""
+    await delivery.start()
+    if not delivery.running:
+        return
+    try:
+        rows = await _database.fetch_all_sql(_database.select_undelivered_Documents, [NODE_ID])
+    except Exception as e:
+        logger.error(f"Unable to look up undelivered documents: {e}")
+        return
+    resumed = 0
+    for file_uuid, sender in rows:
+        file_uuid = str(file_uuid).lower()
+        size = storage.size(file_uuid)
+        if size is not None and delivery.submit(file_uuid, sender, size):
+            resumed += 1
+    if resumed:
+        logger.info(f"Resumed the KTA delivery of {resumed} document(s).")
 
 
-def shutdown_scheduler():
-    if scheduler.running:
-        scheduler.shutdown()
+async def shutdown_delivery() -> None:
+    await delivery.stop()
 
 
 def check_directories() -> None:
     """Checks for the existence of the temporary directory specified in the configuration.
-    Creates the directory if it does not exist and logs the activity.
+    Creates the directory if it does not exist and logs the activity. Also creates the root of the signed-file
+    storage and moves signed files left in the temporary directory by the former flat layout into it.
 
     Raises:
         SystemExit: If the DIR_TEMP is not defined in the configuration.
@@ -86,6 +100,11 @@ def check_directories() -> None:
         else:
             logger.info('Temporary directory found.')
 
+    os.makedirs(storage.root, exist_ok=True)
+    moved = storage.adopt_flat(DIR_TEMP)
+    if moved:
+        logger.info(f"Moved {moved} signed file(s) from {DIR_TEMP} to the sharded storage in {storage.root}.")
+
 
 def create_tables() -> None:
     """Attempts to create necessary database tables by executing SQL commands.
@@ -97,33 +116,165 @@ def create_tables() -> None:
     try:
         execute_sql_sync(create_Documents)
         execute_sql_sync(create_DocumentsHistory)
+        execute_sql_sync(migrate_Documents_CurrentStatus)
+        execute_sql_sync(create_DocumentsHistory_index)
+        execute_sql_sync(create_IdempotencyKeys)
+        execute_sql_sync(migrate_Documents_Node)
         execute_sql_sync(create_Certificates)
     except Exception as e:
         logger.error(f"An error occurred while creating tables: {e}")
 
 
 def check_certificates() -> None:
-    """Parses certificate data from configuration and initializes certificate objects.
-    Updates the global certificate registry with these objects.
-
-    Logs errors if the certificate data is improperly formatted or missing.
+    """Loads the certificates configured in config.ini into the certificate registry.
+    Certificates that cannot be loaded or have expired are retired and logged, the others are used.
     """
-    certs = CERTIFICATES.strip(',').split(',')
-    cfg_certs = {}
-
-    for cert in certs:
-        if cert.strip():
-            cert = cert.split(' ')
-            if len(cert) == 2:
-                name, pwd = cert
-                cfg_certs[name] = Certificate(name, pwd)
-            elif len(cert) == 1:
-                name = cert[0]
-                cfg_certs[name] = Certificate(name)
-            else:
-                logger.error(f"Error parsing certificate data: '{cert}'")
-
-    if cfg_certs:
-        CERTS.update(cfg_certs)
-    else:
+    configured = parse_certificates(CERTIFICATES)
+    if not configured:
         logger.error("No valid certificates data found in config.ini")
+        return
+    CERTS.reload(configured)
+    if not CERTS:
+        logger.error("None of the configured certificates could be loaded.")
+
+
+_reload_lock = asyncio.Lock()
+_reload_task = None
+
+
+async def reload_certificates() -> bool:
+    """Picks up new, renewed, removed and expired certificates from config.ini and dbo.Certificates.
+    When the registry changed, the signing and verification workers are replaced. Returns True on a change."""
+    async with _reload_lock:
+        changed = await asyncio.to_thread(CERTS.reload, parse_certificates(read_certificates()))
+        if changed:
+            engine.reload(CERTS.snapshot())
+            verification_engine.reload(*verification_trust())
+        return changed
+
+
+async def _reload_certificates_periodically() -> None:
+    while True:
+        await asyncio.sleep(CERT_RELOAD_INTERVAL)
+        try:
+            await reload_certificates()
+        except Exception as e:
+            logger.error(f"Reloading certificates failed: {e}")
+
+
+async def start_certificate_reloader() -> None:
+    global _reload_task
+    if CERT_RELOAD_INTERVAL > 0 and _reload_task is None:
+        _reload_task = asyncio.create_task(_reload_certificates_periodically())
+
+
+async def shutdown_certificate_reloader() -> None:
+    global _reload_task
+    if _reload_task is not None:
+        _reload_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await _reload_task
+        _reload_task = None
+
+
+def start_signing_engine() -> None:
+    """Starts the process pool used for CMS signing.
+    Must run after check_certificates so that every worker loads the complete key material.
+    """
+    if not engine.running:
+        engine.start(CERTS.snapshot(), SIGNING_WORKERS)
+
+
+def shutdown_signing_engine() -> None:
+    engine.shutdown()
+
+
+def verification_trust() -> tuple:
+    """Returns the trust anchors and intermediates of /verify.
+
+    Self-signed certificates of CERTS and of their chains, and the files in [VERIFY] TRUST_DIR, are anchors.
+    The other chain certificates are intermediates that only help to build a path to an anchor; a signing
+    certificate issued by a CA is trusted through that CA, not by itself.
+    """
+    anchors, intermediates = [], []
+    for cert in CERTS.snapshot().values():
+        for certificate in [cert.certificate, *cert.chain]:
+            if certificate.issuer == certificate.subject:
+                anchors.append(certificate.public_bytes(Encoding.DER))
+            elif certificate is not cert.certificate:
+                intermediates.append(certificate.public_bytes(Encoding.DER))
+    if VERIFY_TRUST_DIR and os.path.isdir(VERIFY_TRUST_DIR):
+        for name in sorted(os.listdir(VERIFY_TRUST_DIR)):
+            if name.lower().endswith(('.pem', '.crt', '.cer', '.der')):
+                with open(os.path.join(VERIFY_TRUST_DIR, name), 'rb') as file:
+                    anchors.append(file.read())
+    elif VERIFY_TRUST_DIR:
+        logger.warning(f"Trust directory {VERIFY_TRUST_DIR} does not exist.")
+    return anchors, intermediates
+
+
+def start_verification_engine() -> None:
+    """Starts the process pool used by /verify. Must run after check_certificates."""
+    if not verification_engine.running:
+        verification_engine.start(*verification_trust(), VERIFY_WORKERS, VERIFY_SYSTEM_TRUST, VERIFY_CACHE_SIZE,
+                                  VERIFY_CACHE_TTL)
+
+
+def shutdown_verification_engine() -> None:
+    verification_engine.shutdown()
+
+
+async def start_status_writer() -> None:
+    """Starts the write-behind status writer and stores the events replayed from its journal,
+    so that recover_jobs sees the current status of every document."""
+    _database.status_writer.start()
+    await _database.status_writer.flush()
+
+
+async def shutdown_status_writer() -> None:
+    await _database.status_writer.stop()
+
+
+def close_database_pool() -> None:
+    pool.close()
+    logger.info("Database connection pool closed.")
+
+
+def start_signing_queue() -> None:
+    signing_queue.start()
+
+
+async def shutdown_signing_queue() -> None:
+    await signing_queue.stop()
+
+
+async def recover_jobs() -> None:
+    """Re-enqueues documents of this node whose last recorded status is 'Received' or 'Signed'.
+    Their payloads were persisted to DIR_TEMP by the signing queue before the previous shutdown or crash.
+    Documents whose payload is gone are marked as failed. Documents registered by other nodes sharing the
+    database are left to them.
+    """
+    try:
+        rows = await _database.fetch_all_sql(_database.select_unfinished_Documents, [NODE_ID])
+    except Exception as e:
+        logger.error(f"Unable to look up unfinished documents: {e}")
+        return
+
+    recovered = 0
+    for row in rows:
+        file_uuid = str(row[0]).lower()
+        job = await asyncio.to_thread(SigningJob.load, file_uuid)
+        if job is None and row[1] == 'Signed' and storage.exists(file_uuid):
+            # The signed file was renamed into place, only the 'Saved' record is missing.
+            await record_status(file_uuid, 'Saved', 'Signed file saved successfully')
+            await asyncio.to_thread(SigningJob(file_uuid, '', '', Payload()).forget)
+            continue
+        if job is None:
+            logger.warning(f"UUID: {file_uuid} - payload was lost before signing.")
+            await record_status(file_uuid, 'Failed', 'Payload was lost during restart')
+            continue
+        signing_queue.resume(job)
+        recovered += 1
+
+    if recovered:
+        logger.info(f"Recovered {recovered} unfinished signing job(s).")
@@ -0,0 +1,90 @@
+# notifier.py
+
+""" In-process completion signals for signed documents.
+status_cache.record_status publishes every final status of a document (Saved, Failed, Transmitted,
+DeadLetter, Expired), /wait long-polls and /events Server-Sent-Events streams are woken up from here
+instead of polling the database.
+"""
+
+import asyncio
+from typing import Optional
+from _logger import logger
+
+
+class Subscription:
+    """A Server-Sent-Events client interested in documents of one sender or in a set of UUIDs."""
+
+    def __init__(self, sender: Optional[str], uuids: Optional[set], max_pending: int = 1000):
+        self.sender = sender
+        self.uuids = uuids
+        self.events = asyncio.Queue(maxsize=max_pending)
+        self.dropped = 0
+
+    def matches(self, file_uuid: str, sender: Optional[str]) -> bool:
+        if self.uuids is not None and file_uuid not in self.uuids:
+            return False
+        if self.sender is not None and self.sender != sender:
+            return False
+        return True
+
+
+class CompletionHub:
+    def __init__(self):
+        self._waiters = {}
+        self._subscriptions = set()
+        self.published = 0
+
+    @staticmethod
+    def key(file_uuid) -> str:
+        return str(file_uuid).lower()
+
+    def publish(self, file_uuid, status: str, message: str, sender: Optional[str] = None) -> None:
+        key = self.key(file_uuid)
+        event = {"uuid": key, "status": status, "message": message}
+        self.published += 1
+
+        for waiter in self._waiters.pop(key, ()):
+            if not waiter.done():
+                waiter.set_result((status, message))
+
+        for subscription in self._subscriptions:
+            if subscription.matches(key, sender):
+                try:
+                    subscription.events.put_nowait(event)
+                except asyncio.QueueFull:
+                    subscription.dropped += 1
+
+    def register(self, file_uuid) -> asyncio.Future:
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(self.key(file_uuid), set()).add(waiter)
+        return waiter
+
+    def unregister(self, file_uuid, waiter: asyncio.Future) -> None:
+        key = self.key(file_uuid)
+        waiters = self._waiters.get(key)
+        if waiters is not None:
+            waiters.discard(waiter)
+            if not waiters:
+                del self._waiters[key]
+        if not waiter.done():
+            waiter.cancel()
+
+    def subscribe(self, sender: Optional[str] = None, uuids: Optional[set] = None) -> Subscription:
+        subscription = Subscription(sender, {self.key(u) for u in uuids} if uuids else None)
+        self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self._subscriptions.discard(subscription)
+        if subscription.dropped:
+            logger.warning(f"Events subscriber dropped {subscription.dropped} event(s) because it was too slow.")
+
+    def stats(self) -> dict:
+        return {
+            "waiters": sum(len(waiters) for waiters in self._waiters.values()),
+            "subscriptions": len(self._subscriptions),
+            "published": self.published,
+        }
+
+
+hub = CompletionHub()
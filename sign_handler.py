@@ -1,14 +1,17 @@
 # _sign_pdf.pdf
 import asyncio
 import time
+import hashlib
 
-from endesive import pdf
 from datetime import datetime, timezone
-import aiofiles
-from _cert import CERTS
-import _database
+from _engine import engine
+from _payload import Payload
+from status_cache import record_status
+from janitor import janitor
+from delivery import delivery
+from _storage import storage
 from _logger import logger
-from _config import DIR_TEMP
+from _metrics import stage
 
 
 class SignTime:
@@ -23,25 +26,45 @@ class SignTime:
         return formatted_date.encode()
 
 
-async def save_signed_file(file_content, file_uuid):
-    file_path = f'{DIR_TEMP}/{file_uuid}.pdf'
+def signature_etag(signature: bytes) -> str:
+    """Entity tag of a signed file: the digest of its signature, which differs for every signing."""
+    return '"' + hashlib.sha256(signature).hexdigest() + '"'
+
+
+def write_signed_file(payload: Payload, signature: bytes, file_uuid) -> int:
+    """Stores the original document followed by the signature without concatenating them. Returns the stored size.
+
+    A spilled payload is turned into the stored file itself, an in-memory payload is written with one
+    vectored write. Either way readers never see a partially written file.
+    """
+    etag = signature_etag(signature)
+    if payload.in_memory:
+        return storage.put(file_uuid, [payload.data, signature], etag)
+    size = storage.put_file(file_uuid, payload.path, payload.size, signature, etag)
+    payload.path = None
+    return size
+
+
+async def save_signed_file(payload: Payload, signature: bytes, file_uuid, sender=None):
     try:
-        async with aiofiles.open(file_path, 'wb') as file:
-            await file.write(file_content)
+        with stage('save') as timing:
+            size = await asyncio.to_thread(write_signed_file, payload, signature, file_uuid)
     except IOError as e:
-        await _database.execute_query(_database.insert_DocumentsHistory,
-                                      (file_uuid, 'Failed', 'Failed to save signed file to the filesystem'))
-        logger.error(f"Failed to save file {file_uuid}. Error: {e}")
+        message = 'Failed to save signed file to the filesystem'
+        await record_status(file_uuid, 'Failed', message, sender=sender)
+        logger.error("Failed to save file %s. Error: %s", file_uuid, e, extra={"uuid": file_uuid, "sender": sender})
     else:
-        await _database.execute_query(_database.insert_DocumentsHistory,
-                                      (file_uuid, 'Saved', 'Signed file saved successfully'))
-        logger.info(f"Saved: {file_uuid}.")
+        janitor.register(file_uuid, size, sender=sender)
+        message = 'Signed file saved successfully'
+        await record_status(file_uuid, 'Saved', message, sender=sender)
+        logger.info("Saved: %s.", file_uuid,
+                    extra={"uuid": file_uuid, "sender": sender, "stage": 'save', "duration_ms": timing.ms})
+        delivery.submit(file_uuid, sender, size)
 
 
-async def sign_pdf(data: bytes, cert_name: str, file_uuid: str):
-    logger.debug(f'Initializing signing process for {file_uuid} with certificate {cert_name}.')
-    timestamp = SignTime()
-    dct = {
+def signature_fields(timestamp: SignTime) -> dict:
+    """The signature dictionary passed to pdf.cms.sign."""
+    return {
         "sigpage": 0,
         "contact": "pisarev@infomatic.cz",
         "location": "Prague",
@@ -50,23 +73,32 @@ async def sign_pdf(data: bytes, cert_name: str, file_uuid: str):
         "sigflagsft": 132,
     }
 
-    private_key = CERTS[cert_name].private_key
-    certificate = CERTS[cert_name].certificate
+
+async def sign_pdf(payload: Payload, cert_name: str, file_uuid: str):
+    logger.debug('Initializing signing process for %s with certificate %s.', file_uuid, cert_name)
+    timestamp = SignTime()
+    dct = signature_fields(timestamp)
 
     try:
-        signature = pdf.cms.sign(data, dct, private_key, certificate, [], "sha256")
+        with stage('sign', cert_name) as timing:
+            signature = await engine.sign(payload, dct, cert_name)
     except Exception as e:
-        logger.error(f"PDF signing failed: {e}")
+        logger.error("PDF signing failed: %s", e, extra={"uuid": file_uuid, "cert_name": cert_name})
         raise
     else:
-        await _database.execute_query(_database.insert_DocumentsHistory, (file_uuid, 'Signed', 'File was signed'))
-        await _database.execute_query(_database.update_Documents, (timestamp.db(), file_uuid))
-        logger.info(f"Signed {file_uuid} with {cert_name}.")
+        await record_status(file_uuid, 'Signed', 'File was signed', sign_timestamp=timestamp.db())
+        logger.info("Signed %s with %s.", file_uuid, cert_name,
+                    extra={"uuid": file_uuid, "cert_name": cert_name, "stage": 'sign', "duration_ms": timing.ms})
 
-    return data + signature
+    return signature
 
 
-async def sign_flow(file_content, cert_name, file_uuid):
+async def sign_flow(payload: Payload, cert_name, file_uuid, sender=None):
     # await asyncio.sleep(30)
-    signed_content = await sign_pdf(file_content, cert_name, file_uuid)
-    await save_signed_file(signed_content, file_uuid)
+    try:
+        signature = await sign_pdf(payload, cert_name, file_uuid)
+    except Exception:
+        message = 'Failed to sign the file'
+        await record_status(file_uuid, 'Failed', message, sender=sender)
+        return
+    await save_signed_file(payload, signature, file_uuid, sender)
@@ -0,0 +1,129 @@
+# status_cache.py
+
+""" Write-through cache of the current document status.
+Every status change goes through record_status, so /get_signed polls are answered from memory
+and fall back to the denormalized Documents.CurrentStatus only for documents this process has not seen recently.
+"""
+
+import time
+from datetime import datetime
+from collections import OrderedDict
+import _database
+from notifier import hub
+from _metrics import STATUS_TOTAL
+from _config import STATUS_CACHE_SIZE, STATUS_CACHE_TTL, STATUS_CACHE_TERMINAL_TTL, NODE_ID
+
+
+TERMINAL_STATUSES = ('Transmitted', 'Failed', 'Expired')
+
+
+class StatusCache:
+    """Bounded LRU of (status, message) per UUID with per-entry expiry.
+
+    Terminal statuses never change again, so they are kept for terminal_ttl seconds,
+    which makes repeated polls for finished or removed files free.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, terminal_ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.terminal_ttl = terminal_ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(file_uuid) -> str:
+        return str(file_uuid).lower()
+
+    def get(self, file_uuid):
+        key = self.key(file_uuid)
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, file_uuid, status: str, message: str) -> None:
+        key = self.key(file_uuid)
+        ttl = self.terminal_ttl if status in TERMINAL_STATUSES else self.ttl
+        self._entries[key] = (time.monotonic() + ttl, (status, message))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+cache = StatusCache(STATUS_CACHE_SIZE, STATUS_CACHE_TTL, STATUS_CACHE_TERMINAL_TTL)
+
+
+# Final statuses; recording one also publishes it to the /wait and /events listeners.
+FINAL_STATUSES = frozenset(('Saved', 'Failed', 'Transmitted', 'DeadLetter', 'Expired'))
+
+
+async def record_status(file_uuid, status: str, message: str, created: bool = False, file_size: int = None,
+                        sender: str = None, sign_timestamp: str = None) -> None:
+    """Records a status transition. The database write is deferred to _database.status_writer,
+    created=True also registers the document (file_size, sender) in the same transaction,
+    as owned by this node. Returns once the event is in the journal on disk, raises OSError if it cannot be.
+    A final status is then published to notifier.hub; without the sender it only reaches the listeners
+    that do not filter by sender."""
+    _database.status_writer.record(_database.StatusEvent(
+        str(file_uuid), status, message, datetime.now().isoformat(timespec='milliseconds'),
+        created, file_size, sender, sign_timestamp, NODE_ID if created else None
+    ))
+    cache.put(file_uuid, status, message)
+    STATUS_TOTAL.inc(status=status)
+    await _database.status_writer.sync()
+    if status in FINAL_STATUSES:
+        hub.publish(file_uuid, status, message, sender)
+
+
+async def current_status(file_uuid):
+    """Returns (status, message) of the document or None if the UUID is unknown."""
+    cached = cache.get(file_uuid) or _database.status_writer.latest(file_uuid)
+    if cached is not None:
+        return cached
+    row = await _database.fetch_sql(_database.check_file_status, file_uuid)
+    if not row or row[0] is None:
+        return None
+    cache.put(file_uuid, row[0], row[1])
+    return row[0], row[1]
+
+
+async def current_statuses(file_uuids: list) -> dict:
+    """Returns {uuid: (status, message)} of the known documents among file_uuids.
+
+    Statuses in memory are taken first, the rest is read with one query per 1000 UUIDs.
+    """
+    statuses = {}
+    missing = []
+    for file_uuid in file_uuids:
+        key = cache.key(file_uuid)
+        cached = cache.get(key) or _database.status_writer.latest(key)
+        if cached is not None:
+            statuses[key] = cached
+        else:
+            missing.append((key,))
+    for sql, params in _database.multi_row(_database.select_Documents_status, missing,
+                                           _database.select_Documents_status_end):
+        for row in await _database.fetch_all_sql(sql, params):
+            if row[1] is None:
+                continue
+            key = cache.key(row[0])
+            cache.put(key, row[1], row[2])
+            statuses[key] = (row[1], row[2])
+    return statuses
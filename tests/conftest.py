@@ -0,0 +1,30 @@
+# conftest.py - runs the tests against a throwaway working directory.
+
+""" The application reads config.ini and logging_config.json from the working directory when _config and
+_logger are first imported, so the working directory of the benchmark harness (a generated config.ini, a
+self-signed PFX and a temp folder) is prepared here, before any test module imports the application.
+Tests that need the database get a fresh SQLite file through the database fixture (see sqlite_backend).
+"""
+
+import os
+import sys
+import atexit
+import shutil
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [REPO, os.path.join(REPO, 'benchmarks')]
+
+import bench  # noqa: E402
+
+WORKDIR = bench.prepare_workdir(bench.parse_args(['--signing-workers', '1', '--queue-workers', '1']))
+os.chdir(WORKDIR)
+atexit.register(shutil.rmtree, WORKDIR, ignore_errors=True)
+
+
+@pytest.fixture
+def database(tmp_path):
+    """Points the connection pool at an empty SQLite database with the application's schema."""
+    path = str(tmp_path / 'test.sqlite')
+    bench.sqlite_backend.install(path)
+    return path
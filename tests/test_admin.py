@@ -0,0 +1,48 @@
+import asyncio
+
+import httpx
+import pytest
+
+import _cert
+import main
+
+
+def post_reload(headers: dict = None) -> httpx.Response:
+    async def run():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            return await client.post('/admin/certificates/reload', headers=headers or {})
+
+    return asyncio.run(run())
+
+
+def test_reload_endpoint_is_disabled_without_a_token(monkeypatch):
+    monkeypatch.setattr(main, 'ADMIN_TOKEN', '')
+    assert post_reload({"Admin-Token": ""}).status_code == 404
+
+
+def test_reload_endpoint_requires_the_token(monkeypatch):
+    monkeypatch.setattr(main, 'ADMIN_TOKEN', 'secret')
+    assert post_reload().status_code == 403
+    assert post_reload({"Admin-Token": "wrong"}).status_code == 403
+
+
+@pytest.mark.usefixtures('database')
+def test_reload_endpoint_with_the_token(monkeypatch):
+    monkeypatch.setattr(main, 'ADMIN_TOKEN', 'secret')
+    response = post_reload({"Admin-Token": "secret"})
+    assert response.status_code == 200
+    assert "changed" in response.json()
+
+
+def test_registry_is_kept_when_the_database_fails(monkeypatch):
+    registry = _cert.CertificateRegistry()
+    loaded = object()
+    registry._certs = {'loaded': loaded}
+
+    def fail(*args):
+        raise RuntimeError('database is down')
+
+    monkeypatch.setattr(_cert, 'fetch_sql_sync', fail)
+    assert registry.reload({'loaded': 'password', 'new': 'password'}) is False
+    assert registry.snapshot() == {'loaded': loaded}
@@ -0,0 +1,72 @@
+import os
+import json
+import asyncio
+
+import bench
+import bulk_sign
+import _database
+from synthetic import make_pdf
+
+
+def archive(directory, count: int) -> str:
+    os.makedirs(directory)
+    for number in range(count):
+        with open(os.path.join(directory, f'{number}.pdf'), 'wb') as file:
+            file.write(make_pdf(1, 2000))
+    return str(directory)
+
+
+def ledger_rows(path) -> list:
+    with open(path, encoding='utf-8') as file:
+        return [json.loads(line) for line in file]
+
+
+def test_no_db_signs_without_a_database(tmp_path, monkeypatch):
+    def unreachable():
+        raise AssertionError('the database was used')
+
+    monkeypatch.setattr(_database.pool, '_connect', unreachable)
+    monkeypatch.setattr(_database.pool, 'close', lambda: None)
+    source = archive(tmp_path / 'in', 2)
+    ledger = tmp_path / 'ledger.jsonl'
+    code = bulk_sign.main([source, '--output', str(tmp_path / 'out'), '--cert', bench.CERT_NAME, '--no-db',
+                           '--ledger', str(ledger), '--workers', '1'])
+    assert code == 0
+    assert [row['status'] for row in ledger_rows(ledger)] == ['Transmitted', 'Transmitted']
+    assert sorted(os.listdir(tmp_path / 'out')) == ['.bulk_sign.checkpoint', '0.pdf', '1.pdf']
+
+
+def test_results_are_kept_when_the_database_fails(tmp_path, monkeypatch):
+    stored = []
+
+    async def execute_transaction(statements):
+        if not stored:
+            stored.append(None)
+            raise RuntimeError('database is down')
+        stored.append(statements)
+
+    monkeypatch.setattr(_database, 'execute_transaction', execute_transaction)
+    ledger = bulk_sign.Ledger(str(tmp_path / 'ledger.jsonl'))
+    checkpoint = bulk_sign.Checkpoint(str(tmp_path / 'checkpoint'), resume=False)
+    recorder = bulk_sign.Recorder('tests', True, ledger, checkpoint, 10, 60)
+
+    def result(name: str) -> bulk_sign.Result:
+        item = bulk_sign.Result(name, name, name, bulk_sign.now())
+        item.finished = item.received
+        return item
+
+    async def run():
+        recorder.add('a.pdf', result('a'))
+        await recorder.flush()
+        assert recorder.unstored == 1 and 'a.pdf' not in checkpoint
+        recorder.add('b.pdf', result('b'))
+        await recorder.flush()
+
+    asyncio.run(run())
+    ledger.close()
+    checkpoint.close()
+    assert recorder.unstored == 0
+    assert 'a.pdf' in checkpoint and 'b.pdf' in checkpoint
+    assert [row['uuid'] for row in ledger_rows(tmp_path / 'ledger.jsonl')] == ['a', 'b']
+    documents = [params for sql, params in stored[1] if 'INSERT INTO Documents ' in sql]
+    assert len(documents) == 1 and len(documents[0]) == 2 * 5
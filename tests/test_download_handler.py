@@ -0,0 +1,57 @@
+import pytest
+
+from download_handler import parse_range, etag_matches, DeliveryTracker, RangeNotSatisfiable
+
+
+@pytest.mark.parametrize('header, expected', [
+    (None, None),
+    ('bytes=0-99', (0, 99)),
+    ('bytes=100-', (100, 999)),
+    ('bytes=-100', (900, 999)),
+    ('bytes=-5000', (0, 999)),
+    ('bytes=900-5000', (900, 999)),
+    (' Bytes = 0-0', None),
+    ('BYTES=0-0', (0, 0)),
+    ('items=0-99', None),
+    ('bytes=0-99,200-299', None),
+    ('bytes=99-0', None),
+    ('bytes=abc-', None),
+    ('bytes=5', None),
+    ('bytes=--1', None),
+    ('bytes=+1-2', None),
+    ('bytes=1_0-20', None),
+    ('bytes=-', None),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize('header, size', [('bytes=1000-', 1000), ('bytes=-0', 1000), ('bytes=-1', 0)])
+def test_unsatisfiable_range(header, size):
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range(header, size)
+
+
+def test_etag_comparison_is_weak():
+    assert etag_matches('"abc"', 'W/"abc"')
+    assert etag_matches('W/"x", "abc"', '"abc"')
+    assert etag_matches('*', '"abc"')
+    assert not etag_matches('"abd"', '"abc"')
+    assert not etag_matches(None, '"abc"')
+
+
+def test_delivery_is_complete_once_every_byte_was_sent():
+    tracker = DeliveryTracker()
+    assert not tracker.add('A', 500, 999, 1000)
+    assert not tracker.add('a', 0, 199, 1000)
+    assert not tracker.add('a', 300, 499, 1000)
+    assert tracker.add('a', 150, 349, 1000)
+    assert len(tracker) == 0
+
+
+def test_abandoned_deliveries_are_bounded():
+    tracker = DeliveryTracker(max_entries=2)
+    for name in 'abc':
+        tracker.add(name, 0, 0, 10)
+    assert len(tracker) == 2
+    assert not tracker.add('a', 1, 9, 10)
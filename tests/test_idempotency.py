@@ -0,0 +1,110 @@
+import uuid
+import asyncio
+
+import pytest
+
+import idempotency
+from status_cache import record_status
+
+pytestmark = pytest.mark.usefixtures('database')
+
+
+def new_uuid() -> str:
+    return str(uuid.uuid4())
+
+
+async def settle() -> None:
+    """Waits for the claims released in the background."""
+    while idempotency._background:
+        await asyncio.gather(*idempotency._background)
+
+
+async def claim_and_register(key: str, file_uuid: str) -> None:
+    assert await idempotency.claim(key, file_uuid) is None
+    await record_status(file_uuid, 'Received', 'Received file from the client', created=True, file_size=1,
+                        sender='tests')
+    idempotency.registered(key, file_uuid)
+
+
+def test_concurrent_claims_admit_one_request():
+    key = idempotency.request_key('tests', 'cert', new_uuid())
+    first, second = new_uuid(), new_uuid()
+
+    async def run():
+        return await asyncio.gather(idempotency.claim(key, first), idempotency.claim(key, second),
+                                    return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert results.count(None) == 1
+    assert sum(isinstance(result, idempotency.InProgress) for result in results) == 1
+
+
+def test_retry_is_replayed_only_once_registered():
+    key = idempotency.request_key('tests', 'cert', new_uuid())
+    first = new_uuid()
+
+    async def run():
+        assert await idempotency.claim(key, first) is None
+        with pytest.raises(idempotency.InProgress):
+            await idempotency.claim(key, new_uuid())
+        await record_status(first, 'Received', 'Received file from the client', created=True, file_size=1,
+                            sender='tests')
+        # Not in the in-memory cache, as for a retry that reaches another process.
+        assert await idempotency.claim(key, new_uuid()) == first
+
+    asyncio.run(run())
+
+
+def test_released_claim_can_be_taken():
+    key = idempotency.request_key('tests', 'cert', new_uuid())
+    second = new_uuid()
+
+    async def run():
+        first = new_uuid()
+        assert await idempotency.claim(key, first) is None
+        idempotency.release(key, first)
+        await settle()
+        assert await idempotency.claim(key, second) is None
+
+    asyncio.run(run())
+
+
+def test_failed_document_is_taken_over():
+    key = idempotency.request_key('tests', 'cert', new_uuid())
+    first, second = new_uuid(), new_uuid()
+
+    async def run():
+        await claim_and_register(key, first)
+        assert await idempotency.claim(key, new_uuid()) == first
+        await record_status(first, 'Failed', 'Signing failed')
+        assert await idempotency.claim(key, second) is None
+        with pytest.raises(idempotency.InProgress):
+            await idempotency.claim(key, new_uuid())
+
+    asyncio.run(run())
+
+
+def test_abandoned_claim_is_taken_over(monkeypatch):
+    key = idempotency.request_key('tests', 'cert', new_uuid())
+    second = new_uuid()
+
+    async def run():
+        assert await idempotency.claim(key, new_uuid()) is None
+        monkeypatch.setattr(idempotency, 'PENDING_TIMEOUT', -60)
+        assert await idempotency.claim(key, second) is None
+
+    asyncio.run(run())
+
+
+def test_keys_are_scoped_by_sender_and_certificate():
+    header = new_uuid()
+    keys = {idempotency.request_key('tests', 'cert', header), idempotency.request_key('tests', 'other', header),
+            idempotency.request_key('other', 'cert', header)}
+    assert len(keys) == 3
+    assert idempotency.request_key('tests', 'cert', None) is None
+
+    async def run():
+        for key in keys:
+            await claim_and_register(key, new_uuid())
+
+    asyncio.run(run())
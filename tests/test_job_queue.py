@@ -0,0 +1,93 @@
+import uuid
+import asyncio
+
+import pytest
+
+import job_queue
+from _payload import Payload
+from job_queue import SigningQueue, SigningJob, FairQueue, SenderState, TokenBucket, Throttled
+from status_cache import record_status, current_status
+
+
+def job(sender: str, priority: str = 'normal') -> SigningJob:
+    return SigningJob(str(uuid.uuid4()), 'cert', sender, Payload(data=b'%PDF', size=4), priority)
+
+
+def drain(senders: dict, jobs: list) -> list:
+    """Queues jobs and returns their senders in the order they are taken."""
+    states = {}
+
+    def state(sender):
+        return states.setdefault(sender, SenderState(0, 0, senders.get(sender, 1), 0))
+
+    async def run():
+        queue = FairQueue(state)
+        for item in jobs:
+            queue.put_nowait(item)
+        return [(await queue.get()) for _ in jobs]
+
+    taken = asyncio.run(run())
+    assert all(state.depth == 0 for state in states.values())
+    return taken
+
+
+def test_new_sender_is_not_held_back_by_a_backlog():
+    jobs = [job('bulk') for _ in range(20)] + [job('other')]
+    order = [item.sender for item in drain({}, jobs)]
+    assert order.index('other') <= 1
+
+
+def test_backlogged_senders_are_served_by_weight():
+    jobs = [job('heavy') for _ in range(30)] + [job('light') for _ in range(30)]
+    order = [item.sender for item in drain({'heavy': 2}, jobs)][:30]
+    assert order.count('heavy') == 20
+
+
+def test_priority_comes_before_fairness():
+    jobs = [job('a', 'bulk'), job('b', 'normal'), job('a', 'interactive')]
+    assert [item.priority for item in drain({}, jobs)] == ['interactive', 'normal', 'bulk']
+
+
+def test_token_bucket_allows_a_burst_then_throttles():
+    bucket = TokenBucket(rate=1, burst=3)
+    assert [bucket.take() for _ in range(3)] == [0, 0, 0]
+    assert 0 < bucket.take() <= 1
+    assert not bucket.full()
+
+
+def test_admission_limits():
+    queue = SigningQueue(1, 10, (0, 0, 1, 2), {'limited': (1, 2, 1, 0)})
+    queue.sender('deep').depth = 2
+    with pytest.raises(Throttled):
+        queue.admit('deep')
+    queue.admit('limited', 2)
+    with pytest.raises(Throttled) as throttled:
+        queue.admit('limited')
+    assert throttled.value.retry_after >= 1
+    assert queue.sender('limited').throttled == 1
+
+
+@pytest.mark.usefixtures('database')
+def test_job_that_raises_is_failed_and_forgotten(monkeypatch):
+    item = job('tests')
+
+    async def broken(*args):
+        raise RuntimeError('lost the status journal')
+
+    monkeypatch.setattr(job_queue, 'sign_flow', broken)
+
+    async def run():
+        queue = SigningQueue(1, 10, (0, 0, 1, 0), {})
+        queue.start()
+        try:
+            await record_status(item.file_uuid, 'Received', 'Received file from the client', created=True,
+                                file_size=4, sender='tests')
+            await queue.submit(item)
+            while queue.stats()["processed"] < 1:
+                await asyncio.sleep(0.01)
+        finally:
+            await queue.stop()
+        return await current_status(item.file_uuid)
+
+    assert asyncio.run(run())[0] == 'Failed'
+    assert SigningJob.load(item.file_uuid) is None
@@ -0,0 +1,53 @@
+import uuid
+import asyncio
+from types import SimpleNamespace
+
+from janitor import Janitor
+from notifier import hub
+from status_cache import record_status
+
+
+def events(subscription) -> list:
+    found = []
+    while not subscription.events.empty():
+        found.append(subscription.events.get_nowait())
+    return found
+
+
+def test_only_final_statuses_are_published():
+    file_uuid = str(uuid.uuid4())
+
+    async def run():
+        subscription = hub.subscribe(uuids={file_uuid})
+        try:
+            await record_status(file_uuid, 'Signed', 'File was signed', sender='tests')
+            await record_status(file_uuid, 'Failed', 'Failed to sign the file', sender='tests')
+            return events(subscription)
+        finally:
+            hub.unsubscribe(subscription)
+
+    assert [event['status'] for event in asyncio.run(run())] == ['Failed']
+
+
+def test_janitor_removals_reach_sender_subscribers():
+    expired, transmitted, unknown = (str(uuid.uuid4()) for _ in range(3))
+    janitor = Janitor(SimpleNamespace(delete=lambda key: True), retention=0, disk_budget=0)
+
+    async def run():
+        subscription = hub.subscribe('tests')
+        everything = hub.subscribe()
+        try:
+            janitor.register(expired, 10, sender='tests')
+            janitor.register(transmitted, 10, sender='tests')
+            janitor.delivered(transmitted, 10, grace=0)
+            janitor.register(unknown, 10)
+            await janitor._remove(janitor._take_due(float('inf')))
+            return events(subscription), events(everything)
+        finally:
+            hub.unsubscribe(subscription)
+            hub.unsubscribe(everything)
+
+    by_sender, everything = asyncio.run(run())
+    assert {(event['uuid'], event['status']) for event in by_sender} == {(expired, 'Expired'),
+                                                                          (transmitted, 'Transmitted')}
+    assert unknown in {event['uuid'] for event in everything}
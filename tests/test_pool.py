@@ -0,0 +1,109 @@
+import time
+import threading
+from contextlib import contextmanager
+
+import pyodbc
+import pytest
+
+from _database import ConnectionPool
+
+
+class FakeConnection:
+    def __init__(self, alive: bool = True):
+        self.alive = alive
+        self.closed = False
+
+    @contextmanager
+    def cursor(self):
+        if not self.alive:
+            raise pyodbc.Error('connection is dead')
+        yield self
+
+    def execute(self, sql):
+        pass
+
+    def fetchall(self):
+        return [(1,)]
+
+    def close(self):
+        self.closed = True
+
+
+def pool(size: int = 2, max_idle: float = 60, timeout: float = 5, ping_after: float = 60):
+    connections = []
+
+    def connect():
+        connections.append(FakeConnection())
+        return connections[-1]
+
+    return ConnectionPool(connect, size, max_idle, timeout, ping_after), connections
+
+
+def test_checkouts_are_bounded_and_connections_reused():
+    connection_pool, connections = pool(size=2)
+    active, peak, lock = [0], [0], threading.Lock()
+
+    def work():
+        for _ in range(20):
+            with connection_pool.connection():
+                with lock:
+                    active[0] += 1
+                    peak[0] = max(peak[0], active[0])
+                time.sleep(0.001)
+                with lock:
+                    active[0] -= 1
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert peak[0] <= 2
+    assert len(connections) <= 2
+    stats = connection_pool.stats()
+    assert stats["checkouts"] == 160 and stats["in_use"] == 0
+
+
+def test_checkout_times_out_when_exhausted():
+    connection_pool, _ = pool(size=1, timeout=0.05)
+    connection = connection_pool.acquire()
+    with pytest.raises(TimeoutError):
+        connection_pool.acquire()
+    connection_pool.release(connection)
+    connection_pool.release(connection_pool.acquire())
+
+
+def test_driver_errors_discard_the_connection_but_constraint_violations_do_not():
+    connection_pool, connections = pool()
+    with pytest.raises(pyodbc.IntegrityError):
+        with connection_pool.connection():
+            raise pyodbc.IntegrityError('duplicate key')
+    with pytest.raises(pyodbc.Error):
+        with connection_pool.connection():
+            raise pyodbc.Error('communication link failure')
+    assert len(connections) == 1 and connections[0].closed
+    with connection_pool.connection() as connection:
+        assert connection is not connections[0]
+
+
+def test_idle_connections_are_evicted_and_dead_ones_replaced():
+    connection_pool, connections = pool(max_idle=0.01, ping_after=0)
+    connection_pool.release(connection_pool.acquire())
+    time.sleep(0.02)
+    connection_pool.release(connection_pool.acquire())
+    assert connections[0].closed and connection_pool.stats()["evicted"] == 1
+
+    connection_pool.max_idle = 60
+    connections[1].alive = False
+    with connection_pool.connection() as connection:
+        assert connection is connections[2]
+    assert connections[1].closed
+
+
+def test_closed_pool_refuses_checkouts():
+    connection_pool, connections = pool()
+    connection_pool.release(connection_pool.acquire())
+    connection_pool.close()
+    assert connections[0].closed
+    with pytest.raises(RuntimeError):
+        connection_pool.acquire()
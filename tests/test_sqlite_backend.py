@@ -0,0 +1,78 @@
+import re
+import sqlite3
+
+import pytest
+
+import _database
+import sqlite_backend
+
+TABLE = re.compile(r'CREATE TABLE (\w+) \((.*?)\n    \);', re.DOTALL)
+ADDED = re.compile(r'ALTER TABLE (\w+) ADD (.*?);')
+INDEX = re.compile(r'CREATE (?:UNIQUE )?(?:NONCLUSTERED )?INDEX (\w+) ON (\w+)')
+QUERY = ('SELECT', 'INSERT', 'UPDATE', 'DELETE')
+
+
+def templates(prefixes: tuple) -> dict:
+    return {name: value for name, value in vars(_database).items()
+            if isinstance(value, str) and not name.endswith('_end') and value.strip().upper().startswith(prefixes)}
+
+
+def tsql_tables() -> dict:
+    """{table: {column: constraints}} of the create_* and migrate_* templates."""
+    tables = {}
+    for sql in templates(('IF',)).values():
+        for table, body in TABLE.findall(sql):
+            for line in body.split(',\n'):
+                column, _, rest = line.strip().partition(' ')
+                if column not in ('FOREIGN', 'PRIMARY', 'CONSTRAINT'):
+                    tables.setdefault(table, {})[column] = rest
+        for table, columns in ADDED.findall(sql):
+            for column in re.split(r',\s*(?=\w+ \w)', columns):
+                name, _, rest = column.strip().partition(' ')
+                tables.setdefault(table, {})[name] = rest
+    return tables
+
+
+@pytest.fixture
+def connection(database):
+    connection = sqlite3.connect(database)
+    yield connection
+    connection.close()
+
+
+def test_schema_has_the_columns_and_keys_of_the_tsql_tables(connection):
+    for table, columns in tsql_tables().items():
+        info = {row[1]: row for row in connection.execute(f'PRAGMA table_info({table})')}
+        assert set(info) == set(columns), table
+        unique = set()
+        for index in connection.execute(f'PRAGMA index_list({table})'):
+            if index[2]:
+                unique.update(row[2] for row in connection.execute(f'PRAGMA index_info({index[1]})'))
+        for column, constraints in columns.items():
+            assert bool(info[column][5]) == ('PRIMARY KEY' in constraints), (table, column)
+            if 'NOT NULL' in constraints:
+                assert info[column][3] or info[column][5], (table, column)
+            if 'UNIQUE' in constraints:
+                assert column in unique, (table, column)
+
+
+def test_schema_has_the_indexes_of_the_tsql_tables(connection):
+    indexes = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    for sql in templates(('IF',)).values():
+        for index, _ in INDEX.findall(sql):
+            assert index in indexes
+
+
+def test_every_query_template_translates(connection):
+    for name, sql in templates(QUERY).items():
+        suffix = getattr(_database, f'{name}_end', '')
+        if suffix:
+            width = len(re.search(r'AS v \(([^)]*)\)', suffix).group(1).split(','))
+            sql = sql + '(' + ', '.join('?' * width) + ')' + suffix
+        statement = sqlite_backend.translate(sql)
+        connection.execute('EXPLAIN ' + statement, [None] * statement.count('?'))
+
+
+def test_guarded_ddl_is_skipped():
+    for sql in templates(('IF',)).values():
+        assert sqlite_backend.translate(sql) is None
@@ -0,0 +1,119 @@
+import os
+import uuid
+import asyncio
+
+import pytest
+
+import _database
+from _database import StatusWriter, StatusEvent
+
+
+def event(file_uuid: str, status: str, created: bool = False) -> StatusEvent:
+    return StatusEvent(file_uuid, status, f"{status} message", '2024-01-01T00:00:00.000', created,
+                       1 if created else None, 'tests' if created else None, None, 'node' if created else None)
+
+
+def journals(directory) -> list:
+    return sorted(name for name in os.listdir(directory) if name.endswith('.journal'))
+
+
+def test_concurrent_syncs_share_one_fsync(tmp_path, monkeypatch):
+    writer = StatusWriter(str(tmp_path), 100, 60, 1)
+    synced = []
+
+    def sync_journal(paths):
+        synced.append(set(paths))
+
+    monkeypatch.setattr(_database, '_sync_journal', sync_journal)
+
+    async def run():
+        for _ in range(10):
+            writer.record(event(str(uuid.uuid4()), 'Received', created=True))
+        await asyncio.gather(*(writer.sync() for _ in range(10)))
+        await writer.sync()
+
+    asyncio.run(run())
+    assert len(synced) == 1 and len(synced[0]) == 1
+
+
+def test_failed_fsync_is_raised_and_retried(tmp_path, monkeypatch):
+    writer = StatusWriter(str(tmp_path), 100, 60, 1)
+    failures = [OSError('disk failure')]
+
+    def sync_journal(paths):
+        if failures:
+            raise failures.pop()
+
+    monkeypatch.setattr(_database, '_sync_journal', sync_journal)
+
+    async def run():
+        writer.record(event(str(uuid.uuid4()), 'Received', created=True))
+        with pytest.raises(OSError):
+            await writer.sync()
+        await writer.sync()
+        assert writer._synced == writer._written == 1
+
+    asyncio.run(run())
+
+
+def test_sync_is_skipped_without_fsync(tmp_path, monkeypatch):
+    writer = StatusWriter(str(tmp_path), 100, 60, 1, fsync=False)
+    monkeypatch.setattr(_database, '_sync_journal', pytest.fail)
+
+    async def run():
+        writer.record(event(str(uuid.uuid4()), 'Received', created=True))
+        await writer.sync()
+
+    asyncio.run(run())
+
+
+@pytest.mark.usefixtures('database')
+def test_events_are_stored_together_and_the_journal_removed(tmp_path):
+    writer = StatusWriter(str(tmp_path), 100, 60, 1)
+    file_uuid = str(uuid.uuid4())
+
+    async def run():
+        writer.start()
+        writer.record(event(file_uuid, 'Received', created=True))
+        writer.record(event(file_uuid, 'Signed'))
+        writer.record(event(file_uuid, 'Saved'))
+        await writer.sync()
+        assert writer.latest(file_uuid) == ('Saved', 'Saved message')
+        await writer.stop()
+        return await _database.fetch_sql(_database.check_file_status, file_uuid)
+
+    assert tuple(asyncio.run(run())) == ('Saved', 'Saved message')
+    assert writer.latest(file_uuid) is None
+    assert journals(tmp_path) == []
+
+
+@pytest.mark.usefixtures('database')
+def test_journal_left_by_a_crash_is_replayed(tmp_path):
+    file_uuid = str(uuid.uuid4())
+    crashed = StatusWriter(str(tmp_path), 100, 60, 1)
+
+    async def crash():
+        crashed.record(event(file_uuid, 'Received', created=True))
+        crashed.record(event(file_uuid, 'Signed'))
+        await crashed.sync()
+
+    asyncio.run(crash())
+    with open(os.path.join(tmp_path, journals(tmp_path)[0]), 'a', encoding='utf-8') as file:
+        file.write('{"file_uuid": "cut short')
+
+    async def restart():
+        writer = StatusWriter(str(tmp_path), 100, 60, 1)
+        writer.start()
+        assert writer.pending == 2
+        await writer.stop()
+        # Storing the same events again changes nothing.
+        writer = StatusWriter(str(tmp_path), 100, 60, 1)
+        writer.start()
+        writer.record(event(file_uuid, 'Received', created=True))
+        writer.record(event(file_uuid, 'Signed'))
+        await writer.stop()
+        return await _database.fetch_all_sql("SELECT Status FROM DocumentsHistory WHERE UUID = ? ORDER BY ID",
+                                             [file_uuid])
+
+    assert [row[0] for row in asyncio.run(restart())] == ['Received', 'Signed']
+    assert journals(tmp_path) == []
@@ -0,0 +1,169 @@
+import re
+import zlib
+import asyncio
+import tracemalloc
+from io import BytesIO
+
+import PyPDF2
+
+from _payload import Payload
+from validators import check_pdf_structure, valid_file
+from synthetic import make_pdf
+
+CATALOG = b'<< /Type /Catalog /Pages 2 0 R >>'
+PAGES = b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>'
+PAGE = b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] >>'
+
+
+def build_pdf(objects: dict, compressed=(), xref_stream=False, length='direct', previous=None,
+              objstm_data=None) -> bytes:
+    """Writes objects ({number: dictionary}) as a PDF, or as an incremental update of previous.
+
+    Objects listed in compressed are stored in a Flate object stream whose /Length is 'direct',
+    'indirect' or 'missing'; objstm_data replaces the encoded object stream.
+    """
+    output = bytearray(previous or b'%PDF-1.7\n%\xe2\xe3\xcf\xd3\n')
+    entries = {}
+    number = max(objects) + 1
+    if previous is not None:
+        number = max(number, int(re.findall(rb'/Size (\d+)', previous)[-1]))
+
+    def write(obj_number: int, body: bytes) -> None:
+        entries[obj_number] = ('offset', len(output))
+        output.extend(b'%d 0 obj\n' % obj_number + body + b'\nendobj\n')
+
+    for obj_number, body in objects.items():
+        if obj_number not in compressed:
+            write(obj_number, body)
+
+    if compressed:
+        stream_number, number = number, number + 1
+        header, bodies = [], b''
+        for index, obj_number in enumerate(compressed):
+            header.append(b'%d %d' % (obj_number, len(bodies)))
+            bodies += objects[obj_number] + b'\n'
+            entries[obj_number] = ('compressed', stream_number, index)
+        header = b' '.join(header) + b'\n'
+        data = objstm_data if objstm_data is not None else zlib.compress(header + bodies)
+        dictionary = b'/Type /ObjStm /N %d /First %d /Filter /FlateDecode' % (len(compressed), len(header))
+        if length == 'direct':
+            dictionary += b' /Length %d' % len(data)
+        elif length == 'indirect':
+            length_number, number = number, number + 1
+            dictionary += b' /Length %d 0 R' % length_number
+        write(stream_number, b'<< ' + dictionary + b' >>\nstream\n' + data + b'\nendstream')
+        if length == 'indirect':
+            write(length_number, b'%d' % len(data))
+
+    prev = b''
+    if previous is not None:
+        prev = b' /Prev %d' % int(previous.rsplit(b'startxref', 1)[1].split()[0])
+    size = max(number + 1, max(entries) + 1)
+    xref = len(output)
+    if xref_stream:
+        entries[number] = ('offset', xref)
+        numbers = sorted(entries)
+        rows = b''
+        for obj_number in numbers:
+            entry = entries[obj_number]
+            if entry[0] == 'offset':
+                rows += b'\x01' + entry[1].to_bytes(4, 'big') + b'\x00\x00'
+            else:
+                rows += b'\x02' + entry[1].to_bytes(4, 'big') + entry[2].to_bytes(2, 'big')
+        index = b' '.join(b'%d 1' % obj_number for obj_number in numbers)
+        output += (b'%d 0 obj\n<< /Type /XRef /Size %d /W [1 4 2] /Index [%s] /Root 1 0 R /Length %d%s >>\n'
+                   b'stream\n' % (number, size, index, len(rows), prev) + rows + b'\nendstream\nendobj\n')
+    else:
+        output += b'xref\n'
+        if previous is None:
+            output += b'0 1\n0000000000 65535 f\r\n'
+        for obj_number in sorted(entries):
+            output += b'%d 1\n%010d 00000 n\r\n' % (obj_number, entries[obj_number][1])
+        output += b'trailer\n<< /Size %d /Root 1 0 R%s >>\n' % (size, prev)
+    output += b'startxref\n%d\n%%%%EOF\n' % xref
+    return bytes(output)
+
+
+def document(filler: int = 0, **options) -> bytes:
+    objects = {1: CATALOG, 2: PAGES, 3: PAGE}
+    objects.update({number: b'<< >>' for number in range(4, 4 + filler)})
+    return build_pdf(objects, **options)
+
+
+def payload(data: bytes) -> Payload:
+    return Payload(data=data, size=len(data))
+
+
+def pypdf_pages(data: bytes) -> int:
+    return len(PyPDF2.PdfReader(BytesIO(data)).pages)
+
+
+def test_xref_table_with_direct_length():
+    assert check_pdf_structure(document()) is None
+    assert check_pdf_structure(make_pdf(3, 50_000)) is None
+
+
+def test_object_stream_with_direct_length():
+    data = document(compressed=(1, 2), xref_stream=True)
+    assert pypdf_pages(data) == 1
+    assert check_pdf_structure(data) is None
+
+
+def test_object_stream_with_indirect_length():
+    # '/Length 15 0 R' must not be read as a direct length of 1.
+    data = document(filler=10, compressed=(1, 2), xref_stream=True, length='indirect')
+    assert b'/Length 15 0 R' in data
+    assert pypdf_pages(data) == 1
+    assert check_pdf_structure(data) is None
+
+
+def test_object_stream_without_length():
+    assert check_pdf_structure(document(compressed=(1, 2), xref_stream=True, length='missing')) is None
+
+
+def test_incremental_update_takes_newest_objects():
+    original = document()
+    emptied = build_pdf({2: b'<< /Type /Pages /Kids [] /Count 0 >>'}, previous=original)
+    assert check_pdf_structure(emptied) == 'page_tree'
+    restored = build_pdf({2: PAGES}, previous=emptied)
+    assert check_pdf_structure(restored) is None
+
+
+def test_incremental_update_with_xref_stream():
+    original = document(compressed=(2,), xref_stream=True)
+    updated = build_pdf({1: b'<< /Type /Catalog /Pages 2 0 R /Lang (en) >>'}, previous=original, xref_stream=True)
+    assert pypdf_pages(updated) == 1
+    assert check_pdf_structure(updated) is None
+
+
+def test_missing_structure_is_reported():
+    data = document()
+    assert check_pdf_structure(b'not a pdf' + data[8:]) == 'header'
+    assert check_pdf_structure(data[:-20]) == 'eof'
+    assert check_pdf_structure(build_pdf({1: b'<< /Type /Catalog >>', 2: PAGES, 3: PAGE})) == 'catalog'
+
+
+def test_malformed_object_stream_header():
+    data = zlib.compress(b'1 x 2 y\n' + CATALOG + PAGES)
+    assert check_pdf_structure(document(compressed=(1, 2), xref_stream=True, objstm_data=data)) == 'catalog'
+
+
+def test_decompression_bomb_is_rejected():
+    compressor = zlib.compressobj(9)
+    chunk = b'\0' * 1_048_576
+    data = b''.join(compressor.compress(chunk) for _ in range(256)) + compressor.flush()
+    bomb = document(compressed=(1, 2), xref_stream=True, objstm_data=data)
+    assert len(bomb) < 300_000
+    tracemalloc.start()
+    try:
+        assert check_pdf_structure(bomb) == 'catalog'
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < 50 * 1_048_576
+
+
+def test_valid_file_in_memory():
+    assert asyncio.run(valid_file(payload(document(compressed=(1, 2), xref_stream=True, length='indirect'))))
+    validation = asyncio.run(valid_file(payload(b'%PDF-1.7\nnothing')))
+    assert not validation and validation.failed_check == 'eof'
@@ -0,0 +1,142 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from cryptography import x509
+from cryptography.x509.oid import NameOID, ExtendedKeyUsageOID, ObjectIdentifier
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.serialization import Encoding, NoEncryption, pkcs12
+
+import bench
+import _engine
+import maintenance
+from sign_handler import SignTime, signature_fields
+from synthetic import make_pdf
+
+DOCUMENT_SIGNING = ObjectIdentifier('1.3.6.1.5.5.7.3.36')
+
+
+def issue(common_name: str, issuer=None, ca: bool = False, eku: list = None):
+    """Returns (certificate, key); without an issuer the certificate is self-signed."""
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    issuer_certificate, issuer_key = issuer or (None, key)
+    now = datetime.now(timezone.utc)
+    builder = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(issuer_certificate.subject if issuer_certificate else name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(days=1))
+        .not_valid_after(now + timedelta(days=30))
+        .add_extension(x509.BasicConstraints(ca=ca, path_length=None), critical=True)
+        .add_extension(x509.KeyUsage(digital_signature=not ca, content_commitment=not ca, key_encipherment=False,
+                                     data_encipherment=False, key_agreement=False, key_cert_sign=ca, crl_sign=ca,
+                                     encipher_only=False, decipher_only=False), critical=True)
+        .add_extension(x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False)
+    )
+    if issuer_certificate:
+        builder = builder.add_extension(
+            x509.AuthorityKeyIdentifier.from_issuer_public_key(issuer_key.public_key()), critical=False)
+    if eku:
+        builder = builder.add_extension(x509.ExtendedKeyUsage(eku), critical=False)
+    return builder.sign(issuer_key, hashes.SHA256()), key
+
+
+def der(*certificates) -> list:
+    return [certificate.public_bytes(Encoding.DER) for certificate in certificates]
+
+
+def sign(certificate, key) -> bytes:
+    """Signs a document the way the signing workers do."""
+    pfx = pkcs12.serialize_key_and_certificates(b'test', key, certificate, None, NoEncryption())
+    _engine._init_worker({'test': (pfx, '')})
+    document = make_pdf(1, 2000)
+    return document + _engine._sign(document, signature_fields(SignTime()), 'test')
+
+
+def verify(signed: bytes, anchors: list, intermediates: list = ()) -> dict:
+    _engine._init_verifier(anchors, list(intermediates), False, 100, 60)
+    [result] = _engine._verify(signed)
+    return result
+
+
+def test_self_signed_certificate_of_the_service(tmp_path):
+    path = str(tmp_path / 'self.pfx')
+    bench.make_pfx(path, 'self', 'password')
+    with open(path, 'rb') as file:
+        key, certificate, _ = pkcs12.load_key_and_certificates(file.read(), b'password')
+    result = verify(sign(certificate, key), der(certificate))
+    assert result["chain_error"] is None
+    assert result["digest_valid"] and result["signature_valid"] and result["chain_valid"]
+    assert result["covers_document"]
+
+
+def test_document_signing_certificate_without_subject_alt_name():
+    root = issue('Root CA', ca=True)
+    leaf = issue('Signer', root)
+    result = verify(sign(*leaf), der(root[0]))
+    assert result["chain_valid"], result["chain_error"]
+
+
+def test_document_signing_eku_through_configured_intermediate():
+    root = issue('Root CA', ca=True)
+    intermediate = issue('Issuing CA', root, ca=True)
+    leaf = issue('Signer', intermediate, eku=[ExtendedKeyUsageOID.EMAIL_PROTECTION, DOCUMENT_SIGNING])
+    signed = sign(*leaf)
+    assert verify(signed, der(root[0]), der(intermediate[0]))["chain_valid"]
+    assert not verify(signed, der(root[0]))["chain_valid"]
+
+
+def test_untrusted_chain_and_tampering_are_reported():
+    root = issue('Root CA', ca=True)
+    signed = sign(*issue('Signer', root))
+    result = verify(signed, der(issue('Other CA', ca=True)[0]))
+    assert not result["chain_valid"] and result["chain_error"]
+
+    tampered = bytearray(signed)
+    tampered[tampered.find(b'Benchmark page')] ^= 1
+    result = verify(bytes(tampered), der(root[0]))
+    assert result["chain_valid"] and not result["digest_valid"]
+
+
+def test_verification_trust_keeps_intermediates_out_of_the_anchors(monkeypatch):
+    root = issue('Root CA', ca=True)
+    intermediate = issue('Issuing CA', root, ca=True)
+    leaf = issue('Signer', intermediate)
+    self_signed = issue('Self')
+    certs = {
+        'chained': SimpleNamespace(certificate=leaf[0], chain=[intermediate[0], root[0]]),
+        'self': SimpleNamespace(certificate=self_signed[0], chain=[]),
+    }
+    monkeypatch.setattr(maintenance.CERTS, 'snapshot', lambda: certs)
+    anchors, intermediates = maintenance.verification_trust()
+    assert sorted(anchors) == sorted(der(root[0], self_signed[0]))
+    assert intermediates == der(intermediate[0])
+
+
+@pytest.mark.usefixtures('database')
+def test_verify_endpoint_accepts_the_services_own_signature():
+    import main
+
+    async def run():
+        await main.app.router.startup()
+        try:
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url='http://test', timeout=60) as client:
+                headers = {"cert-name": bench.CERT_NAME, "sender": "tests"}
+                file_uuid = (await client.post('/sign', content=make_pdf(1, 5000), headers=headers)).json()['uuid']
+                assert (await client.get(f'/wait/{file_uuid}')).json()['status'] == 'Saved'
+                signed = (await client.get(f'/get_signed/{file_uuid}')).content
+                return (await client.post('/verify', content=signed)).json()
+        finally:
+            await main.app.router.shutdown()
+
+    response = asyncio.run(run())
+    [signature] = response["signatures"]
+    assert signature["chain_valid"], signature
+    assert response["valid"]
@@ -1,20 +1,56 @@
 import re
+import mmap
+import zlib
 import PyPDF2
-from io import BytesIO
 import asyncio
+from dataclasses import dataclass
+from typing import Optional
+from _payload import Payload
+from _config import UPLOAD_MAX_SIZE, VALIDATION_MODE
+from _metrics import stage
 
 
-async def valid_file(file_content: bytes) -> bool:
+@dataclass
+class FileValidation:
+    valid: bool
+    failed_check: Optional[str] = None
+
+    def __bool__(self) -> bool:
+        return self.valid
+
+
+async def valid_file(payload: Payload, strict: bool = None) -> FileValidation:
+    """Checks the size limit and the PDF structure of an uploaded document.
+
+    The default "fast" mode only inspects the header, startxref, the trailer and the cross-reference
+    data and resolves the catalog and the page tree root, see check_pdf_structure. The "strict" mode
+    (VALIDATION_MODE or strict=True) parses the whole page tree with PyPDF2. Documents using features
+    the fast mode does not handle are always checked in strict mode.
+    """
+    with stage('validate'):
+        return await _valid_file(payload, strict)
+
+
+async def _valid_file(payload: Payload, strict: bool = None) -> FileValidation:
     async def check_file_size() -> bool:
-        max_size = 20_971_520
-        return len(file_content) <= max_size
+        return payload.size <= UPLOAD_MAX_SIZE
+
+    async def check_pdf_structure_async() -> Optional[str]:
+        def check_structure() -> Optional[str]:
+            if payload.in_memory:
+                return check_pdf_structure(memoryview(payload.data))
+            with open(payload.path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                return check_pdf_structure(buf)
+
+        return await asyncio.to_thread(check_structure)
 
     async def check_pdf_integrity_async() -> bool:
         # This wrapper function allows us to run the synchronous check_pdf_integrity function in a thread
         def check_pdf_integrity() -> bool:
             try:
-                pdf_reader = PyPDF2.PdfReader(BytesIO(file_content))
-                return len(pdf_reader.pages) > 0
+                with payload.open() as stream:
+                    pdf_reader = PyPDF2.PdfReader(stream)
+                    return len(pdf_reader.pages) > 0
             except Exception as e:
                 print(f"Unexpected error: {e}")
                 return False
@@ -23,12 +59,387 @@ async def valid_file(file_content: bytes) -> bool:
         return await asyncio.to_thread(check_pdf_integrity)
 
     if not await check_file_size():
-        return False
+        return FileValidation(False, 'size')
+
+    if payload.size == 0:
+        return FileValidation(False, 'header')
+
+    if strict is None:
+        strict = VALIDATION_MODE == 'strict'
+
+    if not strict:
+        try:
+            failed_check = await check_pdf_structure_async()
+        except UnsupportedStructure:
+            pass
+        else:
+            return FileValidation(failed_check is None, failed_check)
 
     if not await check_pdf_integrity_async():
-        return False
+        return FileValidation(False, 'integrity')
+
+    return FileValidation(True)
+
+
+# -------------- Structural PDF check --------------
+class UnsupportedStructure(Exception):
+    """The document uses a feature the structural check does not handle."""
+
+
+class _Broken(Exception):
+    def __init__(self, check: str):
+        super().__init__(check)
+        self.check = check
+
+
+_HEADER = re.compile(rb'%PDF-\d\.\d')
+_EOF = re.compile(rb'%%EOF')
+_STARTXREF = re.compile(rb'startxref\s+(\d+)')
+_XREF_KEYWORD = re.compile(rb'\s*xref\s*')
+_SUBSECTION = re.compile(rb'\s*(\d+) +(\d+)[ \t]*(?:\r\n|\r|\n)')
+_XREF_ENTRY = re.compile(rb'(\d{10}) (\d{5}) ([nf])')
+_TRAILER = re.compile(rb'\s*trailer')
+_OBJ_HEADER = re.compile(rb'\s*(\d+)\s+(\d+)\s+obj\b')
+_DICT_START = re.compile(rb'\s*<<')
+_DICT_DELIM = re.compile(rb'<<|>>')
+_STREAM_KEYWORD = re.compile(rb'\s*stream(?:\r\n|\n)')
+_ENDSTREAM = re.compile(rb'(?:\r\n|\r|\n)?endstream')
+_ROOT = re.compile(rb'/Root\s+(\d+)\s+(\d+)\s+R')
+_PAGES = re.compile(rb'/Pages\s+(\d+)\s+(\d+)\s+R')
+_COUNT = re.compile(rb'/Count\s+(\d+)')
+_PREV = re.compile(rb'/Prev\s+(\d+)')
+_XREF_STM = re.compile(rb'/XRefStm\s+(\d+)')
+_TYPE_XREF = re.compile(rb'/Type\s*/XRef\b')
+_LENGTH = re.compile(rb'/Length\s+(\d+)(?:\s+(\d+)\s+R\b)?')
+_INTEGER_OBJ = re.compile(rb'\s*(\d+)\s+endobj')
+_FILTER = re.compile(rb'/Filter\s*(?:/(\w+)|\[\s*((?:/\w+\s*)*)\])')
+_PREDICTOR = re.compile(rb'/Predictor\s+(\d+)')
+_COLUMNS = re.compile(rb'/Columns\s+(\d+)')
+_W = re.compile(rb'/W\s*\[\s*(\d+)\s+(\d+)\s+(\d+)\s*\]')
+_INDEX = re.compile(rb'/Index\s*\[([\d\s]*)\]')
+_SIZE = re.compile(rb'/Size\s+(\d+)')
+_N = re.compile(rb'/N\s+(\d+)')
+_FIRST = re.compile(rb'/First\s+(\d+)')
+
+_MAX_DICT = 1_048_576
+# Decoded size of an xref or object stream. Larger streams are treated as a decompression bomb.
+_MAX_STREAM = 16 * 1_048_576
+_MAX_SECTIONS = 64
+
+
+def check_pdf_structure(buf) -> Optional[str]:
+    """Validates the PDF skeleton of buf (bytes, memoryview or mmap) without copying it.
+
+    Checks the header, the %%EOF marker, startxref, the cross-reference table or stream with its
+    /Prev chain and the trailer, then resolves the document catalog and the page tree root and
+    requires a positive /Count. Returns the name of the first failed check or None.
+    Raises UnsupportedStructure for encodings this check does not implement.
+    """
+    size = len(buf)
+    if not _HEADER.search(buf, 0, min(size, 1024)):
+        return 'header'
+
+    tail = max(0, size - 1024)
+    if not _EOF.search(buf, tail):
+        return 'eof'
+
+    startxref = None
+    for startxref in _STARTXREF.finditer(buf, tail):
+        pass
+    if startxref is None or int(startxref.group(1)) >= size:
+        return 'startxref'
+
+    try:
+        sections, trailer = _read_sections(buf, int(startxref.group(1)))
+
+        root = _ROOT.search(trailer)
+        if not root:
+            return 'trailer'
+
+        catalog = _resolve(buf, sections, int(root.group(1)), 'catalog')
+        pages = _PAGES.search(catalog)
+        if not pages:
+            return 'catalog'
+
+        page_tree = _resolve(buf, sections, int(pages.group(1)), 'page_tree')
+        count = _COUNT.search(page_tree)
+        if not count or int(count.group(1)) == 0:
+            return 'page_tree'
+    except _Broken as e:
+        return e.check
+
+    return None
+
+
+def _dict_at(buf, pos: int, check: str):
+    """Returns the dictionary starting at pos as bytes, together with the position after it."""
+    start = _DICT_START.match(buf, pos)
+    if not start:
+        raise _Broken(check)
+    depth = 0
+    for delimiter in _DICT_DELIM.finditer(buf, start.end() - 2, start.end() + _MAX_DICT):
+        depth += 1 if delimiter.group() == b'<<' else -1
+        if depth == 0:
+            return bytes(buf[start.end() - 2:delimiter.end()]), delimiter.end()
+    raise _Broken(check)
+
+
+def _stream_at(buf, pos: int, check: str, sections: Optional[list] = None):
+    """Returns the dictionary and the decoded data of the stream object whose header starts at pos.
+
+    An indirect /Length is resolved through sections when they are known; otherwise, or if that fails,
+    the data ends at the endstream keyword.
+    """
+    header = _OBJ_HEADER.match(buf, pos)
+    if not header:
+        raise _Broken(check)
+    dictionary, end = _dict_at(buf, header.end(), check)
+    keyword = _STREAM_KEYWORD.match(buf, end)
+    if not keyword:
+        raise _Broken(check)
+
+    length = _LENGTH.search(dictionary)
+    data_length = None
+    if length and length.group(2) is None:
+        data_length = int(length.group(1))
+    elif length and sections:
+        data_length = _integer(buf, sections, int(length.group(1)))
+    if data_length is not None and keyword.end() + data_length <= len(buf):
+        data_end = keyword.end() + data_length
+    else:
+        endstream = _ENDSTREAM.search(buf, keyword.end())
+        if not endstream:
+            raise _Broken(check)
+        data_end = endstream.start()
+    data = bytes(buf[keyword.end():data_end])
+
+    filters = _FILTER.search(dictionary)
+    if filters:
+        names = [filters.group(1)] if filters.group(1) else filters.group(2).split()
+        if [name.strip(b'/') for name in names] != [b'FlateDecode']:
+            raise UnsupportedStructure(filters.group(0).decode(errors='replace'))
+        decompressor = zlib.decompressobj()
+        try:
+            data = decompressor.decompress(data, _MAX_STREAM)
+        except zlib.error:
+            raise _Broken(check)
+        if decompressor.unconsumed_tail:
+            raise _Broken(check)
+
+    predictor = _PREDICTOR.search(dictionary)
+    if predictor and int(predictor.group(1)) > 1:
+        if int(predictor.group(1)) < 10:
+            raise UnsupportedStructure("TIFF predictor")
+        columns = _COLUMNS.search(dictionary)
+        data = _png_unpredict(data, int(columns.group(1)) if columns else 1, check)
+
+    return dictionary, data
+
+
+def _png_unpredict(data: bytes, columns: int, check: str) -> bytes:
+    row_size = columns + 1
+    if len(data) % row_size:
+        raise _Broken(check)
+    previous = bytearray(columns)
+    output = bytearray()
+    for offset in range(0, len(data), row_size):
+        kind = data[offset]
+        row = bytearray(data[offset + 1:offset + row_size])
+        for i in range(columns):
+            left = row[i - 1] if i else 0
+            up = previous[i]
+            if kind == 1:
+                row[i] = (row[i] + left) & 0xFF
+            elif kind == 2:
+                row[i] = (row[i] + up) & 0xFF
+            elif kind == 3:
+                row[i] = (row[i] + ((left + up) >> 1)) & 0xFF
+            elif kind == 4:
+                upper_left = previous[i - 1] if i else 0
+                estimate = left + up - upper_left
+                pa, pb, pc = abs(estimate - left), abs(estimate - up), abs(estimate - upper_left)
+                row[i] = (row[i] + (left if pa <= pb and pa <= pc else up if pb <= pc else upper_left)) & 0xFF
+            elif kind != 0:
+                raise _Broken(check)
+        output += row
+        previous = row
+    return bytes(output)
+
+
+def _read_sections(buf, offset: int):
+    """Follows the /Prev chain from startxref. Returns the lookup functions, newest first, and the newest trailer."""
+    sections = []
+    trailer = None
+    pending = [offset]
+    seen = set()
+    while pending:
+        offset = pending.pop(0)
+        if offset in seen or offset >= len(buf) or len(seen) >= _MAX_SECTIONS:
+            raise _Broken('xref')
+        seen.add(offset)
+
+        keyword = _XREF_KEYWORD.match(buf, offset)
+        if keyword:
+            lookup, dictionary = _read_xref_table(buf, keyword.end())
+        else:
+            lookup, dictionary = _read_xref_stream(buf, offset)
+        sections.append(lookup)
+        if trailer is None:
+            trailer = dictionary
+
+        # A hybrid file keeps the entries of compressed objects in the stream named by /XRefStm.
+        xref_stm = _XREF_STM.search(dictionary)
+        if xref_stm and keyword:
+            stream_lookup, _ = _read_xref_stream(buf, int(xref_stm.group(1)))
+            sections.append(stream_lookup)
+            seen.add(int(xref_stm.group(1)))
+        prev = _PREV.search(dictionary)
+        if prev:
+            pending.append(int(prev.group(1)))
+
+    return sections, trailer
+
+
+def _read_xref_table(buf, pos: int):
+    subsections = []
+    while True:
+        subsection = _SUBSECTION.match(buf, pos)
+        if not subsection:
+            break
+        first, count, start = int(subsection.group(1)), int(subsection.group(2)), subsection.end()
+        # Entries are 20 bytes long, some writers end them with a single-byte EOL.
+        entry_size = 20
+        if count > 1 and not _XREF_ENTRY.match(buf, start + 20) and _XREF_ENTRY.match(buf, start + 19):
+            entry_size = 19
+        subsections.append((first, count, start, entry_size))
+        pos = start + count * entry_size
+
+    keyword = _TRAILER.match(buf, pos)
+    if not subsections or not keyword:
+        raise _Broken('xref' if not subsections else 'trailer')
+    trailer, _ = _dict_at(buf, keyword.end(), 'trailer')
+
+    def lookup(number: int):
+        for first, count, start, entry_size in subsections:
+            if first <= number < first + count:
+                entry = _XREF_ENTRY.match(buf, start + (number - first) * entry_size)
+                if not entry:
+                    raise _Broken('xref')
+                return ('offset', int(entry.group(1))) if entry.group(3) == b'n' else None
+        return None
+
+    return lookup, trailer
+
+
+def _read_xref_stream(buf, offset: int):
+    dictionary, data = _stream_at(buf, offset, 'xref')
+    widths = _W.search(dictionary)
+    if not _TYPE_XREF.search(dictionary) or not widths:
+        raise _Broken('xref')
+    widths = [int(width) for width in widths.groups()]
+    row_size = sum(widths)
+
+    index = _INDEX.search(dictionary)
+    if index:
+        bounds = [int(value) for value in index.group(1).split()]
+    else:
+        size = _SIZE.search(dictionary)
+        bounds = [0, int(size.group(1)) if size else 0]
+    ranges = list(zip(bounds[0::2], bounds[1::2]))
+
+    def field(row: int, start: int, width: int, default: int) -> int:
+        return int.from_bytes(data[row + start:row + start + width], 'big') if width else default
+
+    def lookup(number: int):
+        row_number = 0
+        for first, count in ranges:
+            if first <= number < first + count:
+                row = (row_number + number - first) * row_size
+                if row + row_size > len(data):
+                    raise _Broken('xref')
+                kind = field(row, 0, widths[0], 1)
+                second = field(row, widths[0], widths[1], 0)
+                third = field(row, widths[0] + widths[1], widths[2], 0)
+                if kind == 1:
+                    return 'offset', second
+                if kind == 2:
+                    return 'compressed', second, third
+                return None
+            row_number += count
+        return None
+
+    return lookup, dictionary
+
+
+def _integer(buf, sections: list, number: int) -> Optional[int]:
+    """Returns the value of the direct integer object number, None if it is not one."""
+    for lookup in sections:
+        try:
+            entry = lookup(number)
+        except _Broken:
+            return None
+        if entry:
+            break
+    else:
+        return None
+    if entry[0] != 'offset':
+        return None
+    header = _OBJ_HEADER.match(buf, entry[1])
+    if not header or int(header.group(1)) != number:
+        return None
+    value = _INTEGER_OBJ.match(buf, header.end())
+    return int(value.group(1)) if value else None
+
+
+def _resolve(buf, sections: list, number: int, check: str) -> bytes:
+    """Returns the dictionary of the object number, looking it up in the newest section first."""
+    try:
+        return _resolve_object(buf, sections, number, check)
+    except (ValueError, IndexError):
+        # Malformed numbers or offsets in crafted object streams and cross-reference data.
+        raise _Broken(check)
+
+
+def _resolve_object(buf, sections: list, number: int, check: str) -> bytes:
+    for lookup in sections:
+        entry = lookup(number)
+        if entry:
+            break
+    else:
+        raise _Broken(check)
+
+    if entry[0] == 'offset':
+        header = _OBJ_HEADER.match(buf, entry[1])
+        if not header or int(header.group(1)) != number:
+            raise _Broken(check)
+        return _dict_at(buf, header.end(), check)[0]
+
+    # The object is stored in an object stream.
+    _, stream_number, index = entry
+    for lookup in sections:
+        stream_entry = lookup(stream_number)
+        if stream_entry:
+            break
+    else:
+        raise _Broken(check)
+    if stream_entry[0] != 'offset':
+        raise _Broken(check)
+
+    dictionary, data = _stream_at(buf, stream_entry[1], check, sections)
+    count, first = _N.search(dictionary), _FIRST.search(dictionary)
+    if not count or not first or not 0 <= index < int(count.group(1)):
+        raise _Broken(check)
+    header = data[:int(first.group(1))].split()
+    # The header holds pairs of object number and offset; crafted streams may hold anything else.
+    if len(header) < 2 * index + 2 or not header[2 * index].isdigit() or not header[2 * index + 1].isdigit():
+        raise _Broken(check)
+    if int(header[2 * index]) != number:
+        raise _Broken(check)
+    return _dict_at(data, int(first.group(1)) + int(header[2 * index + 1]), check)[0]
+
 
-    return True
+# Documents.Sender is NVARCHAR(255).
+MAX_SENDER_LENGTH = 255
 
 
 def sanitize_input(input_str: str) -> str: